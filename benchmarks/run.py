@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""Benchmarks of docker-rpmbuild against a fake docker daemon.
+
+Every benchmark runs in its own process so its peak memory can be told
+apart, the fake daemon runs in this one.  All workload sizes are multiplied
+by the scale factor.  The defaults take a minute or so, a scale of 8 gives
+multi-GB tarballs and RPMs.
+
+Usage:
+    run.py [--scale=<factor>] [--save=<file>]
+           [--compare=<file> [--threshold=<ratio>]] [<benchmark>...]
+    run.py --list
+    run.py --child=<benchmark> --base-url=<url> [--scale=<factor>]
+
+Options:
+    -h --help              Show this screen.
+    --list                 List the benchmarks.
+    --scale=<factor>       Multiply every workload size [default: 1].
+    --save=<file>          Store the results as JSON, to compare against.
+    --compare=<file>       Compare with stored results, exit non-zero when a
+                           benchmark got slower or needs more memory.
+    --threshold=<ratio>    Tolerated loss of throughput and growth of peak
+                           memory [default: 0.2].
+    --child=<benchmark>    Run a single benchmark, used internally.
+    --base-url=<url>       Fake daemon of a child, used internally.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(HERE), os.path.join(os.path.dirname(HERE),
+                                                     'tests')]
+
+from docopt import docopt
+import docker
+
+from fakedocker import FakeDocker
+from workloads import BENCHMARKS
+
+# Memory growth below this much is noise of the interpreter.
+MEMORY_SLACK = 16 * 1024 * 1024
+
+
+def rss():
+    """Current resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return peak_rss()
+
+
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def child(name, base_url, scale):
+    benchmark = BENCHMARKS[name]
+    tmp = tempfile.mkdtemp(prefix='rpmbuild-bench-')
+    os.environ['DOCKER_RPMBUILD_CACHE'] = os.path.join(tmp, 'cache')
+
+    try:
+        client = docker.Client(base_url=base_url, version='1.24')
+        run = benchmark.prepare(client, tmp, scale)
+
+        before = rss()
+        start = time.time()
+        amount = run()
+        seconds = time.time() - start
+        peak = max(peak_rss() - before, 0)
+    finally:
+        shutil.rmtree(tmp)
+
+    print(json.dumps({
+        'unit': benchmark.unit,
+        'amount': amount,
+        'seconds': seconds,
+        'throughput': amount / seconds if seconds else 0,
+        'peak_rss': peak,
+    }))
+
+
+def run_benchmarks(names, scale):
+    results = {}
+
+    with FakeDocker() as daemon:
+        for name in names:
+            benchmark = BENCHMARKS[name]
+            daemon.log_lines = 0
+            daemon.rpm_size = None
+            for key, value in benchmark.server(scale).items():
+                setattr(daemon, key, value)
+
+            output = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__),
+                '--child=%s' % name, '--base-url=%s' % daemon.base_url,
+                '--scale=%s' % scale])
+            results[name] = json.loads(output.decode('utf-8').splitlines()[-1])
+            print(format_result(name, results[name]))
+
+    return results
+
+
+def human(value, unit):
+    if unit != 'bytes':
+        return '%.0f %s' % (value, unit)
+    for prefix in ('', 'Ki', 'Mi', 'Gi'):
+        if value < 1024:
+            break
+        value /= 1024.0
+    return '%.1f %sB' % (value, prefix)
+
+
+def format_result(name, result):
+    return '%-22s %14s/s %10s peak %8.2fs' % (
+        name, human(result['throughput'], result['unit']),
+        human(result['peak_rss'], 'bytes'), result['seconds'])
+
+
+def compare(results, baseline, threshold):
+    """Print the change against baseline, returning the regressed names."""
+    regressions = []
+
+    print('')
+    print('%-22s %12s %12s' % ('Compared to baseline', 'throughput', 'memory'))
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print('%-22s %12s' % (name, 'new'))
+            continue
+
+        speed = result['throughput'] / base['throughput'] - 1
+        memory = result['peak_rss'] - base['peak_rss']
+        regressed = (speed < -threshold or
+                     memory > base['peak_rss'] * threshold + MEMORY_SLACK)
+        print('%-22s %+11.1f%% %12s%s' % (
+            name, speed * 100, ('+' if memory >= 0 else '-') +
+            human(abs(memory), 'bytes'), '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    args = docopt(__doc__)
+    scale = float(args['--scale'])
+
+    if args['--list']:
+        for name, benchmark in BENCHMARKS.items():
+            print('%-22s %s' % (name, benchmark.unit))
+        return
+
+    if args['--child']:
+        return child(args['--child'], args['--base-url'], scale)
+
+    names = args['<benchmark>'] or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit('Unknown benchmarks: %s' % ', '.join(unknown))
+
+    results = run_benchmarks(names, scale)
+
+    if args['--save']:
+        with open(args['--save'], 'w') as f:
+            json.dump({'python': platform.python_version(), 'scale': scale,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != scale:
+            print('Warning: baseline was run with --scale=%s'
+                  % baseline.get('scale'), file=sys.stderr)
+        if compare(results, baseline['results'],
+                   float(args['--threshold'])):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
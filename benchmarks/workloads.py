@@ -0,0 +1,139 @@
+"""
+Synthetic workloads of the benchmark suite.
+
+Every benchmark has a prepare step that is not measured, building the
+files it needs below tmp and returning a callable doing the measured work.
+That callable returns the amount of work done in the benchmark's unit.
+Server settings are applied to the fake daemon before the benchmark runs.
+"""
+
+from collections import namedtuple, OrderedDict
+import os
+
+from rpmbuild import Packager, PackagerContext
+from rpmbuild.logs import BuildLog
+
+MiB = 1024 * 1024
+IMAGE = 'centos:7'
+
+Benchmark = namedtuple('Benchmark', ['unit', 'server', 'prepare'])
+
+
+def write_file(path, size, block=b'\xa5' * MiB):
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(block[:min(size, len(block))])
+            size -= len(block)
+    return path
+
+
+def write_spec(tmp, name='bench'):
+    path = os.path.join(tmp, '%s.spec' % name)
+    with open(path, 'w') as f:
+        f.write('Name: %s\nVersion: 1.0\nBuildRequires: gcc\n' % name)
+    return path
+
+
+def small_files(directory, count, size):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return [write_file(os.path.join(directory, 'source%05d.patch' % i), size)
+            for i in range(count)]
+
+
+def prepare_setup_small_sources(client, tmp, scale):
+    sources = small_files(os.path.join(tmp, 'sources'), int(2000 * scale),
+                          4096)
+    context = PackagerContext(IMAGE, spec=write_spec(tmp), sources=sources)
+
+    def run():
+        context.setup()
+        context.teardown()
+        return len(sources)
+    return run
+
+
+def prepare_setup_sources_dir(client, tmp, scale):
+    directory = os.path.join(tmp, 'tree')
+    small_files(directory, int(2000 * scale), 4096)
+    context = PackagerContext(IMAGE, spec=write_spec(tmp), sources=[directory],
+                              stream=True)
+
+    def run():
+        context.setup()
+        return context.size()
+    return run
+
+
+def prepare_build_image(stream):
+    def prepare(client, tmp, scale):
+        tarball = write_file(os.path.join(tmp, 'bench-1.0.tar.gz'),
+                             int(256 * MiB * scale))
+        context = PackagerContext(IMAGE, spec=write_spec(tmp),
+                                  sources=[tarball], stream=stream)
+        packager = Packager(context, client=client).__enter__()
+
+        def run():
+            for line in packager.build_image():
+                pass
+            packager.__exit__(None, None, None)
+            return os.path.getsize(tarball)
+        return run
+    return prepare
+
+
+def prepare_container(client, tmp):
+    """Packager with an image built and its container started."""
+    packager = Packager(PackagerContext(IMAGE, spec=write_spec(tmp),
+                                        stream=True), client=client)
+    packager.__enter__()
+    for line in packager.build_image():
+        pass
+    container, logs = packager.build_package()
+    return packager, logs
+
+
+def prepare_export_large_rpm(client, tmp, scale):
+    packager, logs = prepare_container(client, tmp)
+    output = os.path.join(tmp, 'out')
+    os.mkdir(output)
+
+    def run():
+        return sum(os.path.getsize(path)
+                   for path in packager.export_package(output))
+    return run
+
+
+def prepare_log_flood(client, tmp, scale):
+    packager, logs = prepare_container(client, tmp)
+    log = BuildLog(os.path.join(tmp, 'bench.log'), console=lambda line: None)
+
+    def run():
+        lines = 0
+        for line in logs:
+            log(line.decode('UTF-8').strip())
+            lines += 1
+        log.close()
+        return lines
+    return run
+
+
+BENCHMARKS = OrderedDict([
+    ('setup_small_sources',
+     Benchmark('files', lambda scale: {}, prepare_setup_small_sources)),
+    ('setup_sources_dir',
+     Benchmark('bytes', lambda scale: {}, prepare_setup_sources_dir)),
+    ('build_image_copy',
+     Benchmark('bytes', lambda scale: {}, prepare_build_image(False))),
+    ('build_image_stream',
+     Benchmark('bytes', lambda scale: {}, prepare_build_image(True))),
+    ('export_large_rpm',
+     Benchmark('bytes', lambda scale: {'rpm_size': int(256 * MiB * scale)},
+               prepare_export_large_rpm)),
+    ('log_flood',
+     Benchmark('lines', lambda scale: {'log_lines': int(200000 * scale)},
+               prepare_log_flood)),
+])
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -1,17 +1,60 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
+import hashlib
+import io
+import json
+import math
 import os
 import shutil
+import tarfile
 import tempfile
+import threading
+import time
 
 from jinja2 import Template
 import docker
 
+from rpmbuild.cache import cache_dir, cache_key, evict, lock
+from rpmbuild.config import PROFILES
+from rpmbuild.metrics import Metrics
+from rpmbuild.sources import (IGNORE_FILE, DownloadCache, directory_digest,
+                              file_digest, pack_directories, select_files,
+                              source_name)
+from rpmbuild.spec import Spec
+
+CHUNK_SIZE = 1024 * 1024
+YUM_CACHE_SIZE = 4096 * 1024 * 1024
+CPU_PERIOD = 100000
+
+# rpmbuild arguments of the stages a development build can restart from.
+STAGES = {
+    'all': '-ba',
+    'build': '-bc --short-circuit',
+    'install': '-bi --short-circuit',
+    'files': '-bl',
+    'binary': '-bb --short-circuit',
+}
+
+# Keep downloaded packages in the mounted cache only while the stage runs.
+# The option is passed on the command line so the configuration the image
+# ships with, and what later yum or dnf calls keep, stays untouched.
+YUM_CACHE_SCRIPT = (
+    'yum() { command yum --setopt=keepcache=1 "$@"; }; '
+    'dnf() { command dnf --setopt=keepcache=1 "$@"; }; %s')
+
+# Package caches of yum and dnf, each bound to its own directory of the cache.
+PACKAGE_CACHES = ('yum', 'dnf')
+
 
 class PackagerContext(object):
 
     def __init__(self, image, defines=None, sources=None, sources_dir=None,
-                 spec=None, macrofiles=None, retrieve=None, srpm=None):
+                 spec=None, macrofiles=None, retrieve=None, srpm=None,
+                 stream=False, source_format='gz', repo=None,
+                 context_image=None, download_cache=None, ignore=None,
+                 referenced_sources=False, profile=None):
         self.image = image
         self.defines = defines
         self.sources = sources
@@ -19,10 +62,27 @@ class PackagerContext(object):
         self.spec = spec
         self.srpm = srpm
         self.retrieve = retrieve
+        self.spectool = bool(retrieve)
+        self.download_cache = download_cache
+        self.build_requires = []
+        self.toolchain = None
+        self.stream = stream
+        self.source_format = source_format
+        self.packed = {}
+        self.repo = repo
+        self.context_image = context_image
+        self.ignore = ignore or []
+        self.referenced_sources = referenced_sources
+        self.path = None
+        self._sources_dir_files = None
 
         if not defines:
             self.defines = []
 
+        # Defines of the profile come first so the given ones override them.
+        self.profile = profile or PROFILES['release']
+        self.defines = self.profile.defines + self.defines
+
         if not sources:
             self.sources = []
 
@@ -34,94 +94,351 @@ class PackagerContext(object):
         else:
             self.sources_dir = None
 
+        # Filtered source directories go into the context file by file.
+        self.filtered = bool(self.sources_dir and (
+            self.ignore or referenced_sources or
+            os.path.exists(os.path.join(self.sources_dir, IGNORE_FILE))))
+
         if image is None:
             raise PackagerException("Must provide base docker <image>")
 
+        self.metrics = Metrics(os.path.basename(spec or srpm or image))
+
         # We do this so it's always easy to referrer to the generated Dockerfile in sphinx.
         self.template = Template(self._dockerfile())
+        self.deps_template = Template(self._deps_dockerfile())
+        self.toolchain_template = Template(self._toolchain_dockerfile())
 
     def __str__(self):
         return self.spec or self.srpm
 
-    def _dockerfile(self):
-        """Hacking up the unintentional tarball unpack
-        https://github.com/dotcloud/docker/issues/3050"""
+    @property
+    def base_image(self):
+        """Shared toolchain image when the packager provides one."""
+        return self.toolchain or self.image
+
+    @property
+    def deps_image(self):
+        """
+        Tag of the image holding the spec's BuildRequires.  It is keyed only
+        by the base image, the defines and the resolved dependency set so
+        edits to the spec body or the sources keep reusing it.
+        """
+        if not self.build_requires or self.repo:
+            # Packages from a local repo are rebuilt with every run, they are
+            # resolved by yum-builddep once the repo is set up.
+            return None
+
+        digest = hashlib.sha1()
+        for part in [self.base_image] + self.defines + self.build_requires:
+            digest.update(part.encode('utf-8') + b'\0')
+
+        return 'rpmbuild_deps:%s' % digest.hexdigest()[:12]
+
+    def _toolchain_dockerfile(self):
+        """Toolchain stage, built once per base image digest."""
         return """
             FROM {{ image }}
 
             RUN yum -y install rpmdevtools yum-utils tar
             RUN rpmdev-setuptree
 
-            {% if sources_dir is not none %}
-            ADD SOURCES /rpmbuild/SOURCES
+            """
+
+    def toolchain_dockerfile(self):
+        return io.BytesIO(self.toolchain_template.render(
+            image=self.image,
+        ).encode('utf-8'))
+
+    def _deps_dockerfile(self):
+        """Dependency stage, built once per BuildRequires set."""
+        return """
+            FROM {{ image }}
+
+            RUN yum -y install {% for require in build_requires %} '{{ require }}'{% endfor %}
+
+            """
+
+    def deps_dockerfile(self):
+        return io.BytesIO(self.deps_template.render(
+            image=self.base_image,
+            build_requires=self.build_requires,
+        ).encode('utf-8'))
+
+    def _dockerfile(self):
+        """Sources use COPY to avoid the unintentional tarball unpack
+        https://github.com/dotcloud/docker/issues/3050.  Directory sources
+        arrive already packed by the host.  With a context image everything
+        is copied from it instead of from an uploaded context.  The rpmbuild
+        stage is read from $RPMBUILD_STAGE so resumed builds can skip to
+        a later one."""
+        return """
+            FROM {{ deps_image or toolchain or image }}
+
+            {% set copy = 'COPY --from=' ~ context_image ~ ' /context/' if context_image else 'COPY ' %}
+
+            {% if toolchain is none %}
+            RUN yum -y install rpmdevtools yum-utils tar
+            RUN rpmdev-setuptree
+            {% endif %}
+
+            {% if repo %}
+            {{ copy }}REPO /rpmbuild/REPO
+            RUN yum -y install createrepo && createrepo /rpmbuild/REPO && printf '[rpmbuild-local]\\nname=rpmbuild-local\\nbaseurl=file:///rpmbuild/REPO\\nenabled=1\\ngpgcheck=0\\n' > /etc/yum.repos.d/rpmbuild-local.repo
+            {% endif %}
+
+            {% if sources_dir %}
+            {{ copy }}SOURCES /rpmbuild/SOURCES
             {% endif %}
             {% for source in sources %}
-            ADD {{ source }} /rpmbuild/SOURCES/{{ source }}
-            RUN cd /rpmbuild/SOURCES; if [ -d {{ source }} ]; then mv {{ source }} {{ source }}.tmp; tar -C {{ source }}.tmp -czvf {{ source }} .; rm -r {{ source }}.tmp; fi
-            RUN chown -R root:root /rpmbuild/SOURCES
+            {{ copy }}{{ source }} /rpmbuild/SOURCES/{{ source }}
             {% endfor %}
 
             {% if spec %}
             {% for macrofile in macrofiles %}
-            ADD {{ macrofile }} /rpmbuild/SPECS/{{ macrofile }}
+            {{ copy }}{{ macrofile }} /rpmbuild/SPECS/{{ macrofile }}
             {% endfor %}
-            ADD {{ spec }} /rpmbuild/SPECS/{{ spec }}
+            {{ copy }}{{ spec }} /rpmbuild/SPECS/{{ spec }}
             RUN chown -R root:root /rpmbuild/SPECS
             {% if retrieve %}
             RUN spectool -g -R -A /rpmbuild/SPECS/{{ spec }}
             {% endif %}
             RUN yum-builddep -y $(rpmbuild {% for define in defines %} --define '{{ define }}' {% endfor %} -bs /rpmbuild/SPECS/{{ spec }} | awk '{ print $2 }')
-            CMD rpmbuild {% for define in defines %} --define '{{ define }}' {% endfor %} -ba /rpmbuild/SPECS/{{ spec }}
+            ENV RPMBUILD_STAGE {{ stage }}
+            CMD rpmbuild {% for define in defines %} --define '{{ define }}' {% endfor %} {% for option in options %}{{ option }} {% endfor %}$RPMBUILD_STAGE /rpmbuild/SPECS/{{ spec }}
             {% endif %}
 
             {% if srpm %}
-            ADD {{ srpm }} /rpmbuild/SRPMS/{{ srpm }}
+            {{ copy }}{{ srpm }} /rpmbuild/SRPMS/{{ srpm }}
             RUN chown -R root:root /rpmbuild/SRPMS
-            CMD rpmbuild --rebuild /rpmbuild/SRPMS/{{ srpm }}
+            CMD rpmbuild {% for define in defines %} --define '{{ define }}' {% endfor %} {% for option in options %}{{ option }} {% endfor %}--rebuild /rpmbuild/SRPMS/{{ srpm }}
             {% endif %}
 
             """
 
+    def _context_dockerfile(self):
+        """Data only image holding the context, shared by matrix builds."""
+        return """
+            FROM scratch
+            COPY . /context/
+            """
+
     def setup(self):
         """
         Setup context for docker container build.  Copies the source tarball
         and SPEC file to the context directory.  Writes a Dockerfile from the
-        template above.
+        template above.  Streamed contexts skip the directory entirely and
+        are sent to docker straight from the original files by chunks().
         """
+        with self.metrics.phase('setup'):
+            self._setup()
+        self.metrics.add('setup', bytes=self.size())
+
+    def _setup(self):
+        self.path = None
+
+        if self.spec:
+            with open(self.spec) as f:
+                spec = Spec(f.read(), self.defines)
+            self.build_requires = spec.build_requires
+
+            if self.retrieve and self.download_cache is not False:
+                self.retrieve_sources(spec.remote_sources)
+
+        directories = [s for s in self.sources if os.path.isdir(s)]
+        with pack_directories(directories, self.source_format) as packed:
+            self.packed = packed
+            if not (self.stream or self.context_image):
+                self._copy_context()
+
+    def _copy_context(self):
         self.path = tempfile.mkdtemp()
         self.dockerfile = os.path.join(self.path, 'Dockerfile')
 
-        for source in self.sources:
-            shutil.copy(source, self.path)
+        for path, name in self.files():
+            target = os.path.join(self.path, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, target)
+            else:
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.copy(path, target)
+
+        with open(self.dockerfile, 'w') as f:
+            f.write(self.render())
+
+    def retrieve_sources(self, urls):
+        """
+        Download the spec's remote sources on the host through the download
+        cache and add them to the context.  spectool only runs in the
+        container when some URL could not be resolved or fetched.
+        """
+        if self.download_cache is None:
+            self.download_cache = DownloadCache(cache_dir('downloads'))
+
+        local = set(os.path.basename(s) for s in self.sources)
+        unresolved = [url for url in urls if '%' in url]
+        wanted = [url for url in urls
+                  if '%' not in url and source_name(url) not in local]
 
-        for macrofile in self.macrofiles:
-            shutil.copy(macrofile, self.path)
+        fetched, failed = self.download_cache.fetch_all(wanted)
+        self.sources = self.sources + sorted(
+            path for path in fetched.values() if path not in self.sources)
+        self.spectool = bool(unresolved or failed)
+
+    def files(self):
+        """Host paths making up the build context and their names in it."""
+        files = [(self.packed.get(s, s), os.path.basename(s))
+                 for s in self.sources]
+        files += [(m, os.path.basename(m)) for m in self.macrofiles]
 
         if self.spec:
-            shutil.copy(self.spec, self.path)
+            files.append((self.spec, os.path.basename(self.spec)))
 
         if self.srpm:
-            shutil.copy(self.srpm, self.path)
+            files.append((self.srpm, os.path.basename(self.srpm)))
 
-        if self.sources_dir:
-            shutil.copytree(self.sources_dir,
-                            os.path.join(self.path, 'SOURCES'))
+        if self.filtered:
+            files += [(os.path.join(self.sources_dir, f), 'SOURCES/' + f)
+                      for f in self.sources_dir_files()]
+        elif self.sources_dir:
+            files.append((self.sources_dir, 'SOURCES'))
 
-        with open(self.dockerfile, 'w') as f:
-            content = self.template.render(
-                image=self.image,
-                defines=self.defines,
-                sources=[os.path.basename(s) for s in self.sources],
-                sources_dir=self.sources_dir,
-                spec=self.spec and os.path.basename(self.spec),
-                macrofiles=[os.path.basename(s) for s in self.macrofiles],
-                retrieve=self.retrieve,
-                srpm=self.srpm and os.path.basename(self.srpm),
-            )
-            f.write(content)
+        if self.repo:
+            files.append((self.repo, 'REPO'))
+
+        return files
+
+    def sources_dir_files(self):
+        """
+        Files below sources_dir the context takes: those not excluded by its
+        .rpmbuildignore or the ignore patterns, and with referenced_sources
+        only the ones the spec names as Source or Patch.
+        """
+        if self._sources_dir_files is None:
+            names = None
+            if self.referenced_sources and self.spec:
+                names = Spec.from_file(self.spec, self.defines).source_files
+            self._sources_dir_files = select_files(self.sources_dir,
+                                                   self.ignore, names)
+        return self._sources_dir_files
+
+    @property
+    def copies_sources_dir(self):
+        """Whether SOURCES is copied, filtering may leave nothing of it."""
+        return bool(self.sources_dir and
+                    (not self.filtered or self.sources_dir_files()))
+
+    def size(self):
+        """Bytes of the files making up the context."""
+        total = 0
+        for path, name in self.files():
+            if os.path.isdir(path):
+                total += sum(os.path.getsize(os.path.join(root, f))
+                             for root, dirs, files in os.walk(path)
+                             for f in files)
+            elif os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def digest(self, base=None):
+        """
+        Digest of every input of the build: the base image (its digest when
+        known), defines, flags and the contents of all context files.
+        """
+        parts = [base or self.image, str(bool(self.retrieve)),
+                 self.profile.stage] + self.profile.options + self.defines
+        return self._digest(parts + self._file_parts())
+
+    def image_digest(self):
+        """
+        Digest of the rendered Dockerfile and the contents of all context
+        files.  Identical inputs get the same image wherever they are on
+        disk, and changed inputs never reuse a stale one.
+        """
+        return self._digest([self.render()] + self._file_parts())
+
+    def _file_parts(self):
+        parts = []
+        for path, name in self.files():
+            if os.path.isdir(path):
+                parts += [name, directory_digest(path)]
+            else:
+                parts += [name, file_digest(path)]
+        return parts
+
+    def _digest(self, parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode('utf-8') + b'\0')
+        return digest.hexdigest()
+
+    def render(self):
+        return self.template.render(
+            image=self.image,
+            deps_image=self.deps_image,
+            toolchain=self.toolchain,
+            defines=self.defines,
+            options=self.profile.options,
+            stage=self.profile.stage,
+            sources=[os.path.basename(s) for s in self.sources],
+            sources_dir=self.copies_sources_dir,
+            spec=self.spec and os.path.basename(self.spec),
+            macrofiles=[os.path.basename(s) for s in self.macrofiles],
+            retrieve=self.retrieve and self.spectool,
+            srpm=self.srpm and os.path.basename(self.srpm),
+            repo=self.repo,
+            context_image=self.context_image,
+        )
+
+    def archive(self, fileobj, dockerfile=None):
+        """
+        Write the build context as an uncompressed tar stream to fileobj.
+        The Dockerfile is generated in memory, everything else is read from
+        its original location.
+        """
+        dockerfile = (dockerfile or self.render()).encode('utf-8')
+
+        with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+            info = tarfile.TarInfo('Dockerfile')
+            info.size = len(dockerfile)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(dockerfile))
+
+            for path, name in self.files():
+                tar.add(path, arcname=name)
+
+    def chunks(self, size=CHUNK_SIZE, dockerfile=None):
+        """
+        Generate the build context tar stream in fixed size chunks.  The
+        archive is written by a helper thread into a pipe so memory use does
+        not depend on the size of the sources.
+        """
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def write():
+            try:
+                with os.fdopen(write_fd, 'wb') as f:
+                    self.archive(f, dockerfile)
+            except Exception as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+
+        with os.fdopen(read_fd, 'rb') as f:
+            for chunk in iter(lambda: f.read(size), b''):
+                yield chunk
+
+        writer.join()
+        if errors:
+            raise errors[0]
 
     def teardown(self):
-        shutil.rmtree(self.path)
+        if self.path:
+            shutil.rmtree(self.path)
 
 
 class PackagerException(Exception):
@@ -130,15 +447,53 @@ class PackagerException(Exception):
 
 class Packager(object):
 
-    def __init__(self, context, docker_config):
+    def __init__(self, context, docker_config=None, client=None,
+                 yum_cache=None, yum_cache_size=YUM_CACHE_SIZE,
+                 result_cache=None, pool=None, image_usage=None,
+                 registry=None, dev=False, stage='all', resources=None):
+        if stage not in STAGES:
+            raise PackagerException('Unknown stage %s, use one of %s' % (
+                stage, ', '.join(sorted(STAGES))))
+        if dev and not context.spec:
+            raise PackagerException('Development builds need a spec')
+
         self.context = context
-        self.client = docker.Client(**dict(docker_config))
+        self.client = client or docker.Client(**dict(docker_config))
+        self.yum_cache = yum_cache
+        self.yum_cache_size = yum_cache_size
+        # Results of development builds depend on what the tree held.
+        self.result_cache = None if dev else result_cache
+        self.pool = pool
+        self.dev = dev
+        self.stage = stage
+        self.resources = resources
+        self.image_usage = image_usage
+        self.registry = registry
+        self.metrics = context.metrics
+        self.cache_key = None
+        self._image_name = None
+        self.staging = None
 
     def __enter__(self):
-        self.context.setup()
+        self.context.toolchain = self.toolchain_name
+
+        if self.result_cache is not None:
+            self.cache_key = self.context.digest(self.base_digest)
+
+        # Builder pools copy the context straight into their container.
+        if self.pool is not None:
+            self.context.stream = True
+
+        # Nothing to build on a cache hit, skip copying the context.
+        if not self.cached:
+            self.context.setup()
+
         return self
 
     def __exit__(self, type, value, traceback):
+        if self.staging is not None:
+            shutil.rmtree(self.staging, ignore_errors=True)
+            self.staging = None
         self.context.teardown()
 
     def __str__(self):
@@ -146,49 +501,474 @@ class Packager(object):
 
     def export_package(self, output):
         """
-        Finds RPMs build in the container and copies to host output directory.
+        Copies the RPMs built in the container to the host output directory.
+        Bind mounted builds move the RPMs out of their private directory.
         """
+        if self.staging is not None:
+            return self._move_staged(output)
+
         exported = []
+        # The SRPM of a rebuild was copied in, not built.
+        directories = ['RPMS'] if self.context.srpm else ['RPMS', 'SRPMS']
 
-        for diff in self.client.diff(self.container):
-            if diff['Path'].startswith('/rpmbuild'):
-                if diff['Path'].endswith('.rpm'):
-                    directory, name = os.path.split(diff['Path'])
-                    res = self.client.copy(self.container['Id'], diff['Path'])
-                    with open(os.path.join(output, name), 'wb') as f:
-                        f.write(res.read()[512:])
-                        exported.append(f.name)
+        with self.metrics.phase('export'):
+            for directory in directories:
+                archive, stat = self.client.get_archive(
+                    self.container, '/rpmbuild/%s' % directory)
+                exported += [path for path in self._extract(archive, output)
+                             if path.endswith('.rpm')]
 
         return exported
 
+    def _extract(self, archive, output):
+        """
+        Write the regular files of a tar stream to the output directory.
+        Members are copied in fixed size chunks as the stream is read so
+        memory use does not depend on the size of the RPMs.
+        """
+        extracted = []
+
+        with tarfile.open(fileobj=archive, mode='r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = os.path.basename(member.name)
+                with open(os.path.join(output, name), 'wb') as f:
+                    shutil.copyfileobj(tar.extractfile(member), f, CHUNK_SIZE)
+                    extracted.append(f.name)
+                self.metrics.add('export', bytes=member.size)
+
+        return extracted
+
     @property
     def image_name(self):
-        ## slashes are illegal in an image name; interpreted as a registry
-        ## dashes are also illegal
-        return 'rpmbuild_%s' % str(self.context).replace("/", "_")
+        """
+        Context image tagged by the digest of its inputs, named after the
+        spec or SRPM.  Only known once the context is set up.
+        """
+        if self._image_name is None:
+            name = cache_key(os.path.basename(str(self.context))).lower()
+            self._image_name = 'rpmbuild_%s:%s' % (
+                name, self.context.image_digest()[:12])
+        return self._image_name
+
+    @property
+    def remote_name(self):
+        """Repository and tag of the context image in the registry."""
+        return ('%s/%s' % (self.registry, self.image_name)).rsplit(':', 1)
 
     @property
     def image(self):
-        images = self.client.images(name=self.image_name)
+        try:
+            return self.client.inspect_image(self.image_name)
+        except docker.errors.APIError:
+            raise PackagerException('No image %s' % self.image_name)
 
-        if not images:
-            raise PackagerException
+    @property
+    def base_digest(self):
+        try:
+            image = self.client.inspect_image(self.context.image)
+        except docker.errors.APIError:
+            self.client.pull(self.context.image)
+            image = self.client.inspect_image(self.context.image)
 
-        return images[0]
+        return image['Id'].split(':')[-1]
+
+    @property
+    def toolchain_name(self):
+        """
+        Toolchain image shared by every build on the same base image.  The
+        tag follows the base image digest so it is rebuilt when the base
+        image changes.
+        """
+        return 'rpmbuild_base:%s' % self.base_digest[:12]
+
+    @property
+    def cached(self):
+        return (self.cache_key is not None and
+                self.cache_key in self.result_cache)
+
+    def _touch(self, *tags):
+        """Record the images a build used, for the image garbage collector."""
+        if self.image_usage is not None:
+            self.image_usage.touch(*tags)
+
+    def _image_exists(self, name):
+        repository = name.split(':')[0]
+        for image in self.client.images(name=repository):
+            if name in (image.get('RepoTags') or []):
+                return True
+        return False
+
+    def _pull_image(self):
+        """
+        Pull the context image from the registry when another host built
+        it already, tagging it under the local name.
+        """
+        if not self.registry:
+            return False
+
+        repository, tag = self.remote_name
+        try:
+            self.client.pull(repository, tag=tag)
+            return self.client.tag('%s:%s' % (repository, tag),
+                                   *self.image_name.split(':'))
+        except docker.errors.APIError:
+            return False
+
+    def _push_image(self):
+        repository, tag = self.remote_name
+        self.client.tag(self.image_name, repository, tag=tag)
+        return self.client.push(repository, tag=tag, stream=True)
+
+    def _build_stage(self, tag, dockerfile):
+        if self.yum_cache is None:
+            return self.client.build(fileobj=dockerfile, tag=tag, stream=True)
+        return self._commit_stage(tag, dockerfile)
+
+    def _commit_stage(self, tag, dockerfile):
+        """
+        docker build cannot mount volumes, so with a yum cache a stage is
+        built by running its RUN lines in a container with the cache bind
+        mounted and committing the result.  The committed image keeps the
+        command of its base image and gets no volume for the cache.  Output
+        is yielded in the same format as the docker build stream.
+        """
+        lines = dockerfile.getvalue().decode('UTF-8').split('\n')
+        base = [l.strip()[5:] for l in lines if l.strip().startswith('FROM ')][0]
+        commands = [l.strip()[4:] for l in lines if l.strip().startswith('RUN ')]
+        script = YUM_CACHE_SCRIPT % ' && '.join(commands)
+
+        cache = os.path.join(self.yum_cache, cache_key(self.context.image))
+        binds = {}
+        for manager in PACKAGE_CACHES:
+            path = os.path.join(cache, manager)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Another stage may have created it in the meantime.
+                    if not os.path.isdir(path):
+                        raise
+            binds[path] = {'bind': '/var/cache/%s' % manager, 'ro': False}
+
+        # Stages share the cache, only eviction needs it to themselves.
+        with lock(cache, shared=True):
+            # Binds in the host config mount the cache without declaring a
+            # volume, which the commit would carry into the image.
+            container = self.client.create_container(
+                base, command=['/bin/sh', '-c', script],
+                host_config=self.client.create_host_config(binds=binds))
+            self.client.start(container)
+
+            for line in self.client.logs(container, stream=True):
+                yield json.dumps(
+                    {'stream': line.decode('UTF-8')}).encode('UTF-8')
+
+            try:
+                if self._wait(container) != 0:
+                    raise PackagerException('Building %s failed' % tag)
+                config = self.client.inspect_image(base).get('Config') or {}
+                repository, _, name = tag.partition(':')
+                self.client.commit(container, repository=repository, tag=name,
+                                   conf={'Cmd': config.get('Cmd')})
+            finally:
+                self.client.remove_container(container)
+
+        with lock(cache):
+            evict(cache, self.yum_cache_size, suffix='.rpm')
+
+    def build_toolchain(self):
+        toolchain = self.context.toolchain
+        if toolchain and not self._image_exists(toolchain):
+            with self.metrics.phase('toolchain'):
+                for line in self._build_stage(
+                        toolchain, self.context.toolchain_dockerfile()):
+                    yield line
+
+    def build_deps(self):
+        deps_image = self.context.deps_image
+        if deps_image and not self._image_exists(deps_image):
+            with self.metrics.phase('deps'):
+                for line in self._build_stage(
+                        deps_image, self.context.deps_dockerfile()):
+                    yield line
 
     def build_image(self):
-        return self.client.build(
-            self.context.path,
-            tag=self.image_name,
-            stream=True
-        )
+        """
+        Build the toolchain and dependency stages when they are not cached
+        yet, then the context image on top of them.  Nothing is built when
+        an image of identical inputs exists locally or in the registry, new
+        images are pushed to the registry.  Yields the raw docker build
+        stream.
+        """
+        deps_image = self.context.deps_image
+
+        if self._image_exists(self.image_name) or self._pull_image():
+            self._touch(self.context.toolchain, deps_image, self.image_name)
+            yield json.dumps({'stream': 'Using image %s\n' % self.image_name}
+                             ).encode('UTF-8')
+            return
+
+        for line in self.build_toolchain():
+            yield line
+
+        for line in self.build_deps():
+            yield line
+
+        if self.context.context_image:
+            build = self.client.build(
+                fileobj=io.BytesIO(self.context.render().encode('utf-8')),
+                tag=self.image_name,
+                stream=True)
+        elif self.context.path is None:
+            build = self.client.build(
+                fileobj=self.metrics.count('upload', self.context.chunks()),
+                custom_context=True,
+                tag=self.image_name,
+                stream=True)
+        else:
+            build = self.client.build(
+                self.context.path,
+                tag=self.image_name,
+                stream=True)
+
+        # Streamed uploads overlap with the build, keep them apart.
+        start = time.time()
+        uploaded = self.metrics.seconds('upload')
+        for line in build:
+            yield line
+        self.metrics.add('builddep', time.time() - start -
+                         (self.metrics.seconds('upload') - uploaded))
+
+        if self.registry and self._image_exists(self.image_name):
+            for line in self._push_image():
+                yield line
+
+        self._touch(self.context.toolchain, deps_image, self.image_name,
+                    self.context.context_image)
+
+    def upload_context(self, log=print):
+        """
+        Upload the context once as a data only image that matrix builds on
+        several base images copy from.  Returns the tag of that image.
+        """
+        tag = 'rpmbuild_context:%s' % self.context.digest()[:12]
+
+        if not self._image_exists(tag):
+            self._log_build(self.client.build(
+                fileobj=self.metrics.count('upload', self.context.chunks(
+                    dockerfile=self.context._context_dockerfile())),
+                custom_context=True,
+                tag=tag,
+                stream=True), log)
+
+        self._touch(tag)
+        return tag
+
+    def _wait(self, container):
+        """Exit status of a container, whatever the docker-py version."""
+        status = self.client.wait(container)
+        if isinstance(status, dict):
+            status = status.get('StatusCode')
+        return status
+
+    def _log_build(self, stream, log):
+        """Log a docker build or push stream, raising on its errors."""
+        for line in stream:
+            parsed = json.loads(line.decode('UTF-8'))
+            if 'error' in parsed:
+                raise PackagerException(parsed['error'])
+            if 'stream' not in parsed:
+                log(parsed)
+            else:
+                log(parsed['stream'].strip())
+
+    def run(self, output, log=print, bind_output=False):
+        """
+        Build the image, run rpmbuild and export the results, passing every
+        line of output to log.  Returns the exported paths.  Identical
+        builds found in the result cache are returned without building.
+        """
+        if self.cached:
+            log('Using cached build %s' % self.cache_key)
+            with self.metrics.phase('cache'):
+                return self.result_cache.get(self.cache_key, output)
+
+        if self.pool is not None:
+            self._log_build(self.build_toolchain(), log)
+            self._log_build(self.build_deps(), log)
+            self._touch(self.context.toolchain, self.context.deps_image)
+            exported = self.pool.run(self, output, log, bind_output)
+        else:
+            self._log_build(self.build_image(), log)
+
+            container = None
+            try:
+                with self.metrics.phase('rpmbuild'):
+                    if bind_output:
+                        container, logs = self.build_package(output)
+                    else:
+                        container, logs = self.build_package()
+
+                    for line in logs:
+                        log(line.decode('UTF-8').strip())
+
+                    status = self._wait(container)
+
+                if status != 0:
+                    raise PackagerException(
+                        'rpmbuild failed with status %s' % status)
+
+                exported = self.export_package(output)
+            finally:
+                if container is not None:
+                    self.remove_container(container, log)
+
+        if self.cache_key is not None and exported:
+            self.result_cache.put(self.cache_key, exported, output)
+
+        return exported
+
+    def remove_container(self, container, log=print):
+        """Remove a finished build container and its anonymous volumes."""
+        try:
+            self.client.remove_container(container, v=True)
+        except docker.errors.APIError as e:
+            log('Could not remove container %s: %s' % (container['Id'], e))
+
+    def output_binds(self, output, top='/rpmbuild'):
+        """
+        Host directories bind mounted over the result directories of the
+        rpmbuild topdir.  They live in a private directory below output, so
+        builds sharing an output never see each other's RPMs, and are moved
+        into output by export_package.  SRPMS is left alone for rebuilds
+        since the SRPM being rebuilt lives there.
+        """
+        output = os.path.abspath(output)
+        if not os.path.isdir(output):
+            try:
+                os.makedirs(output)
+            except OSError:
+                # Another build may have created it in the meantime.
+                if not os.path.isdir(output):
+                    raise
+        self.staging = tempfile.mkdtemp(prefix='.rpmbuild-', dir=output)
+
+        binds = {}
+        directories = ['RPMS'] if self.context.srpm else ['RPMS', 'SRPMS']
+
+        for directory in directories:
+            path = os.path.join(self.staging, directory)
+            os.mkdir(path)
+            binds[path] = {'bind': '%s/%s' % (top, directory), 'ro': False}
+
+        return binds
 
-    def build_package(self):
+    @property
+    def tree_volume(self):
+        """
+        Prefix of the named volumes keeping BUILD and BUILDROOT of a
+        development build, one set per spec file and base image.
+        """
+        spec = os.path.abspath(self.context.spec)
+        digest = hashlib.sha1(
+            (spec + '\0' + self.context.image).encode('utf-8')).hexdigest()
+        return 'rpmbuild_tree_%s_%s' % (
+            cache_key(os.path.basename(spec)).lower(), digest[:12])
+
+    def tree_binds(self):
+        return dict(('%s_%s' % (self.tree_volume, directory.lower()),
+                     {'bind': '/rpmbuild/%s' % directory, 'ro': False})
+                    for directory in ('BUILD', 'BUILDROOT'))
+
+    @property
+    def build_cpus(self):
+        """
+        Parallel jobs rpmbuild runs, from the CPU share of the build.  rpm
+        derives %_smp_mflags from $RPM_BUILD_NCPUS when it is set.
+        """
+        if self.resources is None or not self.resources.cpus:
+            return None
+        return max(int(math.ceil(self.resources.cpus)), 1)
+
+    def _host_config(self, binds):
+        """Binds and CPU and memory limits of the build container."""
+        limits = {}
+        resources = self.resources
+        if resources is not None and resources.cpus:
+            limits['cpu_period'] = CPU_PERIOD
+            limits['cpu_quota'] = int(resources.cpus * CPU_PERIOD)
+        if resources is not None and resources.memory:
+            limits['mem_limit'] = resources.memory
+        return self.client.create_host_config(binds=binds or None, **limits)
+
+    def _move_staged(self, output):
+        """
+        Move the RPMs of the private bind mounted directory to the same
+        place below output.  Directories the container created are owned
+        by its user, RPMs that cannot be moved out of them are copied.
         """
-        Build the RPM package on top of the provided image.
+        moved = []
+
+        for root, dirs, files in os.walk(self.staging):
+            target = os.path.join(output, os.path.relpath(root, self.staging))
+            for name in sorted(files):
+                if not name.endswith('.rpm'):
+                    continue
+                if not os.path.isdir(target):
+                    try:
+                        os.makedirs(target)
+                    except OSError:
+                        if not os.path.isdir(target):
+                            raise
+                path = os.path.join(target, name)
+                try:
+                    os.rename(os.path.join(root, name), path)
+                except OSError:
+                    shutil.copyfile(os.path.join(root, name), path)
+                moved.append(path)
+
+        shutil.rmtree(self.staging, ignore_errors=True)
+        self.staging = None
+        return sorted(moved)
+
+    def build_package(self, output=None):
         """
-        self.container = self.client.create_container(self.image['Id'])
+        Build the RPM package on top of the provided image.  With an output
+        directory the results are bind mounted to the host as they are
+        written, and export_package has nothing left to copy.  Development
+        builds keep their build tree in named volumes and may start from a
+        later stage on the tree of the previous run.  With resources the
+        container is limited to its share of the host.
+        """
+        binds = {}
+        options = {}
+
+        if output is not None:
+            binds.update(self.output_binds(output))
+
+        if self.dev:
+            binds.update(self.tree_binds())
+            stage = (STAGES[self.stage] if self.stage != 'all'
+                     else self.context.profile.stage)
+            options['environment'] = {'RPMBUILD_STAGE': stage}
+
+        if binds:
+            options['volumes'] = [b['bind'] for b in binds.values()]
+
+        if self.build_cpus:
+            options['environment'] = dict(options.get('environment', {}),
+                                          RPM_BUILD_NCPUS=self.build_cpus)
+
+        # Daemons refuse start requests with a body from API 1.24 on, binds
+        # and limits go in the host config.
+        options['host_config'] = self._host_config(binds)
+
+        self.container = self.client.create_container(self.image['Id'],
+                                                      **options)
         self.client.start(self.container)
+
         return self.container, self.client.logs(self.container, stream=True)
 
 
@@ -0,0 +1,444 @@
+"""
+asyncio counterpart of Packager.
+
+AsyncPackager talks to the docker remote API itself over asyncio streams,
+so build output and container logs of many builds are read by a single
+event loop instead of a thread per stream::
+
+    async def build(context, output):
+        async with AsyncPackager(context, api=api) as p:
+            return await p.run(output)
+
+    loop.run_until_complete(asyncio.gather(
+        build(PackagerContext('centos:6', spec='foo.spec'), 'out/el6'),
+        build(PackagerContext('centos:7', spec='foo.spec'), 'out/el7')))
+
+Only reading and packing local files (the build context, the result cache
+and exported archives) is handed to the default executor.  Builder pools
+and the yum cache are left to the threaded Packager.  Needs Python 3.6.
+"""
+
+import asyncio
+import io
+import json
+import struct
+import tarfile
+import tempfile
+import time
+from urllib.parse import quote, urlencode, urlsplit
+
+from rpmbuild import CHUNK_SIZE, Packager, PackagerException
+
+DEFAULT_BASE_URL = 'unix://var/run/docker.sock'
+
+
+class APIError(PackagerException):
+
+    def __init__(self, status, message):
+        super(APIError, self).__init__('%s: %s' % (status, message))
+        self.status = status
+
+
+class Response(object):
+    """Status, headers and the (possibly chunked) body of an API call."""
+
+    def __init__(self, reader, writer, status, headers):
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.headers = headers
+
+    async def chunks(self):
+        """Yield the body as it arrives."""
+        try:
+            if self.headers.get('transfer-encoding') == 'chunked':
+                while True:
+                    size = int((await self.reader.readline()).split(b';')[0], 16)
+                    if size == 0:
+                        await self.reader.readline()
+                        break
+                    data = await self.reader.readexactly(size)
+                    await self.reader.readexactly(2)
+                    yield data
+            elif 'content-length' in self.headers:
+                remaining = int(self.headers['content-length'])
+                while remaining:
+                    data = await self.reader.read(min(remaining, CHUNK_SIZE))
+                    if not data:
+                        raise APIError(self.status, 'Truncated response')
+                    remaining -= len(data)
+                    yield data
+            else:
+                while True:
+                    data = await self.reader.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    yield data
+        finally:
+            self.close()
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.chunks()])
+
+    async def lines(self):
+        """Yield the body line by line, as the build stream is sent."""
+        partial = b''
+        async for chunk in self.chunks():
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line
+        if partial.strip():
+            yield partial
+
+    def close(self):
+        self.writer.close()
+
+
+class DockerAPI(object):
+    """
+    Minimal docker remote API client on asyncio streams.  Every request
+    uses its own connection, so any number of them can be in flight.
+    """
+
+    def __init__(self, base_url=None, version=None, timeout=None):
+        url = urlsplit(base_url or DEFAULT_BASE_URL)
+        if url.scheme in ('unix', 'http+unix'):
+            # unix://var/run/docker.sock has the first path element as host.
+            self.socket = '/' + (url.netloc + url.path).lstrip('/')
+            self.host = None
+        else:
+            self.socket = None
+            self.host = url.hostname
+            self.port = url.port or 2375
+        self.version = version
+        self.timeout = timeout
+
+    def _url(self, path, params=None):
+        if self.version:
+            path = '/v%s%s' % (self.version, path)
+        if params:
+            path += '?' + urlencode(sorted(
+                (k, v) for k, v in params.items() if v is not None))
+        return path
+
+    async def _connect(self):
+        if self.socket:
+            return await asyncio.open_unix_connection(self.socket)
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, path, params=None, body=None,
+                      headers=None):
+        """
+        Send a request and return the Response once its headers arrived.
+        A body may be bytes, a JSON serializable dict or an iterator of
+        chunks; iterators are sent with chunked encoding and advanced in
+        the executor since they usually read files.
+        """
+        reader, writer = await asyncio.wait_for(self._connect(), self.timeout)
+        headers = dict(headers or {})
+        headers['Host'] = 'docker'
+        headers['Connection'] = 'close'
+
+        if isinstance(body, dict):
+            body = json.dumps(body).encode('UTF-8')
+            headers['Content-Type'] = 'application/json'
+
+        if body is None or isinstance(body, bytes):
+            headers['Content-Length'] = str(len(body or b''))
+        else:
+            headers['Transfer-Encoding'] = 'chunked'
+
+        head = ['%s %s HTTP/1.1' % (method, self._url(path, params))]
+        head += ['%s: %s' % item for item in sorted(headers.items())]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+        try:
+            if isinstance(body, bytes):
+                writer.write(body)
+            elif body is not None:
+                await self._send_chunks(writer, body)
+            await writer.drain()
+
+            status, headers = await asyncio.wait_for(
+                self._read_head(reader), self.timeout)
+        except:
+            writer.close()
+            raise
+
+        response = Response(reader, writer, status, headers)
+        if status >= 400:
+            message = (await response.read()).decode('UTF-8', 'replace')
+            raise APIError(status, message.strip())
+
+        return response
+
+    async def _send_chunks(self, writer, body):
+        loop = asyncio.get_event_loop()
+        chunks = iter(body)
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                await writer.drain()
+        writer.write(b'0\r\n\r\n')
+
+    async def _read_head(self, reader):
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    async def call(self, method, path, params=None, body=None):
+        """Request returning the decoded JSON body, if any."""
+        data = await (await self.request(method, path, params, body)).read()
+        return json.loads(data.decode('UTF-8')) if data.strip() else None
+
+
+class AsyncPackager(object):
+    """
+    Build a PackagerContext from an event loop.  Used as an async context
+    manager, like Packager is used as a context manager.
+    """
+
+    # Names and archive handling are shared with the threaded packager.
+    image_name = Packager.image_name
+    _extract = Packager._extract
+
+    def __init__(self, context, docker_config=None, api=None,
+                 result_cache=None, image_usage=None):
+        self.context = context
+        self.api = api or DockerAPI(**dict(docker_config or {}))
+        self.result_cache = result_cache
+        self.image_usage = image_usage
+        self.metrics = context.metrics
+        self.cache_key = None
+        self.container = None
+        self._image_name = None
+
+    async def __aenter__(self):
+        self.context.toolchain = 'rpmbuild_base:%s' % (
+            await self.base_digest())[:12]
+
+        # The context is always streamed, there is no directory to build.
+        self.context.stream = True
+
+        if self.result_cache is not None:
+            self.cache_key = await self._executor(
+                self.context.digest, await self.base_digest())
+
+        if not self.cached:
+            await self._executor(self.context.setup)
+
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        self.context.teardown()
+
+    def __str__(self):
+        return self.context.image
+
+    def _executor(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    @property
+    def cached(self):
+        return (self.cache_key is not None and
+                self.cache_key in self.result_cache)
+
+    async def base_digest(self):
+        image = self.context.image
+        try:
+            info = await self.api.call('GET', _image_path(image))
+        except APIError:
+            repository, _, tag = image.partition(':')
+            response = await self.api.request('POST', '/images/create', {
+                'fromImage': repository, 'tag': tag or 'latest'})
+            async for line in response.lines():
+                pass
+            info = await self.api.call('GET', _image_path(image))
+        return info['Id'].split(':')[-1]
+
+    async def image_exists(self, name):
+        repository = name.split(':')[0]
+        images = await self.api.call('GET', '/images/json',
+                                     {'filter': repository})
+        return any(name in (image.get('RepoTags') or []) for image in images)
+
+    async def _build(self, tag, fileobj):
+        response = await self.api.request(
+            'POST', '/build', {'t': tag}, body=fileobj,
+            headers={'Content-Type': 'application/tar'})
+        return response.lines()
+
+    async def build_image(self):
+        """
+        Build the toolchain and dependency stages when they are not cached
+        yet, then the context image on top of them unless an image of
+        identical inputs exists.  Yields the raw docker build stream, like
+        Packager.build_image.
+        """
+        image_name = await self._executor(lambda: self.image_name)
+        if await self.image_exists(image_name):
+            yield json.dumps({'stream': 'Using image %s\n' % image_name}
+                             ).encode('UTF-8')
+            return
+
+        stages = [('toolchain', self.context.toolchain,
+                   self.context.toolchain_dockerfile),
+                  ('deps', self.context.deps_image,
+                   self.context.deps_dockerfile)]
+
+        for phase, tag, dockerfile in stages:
+            if tag and not await self.image_exists(tag):
+                with self.metrics.phase(phase):
+                    async for line in await self._build(
+                            tag, _dockerfile_context(dockerfile())):
+                        yield line
+
+        start = time.time()
+        async for line in await self._build(
+                self.image_name,
+                self.metrics.count('upload', self.context.chunks())):
+            yield line
+        self.metrics.add('builddep', time.time() - start -
+                         self.metrics.seconds('upload'))
+
+        if self.image_usage is not None:
+            await self._executor(
+                self.image_usage.touch, self.context.toolchain,
+                self.context.deps_image, self.image_name)
+
+    async def build_package(self):
+        """Create and start the container running rpmbuild."""
+        image = await self.api.call('GET', _image_path(self.image_name))
+        self.container = await self.api.call(
+            'POST', '/containers/create', body={'Image': image['Id']})
+        await self.api.call(
+            'POST', '/containers/%s/start' % self.container['Id'])
+        return self.container
+
+    async def logs(self):
+        """
+        Yield the output lines of the running container until it exits.
+        The stream is demultiplexed from docker's 8 byte frame headers.
+        """
+        response = await self.api.request(
+            'GET', '/containers/%s/logs' % self.container['Id'],
+            {'follow': 1, 'stdout': 1, 'stderr': 1})
+
+        buffered = b''
+        partial = b''
+        async for chunk in response.chunks():
+            buffered += chunk
+            while len(buffered) >= 8:
+                size = struct.unpack('>I', buffered[4:8])[0]
+                if len(buffered) < 8 + size:
+                    break
+                lines = (partial + buffered[8:8 + size]).split(b'\n')
+                buffered = buffered[8 + size:]
+                partial = lines.pop()
+                for line in lines:
+                    yield line
+        if partial:
+            yield partial
+
+    async def remove_container(self):
+        """Remove the finished container and its anonymous volumes."""
+        await self.api.call('DELETE', '/containers/%s' % self.container['Id'],
+                            {'v': 1})
+        self.container = None
+
+    async def wait(self):
+        result = await self.api.call(
+            'POST', '/containers/%s/wait' % self.container['Id'])
+        return result.get('StatusCode')
+
+    async def export_package(self, output):
+        """
+        Copy the RPMs and SRPMs of the finished container to output.  The
+        archives are spooled to disk and unpacked in the executor.
+        """
+        exported = []
+
+        with self.metrics.phase('export'):
+            for directory in ('RPMS', 'SRPMS'):
+                response = await self.api.request(
+                    'GET', '/containers/%s/archive' % self.container['Id'],
+                    {'path': '/rpmbuild/%s' % directory})
+
+                with tempfile.TemporaryFile() as spool:
+                    async for chunk in response.chunks():
+                        spool.write(chunk)
+                    spool.seek(0)
+                    exported += [path for path in await self._executor(
+                        self._extract, spool, output)
+                                 if path.endswith('.rpm')]
+
+        return exported
+
+    async def run(self, output, log=print):
+        """
+        Build the image, run rpmbuild and export the results, passing every
+        line of output to log.  Returns the exported paths.
+        """
+        if self.cached:
+            log('Using cached build %s' % self.cache_key)
+            with self.metrics.phase('cache'):
+                return await self._executor(
+                    self.result_cache.get, self.cache_key, output)
+
+        async for line in self.build_image():
+            parsed = json.loads(line.decode('UTF-8'))
+            if 'error' in parsed:
+                raise PackagerException(parsed['error'])
+            log(parsed['stream'].strip() if 'stream' in parsed else parsed)
+
+        try:
+            with self.metrics.phase('rpmbuild'):
+                await self.build_package()
+                async for line in self.logs():
+                    log(line.decode('UTF-8').strip())
+
+                status = await self.wait()
+
+            if status != 0:
+                raise PackagerException(
+                    'rpmbuild failed with status %s' % status)
+
+            exported = await self.export_package(output)
+        finally:
+            if self.container is not None:
+                await self.remove_container()
+
+        if self.cache_key is not None and exported:
+            await self._executor(self.result_cache.put, self.cache_key,
+                                 exported, output)
+
+        return exported
+
+
+def _image_path(name):
+    return '/images/%s/json' % quote(name, safe='/:')
+
+
+def _dockerfile_context(dockerfile):
+    """Tar stream holding only a Dockerfile, for the cached stages."""
+    data = dockerfile.getvalue()
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        info = tarfile.TarInfo('Dockerfile')
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return [archive.getvalue()]
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
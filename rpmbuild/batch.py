@@ -0,0 +1,273 @@
+"""
+Build many specs and SRPMs concurrently from a manifest.  Jobs are ordered
+by the packages they build for each other.
+
+A manifest is a JSON list of jobs.  Every job takes the same settings as
+the command line, relative paths are resolved against the manifest:
+
+    [
+        {"image": "centos:7", "spec": "foo/foo.spec",
+         "sources": ["foo/foo-1.0.tar.gz"], "output": "out"},
+        {"image": "centos:7", "srpm": "bar-1.0-1.src.rpm"}
+    ]
+"""
+
+from __future__ import print_function
+
+# Python 2/3 Compatibility
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from rpmbuild import Packager, PackagerContext, PackagerException
+from rpmbuild.dispatch import dispatcher
+from rpmbuild.logs import BuildLog, log_path
+from rpmbuild.scheduler import (DEFAULT_JOB_RESOURCES, dependencies,
+                                job_resources, providers, waves)
+
+PATH_KEYS = ('spec', 'srpm', 'sources_dir', 'output')
+PATH_LIST_KEYS = ('sources', 'macrofiles')
+
+Result = namedtuple('Result', ['name', 'exported', 'error'])
+
+
+def load_manifest(path):
+    with open(path) as f:
+        jobs = json.load(f)
+
+    if not isinstance(jobs, list):
+        raise PackagerException('Manifest must contain a list of jobs')
+
+    base = os.path.dirname(os.path.abspath(path))
+
+    for job in jobs:
+        check_job(job)
+
+        for key in PATH_KEYS:
+            if job.get(key):
+                job[key] = os.path.join(base, job[key])
+
+        for key in PATH_LIST_KEYS:
+            job[key] = [os.path.join(base, p) for p in job.get(key, [])]
+
+    return jobs
+
+
+def check_job(job):
+    if not isinstance(job, dict) or 'image' not in job or not (
+            'spec' in job or 'srpm' in job):
+        raise PackagerException(
+            'Every job needs an image and a spec or srpm: %r' % (job,))
+    if not isinstance(job.get('profile') or '', string_types):
+        raise PackagerException('profile must be the name of a profile: %r'
+                                % (job['profile'],))
+
+
+def apply_profile(job, profiles, default):
+    """Job with its profile name, or the default one, resolved."""
+    name = job.get('profile') or default
+    if name not in profiles:
+        raise PackagerException('Unknown profile %s, use one of %s' % (
+            name, ', '.join(sorted(profiles))))
+    return dict(job, profile=profiles[name])
+
+
+def job_context(job):
+    return PackagerContext(
+        job['image'],
+        defines=job.get('defines'),
+        sources=job.get('sources'),
+        sources_dir=job.get('sources_dir'),
+        ignore=job.get('sources_ignore'),
+        referenced_sources=job.get('referenced_sources', False),
+        profile=job.get('profile'),
+        spec=job.get('spec'),
+        macrofiles=job.get('macrofiles'),
+        retrieve=job.get('retrieve'),
+        srpm=job.get('srpm'),
+        stream=job.get('stream_context', False),
+        source_format=job.get('source_format', 'gz'),
+        repo=job.get('repo'),
+        context_image=job.get('context_image'),
+    )
+
+
+def job_name(job):
+    return job.get('name') or os.path.basename(job.get('spec') or job['srpm'])
+
+
+class Batch(object):
+    """
+    Runs jobs on worker threads sharing one docker client per docker host,
+    docker_config may be a list of hosts to spread the jobs over.  Every job
+    reserves its share of its host's CPUs and memory while it runs, so as
+    many jobs run at once as fit; concurrency optionally caps that.  Log
+    lines of every job are prefixed with the job name.
+    """
+
+    def __init__(self, jobs, docker_config, concurrency=None, log=print,
+                 packager_options=None, pool=False, log_dir=None,
+                 log_compress=False, resources=DEFAULT_JOB_RESOURCES):
+        self.jobs = jobs
+        self.concurrency = concurrency
+        self.resources = resources
+        self.log_dir = log_dir
+        self.log_compress = log_compress
+        self.packager_options = dict(packager_options or {})
+        self.lock = threading.Lock()
+        self.log = log
+        self.metrics = []
+        self.dispatcher = dispatcher(docker_config, pool=pool, log=log)
+
+    def _logger(self, name):
+        def log(line):
+            with self.lock:
+                self.log('[%s] %s' % (name, line))
+        return log
+
+    def run_job(self, job, log_name=None):
+        name = job_name(job)
+        log = self._logger(name)
+        output = job.get('output') or '.'
+
+        if self.log_dir:
+            log = BuildLog(log_path(self.log_dir, log_name or name,
+                                    self.log_compress),
+                           console=log, compress=self.log_compress)
+
+        contexts = []
+
+        def build(host, share):
+            # Every attempt starts from a fresh context on its host.
+            context = job_context(job)
+            context.metrics.name = name
+            contexts.append(context)
+            if len(self.dispatcher.hosts) > 1:
+                log('Building on %s' % host)
+            with Packager(context, client=host.client, resources=share,
+                          **dict(self.packager_options, **host.options)) as p:
+                return p.run(output, log=log,
+                             bind_output=job.get('bind_output', False))
+
+        try:
+            if not os.path.isdir(output):
+                try:
+                    os.makedirs(output)
+                except OSError:
+                    # Another job may have created it in the meantime.
+                    if not os.path.isdir(output):
+                        raise
+            exported = self.dispatcher.run(job_resources(job, self.resources),
+                                           build)
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            log('Container build failed! %s' % error)
+            self._record(contexts)
+            if self.log_dir:
+                log.close(failed=True)
+            return Result(name, [], error)
+
+        if self.log_dir:
+            log.close()
+        self._record(contexts)
+
+        return Result(name, exported, None)
+
+    def _record(self, contexts):
+        """Keep the metrics of a job's last attempt."""
+        if contexts:
+            with self.lock:
+                self.metrics.append(contexts[-1].metrics)
+
+    def run(self):
+        """
+        Build the jobs wave by wave in BuildRequires order.  Every job with
+        dependencies installs from a local repository of its own, holding
+        the RPMs of the jobs it depends on directly or indirectly and no
+        others.  Jobs whose dependencies failed are not built at all.
+        """
+        graph = dependencies(self.jobs)
+        jobs = [dict(job) for job in self.jobs]
+        names = log_names(jobs)
+        results = [None] * len(jobs)
+        repos = []
+        pool = ThreadPool(self.concurrency or max(len(jobs), 1))
+
+        try:
+            for wave in waves(graph):
+                runnable = []
+                for index in wave:
+                    failed = sorted(results[dep].name for dep in graph[index]
+                                    if results[dep].error is not None)
+                    if failed:
+                        results[index] = Result(
+                            job_name(jobs[index]), [],
+                            'Dependency failed: %s' % ', '.join(failed))
+                        continue
+                    if graph[index]:
+                        repo = tempfile.mkdtemp(prefix='rpmbuild-repo-')
+                        repos.append(repo)
+                        for dep in providers(graph, index):
+                            publish(results[dep].exported, repo)
+                        jobs[index]['repo'] = repo
+                    runnable.append(index)
+
+                # Largest shares first, smaller jobs fill the gaps they leave.
+                runnable.sort(key=lambda i: job_resources(
+                    jobs[i], self.resources), reverse=True)
+                wave_results = pool.map(
+                    lambda i: self.run_job(jobs[i], names[i]), runnable)
+                for index, result in zip(runnable, wave_results):
+                    results[index] = result
+        finally:
+            pool.close()
+            pool.join()
+            for repo in repos:
+                shutil.rmtree(repo)
+
+        return results
+
+
+def log_names(jobs):
+    """
+    Log file names of the jobs, job names shared by several jobs are told
+    apart by the job's position in the manifest.
+    """
+    names = [job_name(job) for job in jobs]
+    return ['%s-%d' % (name, index + 1) if names.count(name) > 1 else name
+            for index, name in enumerate(names)]
+
+
+def publish(rpms, repo):
+    """Add binary RPMs to the local repository, hard linking when possible."""
+    for rpm in rpms:
+        if rpm.endswith('.src.rpm'):
+            continue
+        target = os.path.join(repo, os.path.basename(rpm))
+        try:
+            os.link(rpm, target)
+        except OSError:
+            shutil.copy(rpm, target)
+
+
+def summary(results):
+    lines = ['Summary:']
+    for result in results:
+        if result.error is None:
+            lines.append('  OK      %s (%d RPMs)' % (result.name,
+                                                   len(result.exported)))
+        else:
+            lines.append('  FAILED  %s: %s' % (result.name, result.error))
+    return lines
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -7,28 +7,156 @@ Usage:
                           [--docker-base_url=<url>]
                           [--docker-timeout=<seconds>]
                           [--docker-version=<version>]
+                          [--docker-host=<url>...]
                           [--define=<option>...]
-                          (--source=<tarball>...|--sources-dir=<dir>)
-                          (--spec=<file> [--macrofile=<file>...] [--retrieve] [--output=<path>])
-                          <image>
+                          [--stream-context]
+                          [--yum-cache [--yum-cache-size=<MiB>]]
+                          [--no-cache | --result-cache-size=<MiB>]
+                          [--pool | --dev [--stage=<stage>]]
+                          [--cpus=<n>] [--memory=<MiB>]
+                          [--log-dir=<dir> [--log-compress]]
+                          [--metrics=<file>] [--metrics-textfile=<file>]
+                          [--gc [--image-cache-size=<MiB>]]
+                          [--registry=<host>]
+                          [--profile=<name>]
+                          [--source-format=<format>]
+                          (--source=<tarball>...|--sources-dir=<dir> [--sources-ignore=<pattern>...] [--referenced-sources])
+                          (--spec=<file> [--macrofile=<file>...] [--retrieve] [--output=<path>] [--bind-output])
+                          <image>...
     docker-rpmbuild rebuild [--config=<file>]
                             [--docker-base_url=<url>]
                             [--docker-timeout=<seconds>]
                             [--docker-version=<version>]
-                            (--srpm=<file> [--output=<path>])
-                            <image>
+                            [--docker-host=<url>...]
+                            [--stream-context]
+                            [--yum-cache [--yum-cache-size=<MiB>]]
+                            [--no-cache | --result-cache-size=<MiB>]
+                            [--pool]
+                            [--cpus=<n>] [--memory=<MiB>]
+                            [--log-dir=<dir> [--log-compress]]
+                            [--metrics=<file>] [--metrics-textfile=<file>]
+                            [--gc [--image-cache-size=<MiB>]]
+                            [--registry=<host>]
+                            [--profile=<name>]
+                            (--srpm=<file> [--output=<path>] [--bind-output])
+                            <image>...
+    docker-rpmbuild batch [--config=<file>]
+                          [--docker-base_url=<url>]
+                          [--docker-timeout=<seconds>]
+                          [--docker-version=<version>]
+                          [--docker-host=<url>...]
+                          [--concurrency=<n>]
+                          [--cpus=<n>] [--memory=<MiB>]
+                          [--yum-cache [--yum-cache-size=<MiB>]]
+                          [--no-cache | --result-cache-size=<MiB>]
+                          [--pool]
+                          [--log-dir=<dir> [--log-compress]]
+                          [--metrics=<file>] [--metrics-textfile=<file>]
+                          [--gc [--image-cache-size=<MiB>]]
+                          [--registry=<host>]
+                          [--profile=<name>]
+                          <manifest>
+    docker-rpmbuild serve [--config=<file>]
+                          [--docker-base_url=<url>]
+                          [--docker-timeout=<seconds>]
+                          [--docker-version=<version>]
+                          [--docker-host=<url>...]
+                          [--listen=<address>]
+                          [--concurrency=<n>]
+                          [--cpus=<n>] [--memory=<MiB>]
+                          [--yum-cache [--yum-cache-size=<MiB>]]
+                          [--no-cache | --result-cache-size=<MiB>]
+                          [--pool]
+                          [--registry=<host>]
+                          [--profile=<name>]
+    docker-rpmbuild gc [--config=<file>]
+                       [--docker-base_url=<url>]
+                       [--docker-timeout=<seconds>]
+                       [--docker-version=<version>]
+                       [--docker-host=<url>...]
+                       [--image-cache-size=<MiB>] [--dangling]
 
 Options:
     -h --help            Show this screen.
     --config=<file>      Configuration file [default: /etc/docker-packager/rpmbuild.ini]
     --define=<option>    Pass a macro to rpmbuild.
-    --output=<path>      Output directory for RPMs [default: .].
+    --output=<path>      Output directory for RPMs [default: .].  With
+                         several images every image gets its own
+                         subdirectory.
+    --bind-output        Bind mount a private directory below <path> into the
+                         container and move the RPMs it receives to
+                         <path>/RPMS and <path>/SRPMS instead of copying them
+                         out afterwards.  The output directory must be local
+                         to the docker host.
     --source=<tarball>   Tarball containing package sources.
     --sources-dir=<dir>  Directory containing resources required for spec.
-    -r --retrieve        Fetch defined resources in spec file with spectool inside container
+    --sources-ignore=<pattern>  Leave files matching a .dockerignore style
+                                pattern out of --sources-dir, in addition to
+                                the patterns of its .rpmbuildignore file.
+    --referenced-sources  Only send the files of --sources-dir the spec names
+                          as Source or Patch.
+    --source-format=<format>  Archive format for directory sources, packed on
+                              the host: gz or tar [default: gz].
+    -r --retrieve        Fetch the remote sources and patches of the spec file.
+                         They are downloaded on the host, in parallel, into a
+                         cache shared by all builds; spectool fetches them
+                         inside the container when that fails.
     --spec=<file>        RPM Spec file to build.
     --macrofile=<file>   Defines added in a file, will reside together with SPECS/
     --srpm=<file>        SRPM to rebuild.
+    --concurrency=<n>    Most batch or server jobs built at once.  Without
+                         it as many run as fit on the CPUs and memory of the
+                         docker host.
+    --cpus=<n>           CPUs of a build container, also setting the
+                         parallel jobs of %_smp_mflags.  Batch jobs default to
+                         2 and may set "cpus" in the manifest.
+    --memory=<MiB>       Memory limit of a build container.  Batch jobs
+                         default to 2048 and may set "memory" in the manifest.
+    --stream-context     Stream the build context to docker from the original
+                         files instead of copying them to a temp directory.
+    --yum-cache          Share a persistent yum package cache per base image
+                         when installing the toolchain and BuildRequires.
+    --yum-cache-size=<MiB>  Size of the yum package cache per base image,
+                            least recently used packages are evicted
+                            [default: 4096].
+    --pool               Run rpmbuild through docker exec in a fresh
+                         container of the BuildRequires image (or the
+                         toolchain image) instead of building an image per
+                         package.
+    --dev                Keep BUILD and BUILDROOT of the spec in docker
+                         volumes between runs, for resuming failed builds.
+                         Results are not cached.
+    --stage=<stage>      Stage a development build starts from on the tree
+                         of the previous run: all, build (-bc), install (-bi),
+                         files (-bl) or binary (-bb) [default: all].
+    --no-cache           Always build, neither reuse nor store results of
+                         identical earlier builds.
+    --result-cache-size=<MiB>  Size of the cache of earlier build results,
+                               least recently used builds are evicted
+                               [default: 10240].
+    --log-dir=<dir>      Write the full output of every build to
+                         <dir>/<name>.log and only show a line per second of
+                         it, and its last lines on failure, on the console.
+    --log-compress       Gzip the log files.
+    --metrics=<file>     Write the time and bytes spent in every phase of
+                         every build to a JSON file.
+    --metrics-textfile=<file>  Write the same as a Prometheus textfile.
+    --gc                 Collect images and containers like the gc command
+                         once the build finished.
+    --image-cache-size=<MiB>  Size of the rpmbuild_* images kept by gc, least
+                              recently used images are removed
+                              [default: 20480].
+    --dangling           Also remove dangling images.
+    --profile=<name>     Build profile: release, dev or one of the
+                         configuration file [default: release].  dev skips
+                         %check, debuginfo and the SRPM and compresses fast.
+    --listen=<address>   Address the build server API is served on,
+                         host:port or unix:///path/to/socket.  It has no
+                         authentication, keep it on loopback or a unix
+                         socket [default: 127.0.0.1:8420].
+    --registry=<host>    Registry shared by build hosts, e.g. localhost:5000.
+                         Images of identical inputs are pulled from it
+                         instead of built, new images are pushed to it.
 
 Docker Options:
     --docker-base_url=<url>     protocol+hostname+port towards docker
@@ -36,66 +164,311 @@ Docker Options:
     --docker-timeout=<seconds>  HTTP request timeout in seconds towards docker API. (default: 600)
     --docker-version=<version>  API version the docker client will use towards
                                 docker (example: 1.12)
+    --docker-host=<url>         Spread builds over several docker hosts, each
+                                job goes to the least loaded healthy one and
+                                moves to another when its host fails.
 """
 
 from __future__ import print_function
 
-import json
+import os
 import sys
 
-is_py26 = (2, 6) <= sys.version_info < (2, 7)
-
 from docopt import docopt
-from rpmbuild import Packager, PackagerContext, PackagerException
-from rpmbuild.config import get_docker_config
+import docker
+
+from rpmbuild import Packager, PackagerException
+from rpmbuild.batch import (Batch, apply_profile, job_context, job_name,
+                            load_manifest, summary)
+from rpmbuild.cache import ResultCache, cache_dir, cache_key
+from rpmbuild.config import get_docker_configs, get_profiles
+from rpmbuild.dispatch import dispatcher
+from rpmbuild.images import ImageUsage, collect
+from rpmbuild.logs import BuildLog, log_path
+from rpmbuild.metrics import write_json, write_prometheus
+from rpmbuild.scheduler import DEFAULT_JOB_RESOURCES, Resources
+from rpmbuild.server import BuildServer, make_server
+
+
+def packager_options(args):
+    options = {}
+
+    if args['--yum-cache']:
+        options['yum_cache'] = cache_dir('yum')
+        options['yum_cache_size'] = int(args['--yum-cache-size']) * 1024 * 1024
+
+    options['image_usage'] = ImageUsage(cache_dir('images'))
+
+    if args['--registry']:
+        options['registry'] = args['--registry']
+
+    if args['--dev']:
+        options['dev'] = True
+        options['stage'] = args['--stage']
+
+    if not args['--no-cache']:
+        options['result_cache'] = ResultCache(
+            cache_dir('results'),
+            int(args['--result-cache-size']) * 1024 * 1024)
+
+    return options
+
+
+def resources(args, default=None):
+    """CPUs and memory of a build from --cpus and --memory."""
+    if default is None and not (args['--cpus'] or args['--memory']):
+        return None
+
+    default = default or Resources(None, None)
+    return Resources(
+        float(args['--cpus']) if args['--cpus'] else default.cpus,
+        int(args['--memory']) * 1024 * 1024 if args['--memory']
+        else default.memory)
+
+
+def write_metrics(args, builds):
+    if args['--metrics']:
+        write_json(builds, args['--metrics'])
+    if args['--metrics-textfile']:
+        write_prometheus(builds, args['--metrics-textfile'])
+
+
+def gc(args):
+    """
+    Remove stopped build containers and the least recently used rpmbuild
+    images beyond --image-cache-size, on every docker host.
+    """
+    configs = get_docker_configs(args)
+    for config in configs:
+        client = docker.Client(**dict(config))
+        freed = collect(client, ImageUsage(cache_dir('images')),
+                        int(args['--image-cache-size']) * 1024 * 1024,
+                        dangling=args['--dangling'])
+        if len(configs) > 1:
+            print('Freed %d MiB on %s' % (freed // (1024 * 1024),
+                                          config['base_url']))
+        else:
+            print('Freed %d MiB' % (freed // (1024 * 1024)))
+
+
+def batch(args):
+    try:
+        profiles = get_profiles(args)
+        jobs = [apply_profile(job, profiles, args['--profile'])
+                for job in load_manifest(args['<manifest>'])]
+    except (IOError, ValueError, PackagerException) as e:
+        print('Invalid manifest: %s' % e, file=sys.stderr)
+        sys.exit(1)
+
+    concurrency = args['--concurrency']
+    runner = Batch(jobs, get_docker_configs(args),
+                   concurrency=concurrency and int(concurrency),
+                   resources=resources(args, DEFAULT_JOB_RESOURCES),
+                   packager_options=packager_options(args),
+                   pool=args['--pool'],
+                   log_dir=args['--log-dir'],
+                   log_compress=args['--log-compress'])
+
+    try:
+        results = runner.run()
+    except PackagerException as e:
+        print('Batch failed: %s' % e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        write_metrics(args, runner.metrics)
+        if args['--gc']:
+            gc(args)
+
+    for line in summary(results):
+        print(line)
+
+    if any(result.error is not None for result in results):
+        sys.exit(1)
+
+
+def serve(args):
+    """Serve the build API until interrupted, see rpmbuild.server."""
+    concurrency = args['--concurrency']
+    try:
+        profiles = get_profiles(args)
+        if args['--profile'] not in profiles:
+            raise ValueError('Unknown profile %s' % args['--profile'])
+        builds = BuildServer(get_docker_configs(args),
+                             workers=concurrency and int(concurrency),
+                             packager_options=packager_options(args),
+                             pool=args['--pool'],
+                             resources=resources(args, DEFAULT_JOB_RESOURCES),
+                             profiles=profiles,
+                             profile=args['--profile'])
+        server = make_server(builds, args['--listen'])
+    except (IOError, OSError, ValueError, PackagerException,
+            docker.errors.DockerException) as e:
+        print('Cannot serve: %s' % e, file=sys.stderr)
+        sys.exit(1)
+
+    builds.start()
+    print('Serving builds on %s' % args['--listen'])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        builds.stop()
+
+
+def build_job(args):
+    """Job settings of a build or rebuild, as used in batch manifests."""
+    if args['build']:
+        return {
+            'defines': args['--define'],
+            'sources': args['--source'],
+            'sources_dir': args['--sources-dir'],
+            'sources_ignore': args['--sources-ignore'],
+            'referenced_sources': args['--referenced-sources'],
+            'spec': args['--spec'],
+            'macrofiles': args['--macrofile'],
+            'retrieve': args['--retrieve'],
+            'stream_context': args['--stream-context'],
+            'source_format': args['--source-format'],
+            'output': args['--output'],
+            'bind_output': args['--bind-output'],
+            'profile': args['--profile'],
+        }
+
+    return {
+        'srpm': args['--srpm'],
+        'stream_context': args['--stream-context'],
+        'output': args['--output'],
+        'bind_output': args['--bind-output'],
+        'profile': args['--profile'],
+    }
+
+
+def matrix_jobs(job, images, context_image):
+    """One job per image, all copying from the same context image."""
+    jobs = []
+    for image in images:
+        jobs.append(dict(job,
+                         image=image,
+                         name=image,
+                         context_image=context_image,
+                         output=os.path.join(job['output'], cache_key(image))))
+    return jobs
+
+
+def matrix(args, job):
+    """
+    Build one spec or SRPM on several images at once.  On a single docker
+    host the context is uploaded a single time as a data image the
+    per-image builds copy from.
+    """
+    images = args['<image>']
+    options = packager_options(args)
+    configs = get_docker_configs(args)
+
+    try:
+        context_image = None
+        if not args['--pool'] and len(configs) == 1:
+            context = job_context(dict(job, image=images[0],
+                                       stream_context=True))
+            client = docker.Client(**dict(configs[0]))
+            with Packager(context, client=client) as p:
+                context_image = p.upload_context()
+
+        runner = Batch(matrix_jobs(job, images, context_image), configs,
+                       concurrency=len(images),
+                       resources=resources(args, DEFAULT_JOB_RESOURCES),
+                       packager_options=options,
+                       pool=args['--pool'],
+                       log_dir=args['--log-dir'],
+                       log_compress=args['--log-compress'])
+        results = runner.run()
+    except PackagerException as e:
+        print('Container build failed! %s' % e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if args['--gc']:
+            gc(args)
+
+    write_metrics(args, runner.metrics)
+
+    for line in summary(results):
+        print(line)
+
+    if any(result.error is not None for result in results):
+        sys.exit(1)
 
 
 def main():
     args = docopt(__doc__, version='Docker Packager 0.0.1')
 
-    if args['build']:
-        context = PackagerContext(
-            args['<image>'],
-            defines=args['--define'],
-            sources=args['--source'],
-            sources_dir=args['--sources-dir'],
-            spec=args['--spec'],
-            macrofiles=args['--macrofile'],
-            retrieve=args['--retrieve'],
-        )
-
-    if args['rebuild']:
-        context = PackagerContext(
-            args['<image>'],
-            srpm=args['--srpm']
-        )
+    if args['gc']:
+        return gc(args)
+
+    if args['batch']:
+        return batch(args)
+
+    if args['serve']:
+        return serve(args)
 
     try:
-        with Packager(context,  get_docker_config(args)) as p:
-            for line in p.build_image():
-                if is_py26:
-                    parsed = json.loads(line.decode('UTF-8'))
-                else:
-                    parsed = json.loads(line.decode(encoding='UTF-8'))
-                if 'stream' not in parsed:
-                    print(parsed)
-                else:
-                    print(parsed['stream'].strip())
-
-            container, logs = p.build_package()
-
-            for line in logs:
-                if is_py26:
-                    print(line.decode('UTF-8').strip())
-                else:
-                    print(line.decode(encoding='UTF-8').strip())
-
-            for path in p.export_package(args['--output']):
-                print('Wrote: %s' % path)
+        job = apply_profile(build_job(args), get_profiles(args),
+                            args['--profile'])
+    except (ValueError, PackagerException) as e:
+        print('Invalid profile: %s' % e, file=sys.stderr)
+        sys.exit(1)
+
+    if len(args['<image>']) > 1:
+        return matrix(args, job)
+
+    job = dict(job, image=args['<image>'][0])
+
+    log = print
+    if args['--log-dir']:
+        log = BuildLog(log_path(args['--log-dir'], job_name(job),
+                                args['--log-compress']),
+                       compress=args['--log-compress'])
+
+    limits = resources(args)
+    options = packager_options(args)
+    contexts = []
+
+    def build(host, share):
+        # Every attempt starts from a fresh context on its host.
+        context = job_context(job)
+        contexts.append(context)
+        with Packager(context, client=host.client,
+                      resources=limits and share,
+                      **dict(options, **host.options)) as p:
+            return p.run(args['--output'], log=log,
+                         bind_output=args['--bind-output'])
+
+    try:
+        hosts = dispatcher(get_docker_configs(args), pool=args['--pool'],
+                           log=log)
+        exported = hosts.run(limits or Resources(0.0, 0), build)
 
     except PackagerException:
+        if args['--log-dir']:
+            log.close(failed=True)
+        write_metrics(args, [c.metrics for c in contexts[-1:]])
         print('Container build failed!', file=sys.stderr)
         sys.exit(1)
+    else:
+        if args['--log-dir']:
+            log.close()
+    finally:
+        # Any other error must not leave the log writer thread behind.
+        if args['--log-dir']:
+            log.close(failed=True)
+        if args['--gc']:
+            gc(args)
+
+    write_metrics(args, [c.metrics for c in contexts[-1:]])
+
+    for path in exported:
+        print('Wrote: %s' % path)
 
 if __name__ == '__main__':
     main()
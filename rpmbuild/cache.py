@@ -0,0 +1,164 @@
+"""
+Host side caches shared between docker-rpmbuild runs.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import os
+import shutil
+import tempfile
+
+CACHE_ENV = 'DOCKER_RPMBUILD_CACHE'
+
+
+def cache_dir(*parts):
+    """
+    Return (and create) a directory below the cache root.  The root is
+    taken from $DOCKER_RPMBUILD_CACHE, falling back to the XDG cache home.
+    """
+    root = os.environ.get(CACHE_ENV)
+    if not root:
+        xdg = os.environ.get('XDG_CACHE_HOME',
+                             os.path.join(os.path.expanduser('~'), '.cache'))
+        root = os.path.join(xdg, 'docker-rpmbuild')
+
+    path = os.path.join(root, *parts)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another build may have created it in the meantime.
+            if not os.path.isdir(path):
+                raise
+
+    return path
+
+
+def cache_key(name):
+    """Turn an image or URL into something usable as a directory name."""
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+
+
+@contextmanager
+def lock(path, shared=False):
+    """
+    Lock on a cache directory, held across processes.  Shared locks only
+    keep exclusive holders out.
+    """
+    with open(os.path.join(path, '.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def evict(path, max_bytes, suffix=''):
+    """
+    Remove the least recently used files ending with suffix below path
+    until those left take at most max_bytes.  Returns the bytes freed.
+    """
+    entries = []
+    total = 0
+
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if name == '.lock' or not name.endswith(suffix):
+                continue
+            full = os.path.join(root, name)
+            stat = os.lstat(full)
+            entries.append((max(stat.st_atime, stat.st_mtime),
+                            stat.st_size, full))
+            total += stat.st_size
+
+    freed = 0
+    for used, size, full in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        os.remove(full)
+        freed += size
+
+    return freed
+
+
+def _size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(path) for name in files)
+
+
+class ResultCache(object):
+    """
+    Exported RPMs of earlier builds keyed by a digest of their inputs.
+    Entries are evicted as a whole, least recently used first.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def __contains__(self, key):
+        return os.path.isdir(self._entry(key))
+
+    def get(self, key, output):
+        """
+        Copy the RPMs stored under key to output, keeping their layout, and
+        return their paths.  Returns None on a miss.
+        """
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return None
+
+        os.utime(entry, None)
+        copied = []
+
+        for root, dirs, files in os.walk(entry):
+            for name in files:
+                source = os.path.join(root, name)
+                target = os.path.join(output, os.path.relpath(source, entry))
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.copy(source, target)
+                copied.append(target)
+
+        return sorted(copied)
+
+    def put(self, key, paths, output):
+        """Store the RPMs of a finished build exported below output."""
+        partial = tempfile.mkdtemp(dir=self.path, prefix='.partial-')
+
+        for path in paths:
+            relative = os.path.relpath(path, output)
+            if relative.startswith(os.pardir):
+                relative = os.path.basename(path)
+            target = os.path.join(partial, relative)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copy(path, target)
+
+        try:
+            os.rename(partial, self._entry(key))
+        except OSError:
+            # An identical build stored its results first.
+            shutil.rmtree(partial)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            entry = self._entry(name)
+            if not name.startswith('.') and os.path.isdir(entry):
+                entries.append((os.path.getmtime(entry), _size(entry), entry))
+
+        total = sum(size for used, size, entry in entries)
+        for used, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry)
+            total -= size
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -6,11 +6,24 @@ except ImportError:
     from configparser import ConfigParser
     from io import StringIO
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import os
 
 
 DEFAULT_TIMEOUT = '600'
+PROFILE_SECTION = 'profile:'
+
+# Macros and rpmbuild flags applied by a build profile.  stage is the build
+# mode rpmbuild runs with, -ba for binary and source packages.
+Profile = namedtuple('Profile', ['defines', 'options', 'stage'])
+
+PROFILES = {
+    'release': Profile([], [], '-ba'),
+    # Iteration builds: fast payload compression, no debuginfo, no %check
+    # and no SRPM.
+    'dev': Profile(['_binary_payload w1.gzdio', 'debug_package %{nil}'],
+                   ['--nocheck'], '-bb'),
+}
 
 
 def read_config(config_file):
@@ -57,3 +70,74 @@ def get_docker_config(docopt_args):
     # Update docker config with overrides.
     docker_config.update(docker_config_overrides)
     return docker_config
+
+
+def read_hosts(config_file):
+    """Docker endpoints of the hosts option of the docker section."""
+    config = ConfigParser()
+    config.readfp(StringIO(config_file))
+
+    if not config.has_option('docker', 'hosts'):
+        return []
+    return config.get('docker', 'hosts').replace(',', ' ').split()
+
+
+def get_docker_configs(docopt_args):
+    """
+    Docker configs of every host builds are spread over: those given by
+    --docker-host or else the hosts of the configuration file, otherwise
+    just the one of get_docker_config.
+    """
+    docker_config = get_docker_config(docopt_args)
+
+    hosts = docopt_args.get('--docker-host') or []
+    if not hosts and docopt_args['--config'] is not None and os.path.exists(docopt_args['--config']):
+        with open(docopt_args['--config']) as f:
+            hosts = read_hosts(f.read())
+
+    if not hosts:
+        return [docker_config]
+    return [dict(docker_config, base_url=host) for host in hosts]
+
+
+def read_profiles(config_file):
+    """
+    Build profiles of [profile:<name>] sections, on top of the built in
+    ones.  define takes one macro per line, options the extra rpmbuild
+    flags and stage the build mode; a section named after a built in
+    profile starts from it.
+    """
+    config = ConfigParser()
+    config.readfp(StringIO(config_file))
+
+    profiles = dict(PROFILES)
+    for section in config.sections():
+        if not section.startswith(PROFILE_SECTION):
+            continue
+        name = section[len(PROFILE_SECTION):].strip()
+        base = profiles.get(name, PROFILES['release'])
+
+        defines, options, stage = base
+        if config.has_option(section, 'define'):
+            defines = [line.strip() for line
+                       in config.get(section, 'define', raw=True).splitlines()
+                       if line.strip()]
+        if config.has_option(section, 'options'):
+            options = config.get(section, 'options', raw=True).split()
+        if config.has_option(section, 'stage'):
+            stage = config.get(section, 'stage', raw=True).strip()
+        if not stage.startswith('-b'):
+            raise ValueError('Stage of profile %s must be an rpmbuild -b '
+                             'mode, not %s' % (name, stage))
+
+        profiles[name] = Profile(defines, options, stage)
+
+    return profiles
+
+
+def get_profiles(docopt_args):
+    """Built in profiles and those of the configuration file."""
+    if docopt_args['--config'] is not None and os.path.exists(docopt_args['--config']):
+        with open(docopt_args['--config']) as f:
+            return read_profiles(f.read())
+    return dict(PROFILES)
@@ -0,0 +1,160 @@
+"""
+Builds spread over several docker hosts.
+
+Every host of the pool has its own client, CPUs and memory and a health
+state.  A job goes to the healthy host with the smallest part of its CPUs
+reserved that has room for the job's share, waiting for one otherwise.
+When the host fails rather than the build, connecting to it or talking to
+it breaks off, it is left out for a while and the job starts over on
+another host.  Contexts are uploaded to, and RPMs exported from, the host
+running the job through its client.
+"""
+
+from __future__ import print_function
+
+import threading
+import time
+
+import docker
+import requests
+
+from rpmbuild import PackagerException
+from rpmbuild.pool import BuilderPool
+from rpmbuild.scheduler import ResourcePool, host_resources
+
+# Seconds a failed host is left out before it is probed again.
+RETRY_AFTER = 60
+
+# Failures of the host itself, other errors are failures of the build.
+HOST_ERRORS = (requests.exceptions.ConnectionError,
+               requests.exceptions.Timeout)
+
+
+class DockerHost(object):
+    """A docker endpoint of the pool."""
+
+    def __init__(self, config, client=None, pool=False):
+        self.config = dict(config)
+        self.name = self.config.get('base_url') or 'default'
+        self.client = client or docker.Client(**self.config)
+        self.resources = None
+        self.failed_at = None
+        self.running = 0
+        self.lock = threading.Lock()
+        # Packager options bound to this host's client.
+        self.options = {}
+
+        if pool:
+            self.options['pool'] = BuilderPool(self.client)
+
+    def __str__(self):
+        return self.name
+
+    def probe(self):
+        """Learn the host's CPUs and memory, False when it cannot be reached."""
+        try:
+            capacity = host_resources(self.client)
+        except HOST_ERRORS + (docker.errors.DockerException,):
+            self.failed_at = time.time()
+            return False
+
+        with self.lock:
+            if self.resources is None:
+                self.resources = ResourcePool(capacity)
+            self.failed_at = None
+        return True
+
+
+class Dispatcher(object):
+    """Least loaded healthy host for every job, retrying on host failures."""
+
+    def __init__(self, hosts, retry_after=RETRY_AFTER, log=print):
+        self.hosts = hosts
+        self.retry_after = retry_after
+        self.log = log
+        self.condition = threading.Condition()
+
+    @property
+    def client(self):
+        """Client of the first host, for single host callers."""
+        return self.hosts[0].client
+
+    def _available(self, exclude):
+        """
+        Hosts not excluded that are healthy, probing new hosts and failed
+        ones due for another try.  Called without holding the condition,
+        probes talk to the hosts.
+        """
+        now = time.time()
+        hosts = []
+        for host in self.hosts:
+            if host in exclude:
+                continue
+            if host.failed_at is not None:
+                if now - host.failed_at < self.retry_after:
+                    continue
+                if not host.probe():
+                    continue
+            elif host.resources is None and not host.probe():
+                self.log('Docker host %s is unreachable' % host)
+                continue
+            hosts.append(host)
+        return hosts
+
+    def _acquire(self, resources, exclude, error):
+        while True:
+            hosts = self._available(exclude)
+            if not hosts:
+                raise PackagerException(
+                    'No healthy docker host left%s' %
+                    (': %s' % error if error else ''))
+
+            with self.condition:
+                hosts.sort(key=lambda h: (h.resources.load, h.running))
+                for host in hosts:
+                    share = host.resources.take(resources)
+                    if share is not None:
+                        host.running += 1
+                        return host, share
+
+                # Wake up now and then, failed hosts may be back by then.
+                self.condition.wait(1)
+
+    def _release(self, host, share):
+        with self.condition:
+            host.running -= 1
+            host.resources.give(share)
+            self.condition.notify_all()
+
+    def run(self, resources, build):
+        """
+        Call build(host, share) on the least loaded healthy host with room
+        for resources and return its result.  Builds failing because of
+        their host start over on another one.
+        """
+        tried = set()
+        error = None
+
+        while True:
+            host, share = self._acquire(resources, tried, error)
+            try:
+                return build(host, share)
+            except HOST_ERRORS as e:
+                error = '%s: %s' % (host, e)
+                self.log('Docker host %s failed, trying another one: %s'
+                         % (host, e))
+                host.failed_at = time.time()
+                tried.add(host)
+            finally:
+                self._release(host, share)
+
+
+def dispatcher(docker_configs, pool=False, log=print):
+    """Dispatcher over one docker config or a list of them."""
+    if isinstance(docker_configs, dict):
+        docker_configs = [docker_configs]
+    return Dispatcher([DockerHost(config, pool=pool)
+                       for config in docker_configs], log=log)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,153 @@
+"""
+Garbage collection of the images and containers builds leave behind.
+
+Builds tag rpmbuild_* images for toolchains, BuildRequires stages, shared
+contexts and every spec.  The last use of each tag is kept in a state file
+below the cache directory so collect() can evict the least recently used
+ones once their total size passes a limit, keeping the toolchain and
+dependency images most builds start from.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+import time
+
+import docker
+
+from rpmbuild.cache import lock
+
+IMAGE_PREFIX = 'rpmbuild_'
+
+
+class ImageUsage(object):
+    """Last use of rpmbuild images, shared by concurrent builds."""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = os.path.join(path, 'usage.json')
+
+    def _load(self):
+        try:
+            with open(self.state) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, usage):
+        fd, partial = tempfile.mkstemp(dir=self.path, suffix='.partial')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(usage, f)
+        os.rename(partial, self.state)
+
+    def touch(self, *tags):
+        """Record tags as used now, None entries are ignored."""
+        tags = [tag for tag in tags if tag]
+        if not tags:
+            return
+
+        with lock(self.path):
+            usage = self._load()
+            now = time.time()
+            for tag in tags:
+                usage[tag] = now
+            self._save(usage)
+
+    def last_used(self):
+        with lock(self.path):
+            return self._load()
+
+    def forget(self, tags):
+        with lock(self.path):
+            usage = self._load()
+            for tag in tags:
+                usage.pop(tag, None)
+            self._save(usage)
+
+
+def rpmbuild_images(client):
+    """Images holding rpmbuild_* tags, with only those tags listed."""
+    images = []
+    for image in client.images():
+        tags = [tag for tag in image.get('RepoTags') or []
+                if tag.startswith(IMAGE_PREFIX)]
+        if tags:
+            images.append(dict(image, RepoTags=tags))
+    return images
+
+
+def remove_containers(client, image_ids, log=print):
+    """
+    Remove stopped containers of rpmbuild images, left over by interrupted
+    builds.
+    """
+    removed = []
+
+    for container in client.containers(all=True,
+                                       filters={'status': 'exited'}):
+        image = container.get('Image', '')
+        if not (image.startswith(IMAGE_PREFIX) or image in image_ids or
+                container.get('ImageID') in image_ids):
+            continue
+        try:
+            client.remove_container(container['Id'], v=True)
+        except docker.errors.APIError as e:
+            log('Keeping container %s: %s' % (container['Id'][:12], e))
+            continue
+        removed.append(container['Id'])
+
+    return removed
+
+
+def collect(client, usage, max_bytes, dangling=False, log=print):
+    """
+    Remove stopped build containers, then untag the least recently used
+    rpmbuild images until those left take at most max_bytes.  Images never
+    recorded in usage count as used when they were created.  Sizes include
+    layers shared with parent images, so the limit errs on the small side.
+    Returns the bytes freed.
+    """
+    images = rpmbuild_images(client)
+    remove_containers(client, set(image['Id'] for image in images), log)
+
+    last_used = usage.last_used()
+    entries = []
+    for image in images:
+        used = max(last_used.get(tag, 0) for tag in image['RepoTags'])
+        entries.append((used or image.get('Created', 0),
+                        image.get('Size', 0), image['RepoTags']))
+
+    total = sum(size for used, size, tags in entries)
+    freed = 0
+    removed = []
+
+    for used, size, tags in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        try:
+            for tag in tags:
+                client.remove_image(tag)
+                removed.append(tag)
+        except docker.errors.APIError as e:
+            # Images of running containers, like builder pools, stay.
+            log('Keeping image %s: %s' % (tags[0], e))
+            continue
+        log('Removed image %s' % ', '.join(tags))
+        freed += size
+
+    if dangling:
+        for image in client.images(filters={'dangling': True}):
+            try:
+                client.remove_image(image['Id'])
+            except docker.errors.APIError:
+                continue
+            freed += image.get('Size', 0)
+
+    usage.forget(removed)
+
+    return freed
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,128 @@
+"""
+Build logs written to files in large batches, with a rate limited view of
+them on the console.
+"""
+
+from __future__ import print_function
+
+from collections import deque
+import gzip
+import io
+import os
+import threading
+import time
+
+from rpmbuild.cache import cache_key
+
+FLUSH_SIZE = 256 * 1024
+FLUSH_INTERVAL = 1.0
+MAX_PENDING = 16 * 1024 * 1024
+CONSOLE_INTERVAL = 1.0
+TAIL_LINES = 20
+
+
+def log_path(log_dir, name, compress=False):
+    """Log file of the build called name below log_dir."""
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    return os.path.join(log_dir, cache_key(name) + ('.log.gz' if compress
+                                                    else '.log'))
+
+
+class BuildLog(object):
+    """
+    Callable taking the log lines of one build, usable wherever a log
+    function is expected.  Lines are queued in memory and written by a
+    helper thread once enough of them piled up, optionally gzipped.  When
+    the writer falls behind by more than max_pending bytes callers block
+    until it caught up.  The console gets at most one line per interval,
+    and the last lines of the log when a build failed.
+    """
+
+    def __init__(self, path, console=print, compress=False,
+                 interval=CONSOLE_INTERVAL, tail=TAIL_LINES,
+                 flush_size=FLUSH_SIZE, max_pending=MAX_PENDING):
+        self.path = path
+        self.console = console
+        self.interval = interval
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self.tail = deque(maxlen=tail)
+        self.lines = 0
+        self.shown = None
+        self.pending = []
+        self.pending_size = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        if compress:
+            # Logs are mostly repetitive text, the fastest level is plenty.
+            self.file = gzip.open(path, 'wb', 1)
+        else:
+            self.file = io.open(path, 'wb')
+
+        self.writer = threading.Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close(failed=type is not None)
+
+    def __call__(self, line):
+        line = u'%s' % (line,)
+
+        with self.condition:
+            while self.pending_size >= self.max_pending:
+                self.condition.wait()
+            self.pending.append(line + u'\n')
+            self.pending_size += len(line) + 1
+            if self.pending_size >= self.flush_size:
+                self.condition.notify_all()
+
+        self.lines += 1
+        self.tail.append(line)
+
+        now = time.time()
+        if self.shown is None or now - self.shown >= self.interval:
+            self.shown = now
+            self.console(line)
+
+    def _write(self):
+        while True:
+            with self.condition:
+                if not self.closed and self.pending_size < self.flush_size:
+                    self.condition.wait(FLUSH_INTERVAL)
+                batch = self.pending
+                self.pending = []
+                self.pending_size = 0
+                closed = self.closed
+                self.condition.notify_all()
+
+            if batch:
+                self.file.write(u''.join(batch).encode('utf-8'))
+            if closed:
+                break
+
+        self.file.close()
+
+    def close(self, failed=False):
+        """Write what is left and report the log file on the console."""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+
+        if failed:
+            self.console('Last %d lines of %s:' % (len(self.tail), self.path))
+            for line in self.tail:
+                self.console(line)
+        else:
+            self.console('Wrote %d lines to %s' % (self.lines, self.path))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
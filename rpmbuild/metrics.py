@@ -0,0 +1,116 @@
+"""
+Timings and byte counts of the phases of a build, written as JSON or as a
+Prometheus textfile.
+
+Phases recorded by Packager and PackagerContext:
+
+    setup      copying or packing the context on the host, bytes in context
+    toolchain  building the toolchain image, when it was not cached
+    deps       building the BuildRequires image, when it was not cached
+    upload     sending the context to docker, bytes sent
+    builddep   building the context image, mostly yum-builddep
+    rpmbuild   running rpmbuild in the container
+    export     copying the RPMs to the host, bytes exported
+    cache      copying the RPMs of an identical build from the result cache
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class Metrics(object):
+    """Phases of one build, in the order they were first recorded."""
+
+    def __init__(self, name=None):
+        self.name = name
+        self.phases = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds=0.0, bytes=0):
+        with self.lock:
+            entry = self.phases.setdefault(phase, {'seconds': 0.0, 'bytes': 0})
+            entry['seconds'] += seconds
+            entry['bytes'] += bytes
+
+    def seconds(self, phase):
+        return self.phases.get(phase, {}).get('seconds', 0.0)
+
+    @contextmanager
+    def phase(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start)
+
+    def count(self, phase, chunks):
+        """Pass chunks through, recording their size and the time taken."""
+        start = time.time()
+        total = 0
+        for chunk in chunks:
+            total += len(chunk)
+            yield chunk
+        self.add(phase, time.time() - start, total)
+
+    def to_dict(self):
+        with self.lock:
+            phases = OrderedDict((phase, dict(entry))
+                                 for phase, entry in self.phases.items())
+        return OrderedDict([
+            ('name', self.name),
+            ('seconds', sum(e['seconds'] for e in phases.values())),
+            ('phases', phases),
+        ])
+
+
+def _write(path, data):
+    """Replace path atomically, textfile collectors may read it any time."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, partial = tempfile.mkstemp(dir=directory, suffix='.partial')
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.rename(partial, path)
+
+
+def write_json(builds, path):
+    _write(path, json.dumps([m.to_dict() for m in builds], indent=2) + '\n')
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus(builds):
+    """Render builds in the Prometheus text exposition format."""
+    lines = [
+        '# HELP rpmbuild_phase_seconds Time spent in a phase of a build.',
+        '# TYPE rpmbuild_phase_seconds gauge',
+    ]
+    sizes = [
+        '# HELP rpmbuild_phase_bytes Bytes handled in a phase of a build.',
+        '# TYPE rpmbuild_phase_bytes gauge',
+    ]
+
+    for metrics in builds:
+        for phase, entry in metrics.to_dict()['phases'].items():
+            labels = '{build="%s",phase="%s"}' % (_label(metrics.name),
+                                                  _label(phase))
+            lines.append('rpmbuild_phase_seconds%s %.6f'
+                         % (labels, entry['seconds']))
+            if entry['bytes']:
+                sizes.append('rpmbuild_phase_bytes%s %d'
+                             % (labels, entry['bytes']))
+
+    return '\n'.join(lines + sizes) + '\n'
+
+
+def write_prometheus(builds, path):
+    _write(path, prometheus(builds))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
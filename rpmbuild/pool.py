@@ -0,0 +1,161 @@
+"""
+Builder containers running rpmbuild through docker exec.
+
+Instead of building an image per package, every job runs in a fresh
+container of its dependency image, or of its toolchain image when the job
+has no dependency stage.  Its context is copied into an rpmbuild
+topdir with put_archive, rpmbuild runs through exec and the container is
+removed afterwards, so the BuildRequires and repository of one job are
+never seen by another.
+"""
+
+import os
+import uuid
+
+from jinja2 import Template
+import docker
+
+from rpmbuild import PackagerException
+
+JOBS_DIR = '/rpmbuild-jobs'
+
+SCRIPT = Template("""
+set -e
+top={{ top }}
+{% if cpus %}
+export RPM_BUILD_NCPUS={{ cpus }}
+{% endif %}
+mkdir -p $top/BUILD $top/BUILDROOT $top/RPMS $top/SOURCES $top/SPECS $top/SRPMS
+cd $top/context
+{% if repo %}
+yum -y install createrepo
+createrepo $top/context/REPO
+printf '[rpmbuild-{{ job }}]\\nname=rpmbuild-{{ job }}\\nbaseurl=file://'$top'/context/REPO\\nenabled=1\\ngpgcheck=0\\n' > /etc/yum.repos.d/rpmbuild-{{ job }}.repo
+{% endif %}
+{% if sources_dir %}
+cp -a SOURCES/. $top/SOURCES/
+{% endif %}
+{% for source in sources %}
+cp -a '{{ source }}' $top/SOURCES/
+{% endfor %}
+{% if spec %}
+{% for macrofile in macrofiles %}
+cp -a '{{ macrofile }}' $top/SPECS/
+{% endfor %}
+cp -a '{{ spec }}' $top/SPECS/
+{% if retrieve %}
+spectool -g -R -A --define "_topdir $top" $top/SPECS/'{{ spec }}'
+{% endif %}
+yum-builddep -y $(rpmbuild --define "_topdir $top" {% for define in defines %} --define '{{ define }}' {% endfor %} -bs $top/SPECS/'{{ spec }}' | awk '{ print $2 }')
+rpmbuild --define "_topdir $top" {% for define in defines %} --define '{{ define }}' {% endfor %} {% for option in options %}{{ option }} {% endfor %}{{ stage }} $top/SPECS/'{{ spec }}'
+{% endif %}
+{% if srpm %}
+yum-builddep -y '{{ srpm }}'
+rpmbuild --define "_topdir $top" {% for define in defines %} --define '{{ define }}' {% endfor %} {% for option in options %}{{ option }} {% endfor %}--rebuild '{{ srpm }}'
+{% endif %}
+""")
+
+
+class BuilderPool(object):
+    """
+    Runs jobs in containers of their dependency or toolchain image, skipping
+    the image builds of every package.
+    """
+
+    def __init__(self, client):
+        if not hasattr(client, 'exec_create'):
+            raise PackagerException(
+                'Builder pools need a docker-py with exec support')
+        self.client = client
+
+    def container(self, packager, binds=None):
+        """
+        Start a fresh builder container of the packager's dependency stage,
+        so yum-builddep only installs what changed since it was built.
+        """
+        context = packager.context
+        container = self.client.create_container(
+            context.deps_image or context.toolchain,
+            command=['tail', '-f', '/dev/null'],
+            volumes=[b['bind'] for b in (binds or {}).values()] or None,
+            host_config=packager._host_config(binds))
+        self.client.start(container)
+        return container
+
+    def _exec(self, container, script, log):
+        """Run a shell script in the container, passing output to log."""
+        exec_id = self.client.exec_create(container, ['/bin/sh', '-c', script])
+
+        partial = b''
+        for chunk in self.client.exec_start(exec_id, stream=True):
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                log(line.decode('UTF-8', 'replace').rstrip())
+        if partial:
+            log(partial.decode('UTF-8', 'replace').rstrip())
+
+        return self.client.exec_inspect(exec_id)['ExitCode']
+
+    def run(self, packager, output, log, bind_output=False):
+        """
+        Build the packager's context in a fresh builder container and export
+        the resulting RPMs to output, bind mounting output when asked to.
+        """
+        context = packager.context
+        metrics = packager.metrics
+        job = uuid.uuid4().hex[:12]
+        top = '%s/%s' % (JOBS_DIR, job)
+
+        binds = None
+        if bind_output:
+            binds = packager.output_binds(output, top)
+
+        container = self.container(packager, binds)
+        try:
+            self._exec(container, 'mkdir -p %s/context' % top, log)
+            self.client.put_archive(container, '%s/context' % top,
+                                    metrics.count('upload', context.chunks()))
+
+            with metrics.phase('rpmbuild'):
+                status = self._exec(container, SCRIPT.render(
+                    top=top,
+                    job=job,
+                    cpus=packager.build_cpus,
+                    repo=context.repo,
+                    defines=context.defines,
+                    options=context.profile.options,
+                    stage=context.profile.stage,
+                    sources=[os.path.basename(s) for s in context.sources],
+                    sources_dir=context.copies_sources_dir,
+                    spec=context.spec and os.path.basename(context.spec),
+                    macrofiles=[os.path.basename(m)
+                                for m in context.macrofiles],
+                    retrieve=context.retrieve and context.spectool,
+                    srpm=context.srpm and os.path.basename(context.srpm),
+                ), log)
+
+            if status != 0:
+                raise PackagerException('rpmbuild failed with status %s'
+                                        % status)
+
+            if bind_output:
+                return packager.export_package(output)
+
+            exported = []
+            with metrics.phase('export'):
+                for directory in ('RPMS', 'SRPMS'):
+                    archive, stat = self.client.get_archive(
+                        container, '%s/%s' % (top, directory))
+                    exported += [path for path in
+                                 packager._extract(archive, output)
+                                 if path.endswith('.rpm')]
+            return exported
+        finally:
+            try:
+                self.client.remove_container(container, v=True, force=True)
+            except docker.errors.APIError as e:
+                log('Could not remove container %s: %s' % (container['Id'], e))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,176 @@
+"""
+Order build jobs by the packages they need from each other, and pack the
+jobs running at once onto the CPUs and memory of the docker host.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+import multiprocessing
+import os
+import threading
+
+from rpmbuild import PackagerException
+from rpmbuild.spec import Spec
+
+MiB = 1024 * 1024
+
+# CPUs and bytes of memory, of the host or reserved by a job.
+Resources = namedtuple('Resources', ['cpus', 'memory'])
+
+DEFAULT_JOB_RESOURCES = Resources(2.0, 2048 * MiB)
+
+
+def job_spec(job):
+    """Parsed spec of a job, or None for SRPM rebuilds and unreadable specs."""
+    if not job.get('spec'):
+        return None
+
+    try:
+        return Spec.from_file(job['spec'], job.get('defines'))
+    except (IOError, OSError):
+        return None
+
+
+def dependencies(jobs):
+    """
+    Map every job index to the indexes of the jobs providing one of its
+    BuildRequires.
+    """
+    specs = [job_spec(job) for job in jobs]
+    providers = {}
+
+    for index, spec in enumerate(specs):
+        for name in spec.provides if spec else ():
+            providers.setdefault(name, set()).add(index)
+
+    graph = {}
+    for index, spec in enumerate(specs):
+        graph[index] = set()
+        for name in spec.build_requires_names if spec else ():
+            graph[index].update(providers.get(name, ()))
+        graph[index].discard(index)
+
+    return graph
+
+
+def waves(graph):
+    """
+    Split the dependency graph into waves of jobs that only depend on jobs
+    of earlier waves, so every wave can be built in parallel.
+    """
+    remaining = dict((index, set(deps)) for index, deps in graph.items())
+    done = set()
+    result = []
+
+    while remaining:
+        wave = sorted(index for index, deps in remaining.items()
+                      if deps <= done)
+        if not wave:
+            raise PackagerException(
+                'Dependency cycle between jobs: %s' % sorted(remaining))
+
+        for index in wave:
+            del remaining[index]
+        done.update(wave)
+        result.append(wave)
+
+    return result
+
+
+def providers(graph, index):
+    """Indexes of the jobs a job depends on, directly or through others."""
+    found = set()
+    pending = list(graph[index])
+
+    while pending:
+        dep = pending.pop()
+        if dep not in found:
+            found.add(dep)
+            pending.extend(graph[dep])
+
+    return found
+
+
+def job_resources(job, default=DEFAULT_JOB_RESOURCES):
+    """Share of a job, 'cpus' and 'memory' (MiB) in the manifest."""
+    memory = job.get('memory')
+    return Resources(float(job.get('cpus') or default.cpus),
+                     int(memory) * MiB if memory else default.memory)
+
+
+def host_resources(client):
+    """
+    CPUs and memory of the docker host, falling back to this machine's when
+    the daemon does not report them.
+    """
+    try:
+        info = client.info()
+        return Resources(float(info['NCPU']), int(info['MemTotal']))
+    except (KeyError, TypeError, ValueError):
+        return Resources(float(multiprocessing.cpu_count()),
+                         os.sysconf('SC_PAGE_SIZE') *
+                         os.sysconf('SC_PHYS_PAGES'))
+
+
+class ResourcePool(object):
+    """
+    CPUs and memory of the docker host shared by the jobs running at once.
+    A job waits until its share is free; shares larger than the host are
+    cut down to it so every job runs eventually.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.free = capacity
+        self.condition = threading.Condition()
+
+    def clamp(self, resources):
+        return Resources(min(resources.cpus, self.capacity.cpus),
+                         min(resources.memory, self.capacity.memory))
+
+    def _fits(self, resources):
+        return (resources.cpus <= self.free.cpus + 1e-9 and
+                resources.memory <= self.free.memory)
+
+    def take(self, resources):
+        """Take a share without waiting, None when it does not fit now."""
+        resources = self.clamp(resources)
+
+        with self.condition:
+            if not self._fits(resources):
+                return None
+            self.free = Resources(self.free.cpus - resources.cpus,
+                                  self.free.memory - resources.memory)
+        return resources
+
+    def give(self, resources):
+        with self.condition:
+            self.free = Resources(self.free.cpus + resources.cpus,
+                                  self.free.memory + resources.memory)
+            self.condition.notify_all()
+
+    @property
+    def load(self):
+        """Part of the CPUs reserved."""
+        if not self.capacity.cpus:
+            return 1.0
+        return 1 - self.free.cpus / self.capacity.cpus
+
+    @contextmanager
+    def reserve(self, resources):
+        """Hold a share of the host for the duration of the block."""
+        resources = self.clamp(resources)
+
+        with self.condition:
+            while not self._fits(resources):
+                self.condition.wait()
+            self.free = Resources(self.free.cpus - resources.cpus,
+                                  self.free.memory - resources.memory)
+
+        try:
+            yield resources
+        finally:
+            self.give(resources)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
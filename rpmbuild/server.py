@@ -0,0 +1,359 @@
+"""
+Long running build server.
+
+A build started from the command line pays for interpreter startup and a
+new docker connection every time.  ``docker-rpmbuild serve`` keeps the
+docker clients with their pooled connections, the result cache, image
+usage, builder pools and the hosts' resource pools for every job it is
+sent.  Jobs take the keys of batch manifests, with absolute paths, and
+wait in a queue for a fixed number of worker threads.  The API is plain
+HTTP on a TCP address or, given as unix:///path, a unix socket:
+
+    POST /jobs              queue a job, answers with its state
+    GET  /jobs              state of every job kept
+    GET  /jobs/<id>         state, RPMs written, error and metrics of a job
+    GET  /jobs/<id>/log     its log lines, streamed until the job finished
+
+There is no authentication.  Jobs read any host path and run anything as
+root in containers, so the API must only listen on loopback or on a unix
+socket, which is created readable and writable by its owner only.
+"""
+
+from __future__ import print_function
+
+# Python 2/3 Compatibility
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from Queue import Empty, Queue
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from queue import Empty, Queue
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+from collections import OrderedDict
+import itertools
+import json
+import math
+import os
+import re
+import stat
+import threading
+
+from rpmbuild import Packager, PackagerException
+from rpmbuild.batch import (PATH_KEYS, PATH_LIST_KEYS, apply_profile,
+                            check_job, job_context, job_name)
+from rpmbuild.config import PROFILES
+from rpmbuild.dispatch import dispatcher
+from rpmbuild.scheduler import DEFAULT_JOB_RESOURCES, job_resources
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+KEEP_JOBS = 100
+JOB_RE = re.compile(r'^/jobs/(\d+)(/log)?$')
+UNIX_PREFIX = 'unix://'
+
+
+class Job(object):
+    """A submitted job, its state and the log lines written so far."""
+
+    def __init__(self, id, job):
+        self.id = id
+        self.job = job
+        self.name = job_name(job)
+        self.state = QUEUED
+        self.exported = []
+        self.error = None
+        self.metrics = None
+        self.lines = []
+        self.changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED)
+
+    def log(self, line):
+        with self.changed:
+            self.lines.append(line)
+            self.changed.notify_all()
+
+    def start(self):
+        with self.changed:
+            self.state = RUNNING
+            self.changed.notify_all()
+
+    def finish(self, exported, error):
+        with self.changed:
+            self.exported = exported
+            self.error = error
+            self.state = DONE if error is None else FAILED
+            self.changed.notify_all()
+
+    def follow(self):
+        """
+        Generate the log lines written since the last batch, waiting for
+        more until the job finished.
+        """
+        seen = 0
+        while True:
+            with self.changed:
+                while seen == len(self.lines) and not self.finished:
+                    self.changed.wait()
+                lines = self.lines[seen:]
+                finished = self.finished
+            seen += len(lines)
+            if lines:
+                yield lines
+            if finished:
+                return
+
+    def to_dict(self):
+        return OrderedDict([
+            ('id', self.id),
+            ('name', self.name),
+            ('state', self.state),
+            ('rpms', self.exported),
+            ('error', self.error),
+            ('metrics', self.metrics and self.metrics.to_dict()),
+        ])
+
+
+class BuildServer(object):
+    """
+    Queue of jobs built by worker threads sharing one docker client per
+    docker host.  Like batch builds every job reserves its share of a docker
+    host while it runs; jobs are independent, their BuildRequires are not
+    ordered.
+    """
+
+    def __init__(self, docker_config, workers=None, packager_options=None,
+                 pool=False, resources=DEFAULT_JOB_RESOURCES, profiles=None,
+                 profile='release', keep=KEEP_JOBS, log=print):
+        self.dispatcher = dispatcher(docker_config, pool=pool, log=log)
+        self.packager_options = dict(packager_options or {})
+        self.resources = resources
+        self.profiles = profiles or PROFILES
+        self.profile = profile
+        self.keep = keep
+        self.log = log
+
+        if workers is None:
+            cpus = sum(host.resources.capacity.cpus
+                       for host in self.dispatcher.hosts if host.probe())
+            workers = max(int(math.ceil(cpus)), 1)
+        self.workers = workers
+        self.queue = Queue()
+        self.jobs = OrderedDict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Fail the queued jobs and wait for the running ones."""
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except Empty:
+                break
+            if job is not None:
+                job.finish([], 'Server stopped')
+
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, job):
+        """Validate and queue a job, returning its Job."""
+        check_job(job)
+        for key in PATH_KEYS:
+            if job.get(key) and not os.path.isabs(job[key]):
+                raise PackagerException('%s must be an absolute path' % key)
+        for key in PATH_LIST_KEYS:
+            if not all(os.path.isabs(p) for p in job.get(key) or []):
+                raise PackagerException('%s must be absolute paths' % key)
+
+        with self.lock:
+            submitted = Job(next(self.ids), apply_profile(job, self.profiles,
+                                                          self.profile))
+            self.jobs[submitted.id] = submitted
+            self._forget()
+
+        self.queue.put(submitted)
+        return submitted
+
+    def _forget(self):
+        """Drop the oldest finished jobs beyond the ones kept."""
+        finished = [job.id for job in self.jobs.values() if job.finished]
+        for id in finished[:max(len(finished) - self.keep, 0)]:
+            del self.jobs[id]
+
+    def get(self, id):
+        with self.lock:
+            return self.jobs.get(int(id))
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self.run_job(job)
+
+    def run_job(self, job):
+        job.start()
+        self.log('Job %d %s: %s' % (job.id, job.name, job.state))
+
+        settings = job.job
+        output = settings.get('output') or '.'
+
+        def build(host, share):
+            context = job_context(settings)
+            context.metrics.name = job.name
+            job.metrics = context.metrics
+            if len(self.dispatcher.hosts) > 1:
+                job.log('Building on %s' % host)
+            with Packager(context, client=host.client, resources=share,
+                          **dict(self.packager_options, **host.options)) as p:
+                return p.run(output, log=job.log,
+                             bind_output=settings.get('bind_output', False))
+
+        try:
+            if not os.path.isdir(output):
+                try:
+                    os.makedirs(output)
+                except OSError:
+                    # Another job may have created it in the meantime.
+                    if not os.path.isdir(output):
+                        raise
+            exported = self.dispatcher.run(
+                job_resources(settings, self.resources), build)
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            job.log('Container build failed! %s' % error)
+            job.finish([], error)
+        else:
+            job.finish(exported, None)
+
+        self.log('Job %d %s: %s' % (job.id, job.name, job.state))
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_log(self, job):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for lines in job.follow():
+                chunk = ''.join(line + '\n' for line in lines).encode('utf-8')
+                self.wfile.write(('%x\r\n' % len(chunk)).encode('ascii') +
+                                 chunk + b'\r\n')
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+        except (IOError, OSError):
+            # The client went away, the job carries on.
+            self.close_connection = True
+
+    def do_GET(self):
+        builds = self.server.builds
+        path = self.path.split('?')[0].rstrip('/')
+
+        if path == '/jobs':
+            return self.send_json([job.to_dict() for job in builds.list()])
+
+        match = JOB_RE.match(path)
+        job = match and builds.get(match.group(1))
+        if not job:
+            return self.send_json({'message': 'No such job'}, 404)
+
+        if match.group(2):
+            return self.send_log(job)
+        self.send_json(job.to_dict())
+
+    def do_POST(self):
+        if self.path.split('?')[0].rstrip('/') != '/jobs':
+            return self.send_json({'message': 'No route for %s' % self.path},
+                                  404)
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            job = json.loads(self.rfile.read(length).decode('utf-8'))
+            submitted = self.server.builds.submit(job)
+        except (TypeError, ValueError, PackagerException) as e:
+            # Malformed values of otherwise valid keys end up as TypeError.
+            return self.send_json({'message': str(e)}, 400)
+
+        self.send_json(submitted.to_dict(), 201)
+
+
+class TCPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class UnixServer(ThreadingMixIn, UnixStreamServer):
+
+    daemon_threads = True
+
+    def get_request(self):
+        request, address = UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects a (host, port) like address.
+        return request, ('unix', 0)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(builds, address):
+    """
+    HTTP server of the build server API on host:port or unix:///path.  A
+    stale socket left by an earlier server is replaced, the socket is only
+    accessible to its owner.
+    """
+    if address.startswith(UNIX_PREFIX):
+        path = address[len(UNIX_PREFIX):]
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        # Never let the socket exist with looser permissions, not even
+        # between binding and a chmod.
+        umask = os.umask(0o177)
+        try:
+            server = UnixServer(path, Handler)
+        finally:
+            os.umask(umask)
+    else:
+        host, _, port = address.rpartition(':')
+        server = TCPServer((host or '127.0.0.1', int(port)), Handler)
+
+    server.builds = builds
+    return server
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
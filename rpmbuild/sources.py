@@ -0,0 +1,444 @@
+"""
+Host side handling of package sources before they enter the build context.
+"""
+
+# Python 2/3 Compatibility
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import tarfile
+import tempfile
+import zlib
+
+from rpmbuild.cache import cache_dir, evict, lock
+
+BLOCK_SIZE = 1024 * 1024
+FORMATS = ('gz', 'tar')
+SOURCES_CACHE_SIZE = 4096 * 1024 * 1024
+DOWNLOAD_CACHE_SIZE = 10240 * 1024 * 1024
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_TIMEOUT = 60
+IGNORE_FILE = '.rpmbuildignore'
+MACRO_RE = re.compile(r'%\{[^}]*\}|%\w+')
+
+
+class ParallelGzipFile(object):
+    """
+    Write-only gzip file compressing fixed size blocks on several cores.
+    Every block becomes its own gzip member; concatenated members are a
+    valid gzip stream for gunzip, tar and rpmbuild alike.  zlib releases
+    the GIL so plain threads are enough.
+    """
+
+    def __init__(self, fileobj, compresslevel=6, workers=None,
+                 block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.workers)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _compress(self, data):
+        # wbits of 31 makes zlib write the gzip header and trailer.
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def _submit(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+
+        self.pending.append(self.pool.apply_async(self._compress, (data,)))
+
+        # Bound the amount of uncompressed data held in memory.
+        while len(self.pending) > self.workers * 2:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def close(self):
+        if self.pool is None:
+            return
+
+        if self.buffered:
+            self._submit()
+
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+
+def file_digest(path, algorithm='sha1'):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def directory_digest(path):
+    """
+    Digest of a directory tree covering relative paths, executable bits and
+    file contents.  Timestamps and ownership are ignored.
+    """
+    digest = hashlib.sha1()
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            relative = os.path.relpath(full, path)
+            digest.update(relative.encode('utf-8') + b'\0')
+
+            if os.path.islink(full):
+                digest.update(b'l' + os.readlink(full).encode('utf-8'))
+                continue
+
+            executable = os.access(full, os.X_OK)
+            digest.update(b'x' if executable else b'-')
+            with open(full, 'rb') as f:
+                for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                    digest.update(block)
+
+        for name in dirs:
+            relative = os.path.relpath(os.path.join(root, name), path)
+            digest.update(relative.encode('utf-8') + b'/\0')
+
+    return digest.hexdigest()
+
+
+def _root_owned(info):
+    info.uid = info.gid = 0
+    info.uname = info.gname = 'root'
+    return info
+
+
+@contextmanager
+def pack_directories(paths, fmt='gz', workers=None,
+                     max_bytes=SOURCES_CACHE_SIZE):
+    """
+    Pack directory sources with pack_directory, yielding their archives
+    keyed by directory.  Old archives are evicted first so the cache stays
+    within max_bytes and the archives yielded stay in place.  Eviction
+    locks the cache for itself, other builds are kept from evicting until
+    the block is left.
+    """
+    if not paths:
+        yield {}
+        return
+
+    cache = cache_dir('sources')
+
+    # Archives only, partial ones of concurrent builds are left alone.
+    with lock(cache):
+        evict(cache, max_bytes, suffix=tuple('.' + f for f in FORMATS))
+
+    with lock(cache, shared=True):
+        yield dict((path, pack_directory(path, fmt, workers))
+                   for path in paths)
+
+
+def pack_directory(path, fmt='gz', workers=None):
+    """
+    Pack a directory source into a tarball, like ``tar -C path -czf`` would,
+    and return the path of the archive.  Archives are cached by the digest
+    of the directory so unchanged trees are never packed twice.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown source format: %s' % fmt)
+
+    cache = cache_dir('sources')
+    archive = os.path.join(cache, '%s.%s' % (directory_digest(path), fmt))
+
+    if os.path.exists(archive):
+        os.utime(archive, None)
+        return archive
+
+    fd, partial = tempfile.mkstemp(dir=cache, suffix='.partial')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if fmt == 'gz':
+                with ParallelGzipFile(f, workers=workers) as gz:
+                    _pack(path, gz)
+            else:
+                _pack(path, f)
+        os.rename(partial, archive)
+    except:
+        os.remove(partial)
+        raise
+
+    return archive
+
+
+def _pack(path, fileobj):
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        tar.add(path, arcname='.', filter=_root_owned)
+
+
+def source_name(url):
+    """
+    File name rpmbuild expects for a Source URL, honouring the '#/name'
+    fragment used for URLs not ending in the file name.
+    """
+    return url.rstrip('/').rsplit('/', 1)[-1]
+
+
+def _pattern_re(pattern):
+    """
+    Regex of a .dockerignore style pattern: * and ? stay within a path
+    component, ** spans any number of them.  A pattern naming a directory
+    matches everything below it as well.
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        char = pattern[i]
+        regex.append('[^/]*' if char == '*' else '[^/]' if char == '?'
+                     else re.escape(char))
+        i += 1
+    return re.compile(''.join(regex) + '(/.*)?$')
+
+
+class IgnoreRules(object):
+    """
+    Exclusion patterns of a .rpmbuildignore, matched against paths relative
+    to the sources directory.  The last matching pattern wins, patterns
+    starting with ! include files again.
+    """
+
+    def __init__(self, patterns):
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            pattern = os.path.normpath(pattern.lstrip('!').strip()).strip('/')
+            self.rules.append((negate, _pattern_re(pattern)))
+        # Excluded directories can only be skipped when nothing below them
+        # may be included again.
+        self.reincludes = any(negate for negate, regex in self.rules)
+
+    @classmethod
+    def from_directory(cls, path, extra=()):
+        """Rules of path's .rpmbuildignore, followed by extra patterns."""
+        patterns = []
+        ignore_file = os.path.join(path, IGNORE_FILE)
+        if os.path.exists(ignore_file):
+            with open(ignore_file) as f:
+                patterns = f.read().splitlines()
+        return cls(patterns + list(extra))
+
+    def ignored(self, relative):
+        ignored = False
+        for negate, regex in self.rules:
+            if regex.match(relative):
+                ignored = not negate
+        return ignored
+
+
+def select_files(path, patterns=(), names=None):
+    """
+    Sorted relative paths of the files below path that go into the build
+    context, leaving out the ones excluded by its .rpmbuildignore and
+    patterns.  With names only top level files of these names are taken,
+    names holding unexpanded macros match any file name in their place.
+    """
+    rules = IgnoreRules.from_directory(path, patterns)
+    selected = []
+
+    if names is not None:
+        globs = [_pattern_re(MACRO_RE.sub('*', name)) for name in names]
+        for name in os.listdir(path):
+            if (name != IGNORE_FILE and
+                    not os.path.isdir(os.path.join(path, name)) and
+                    any(glob.match(name) for glob in globs) and
+                    not rules.ignored(name)):
+                selected.append(name)
+        return sorted(selected)
+
+    for root, dirs, files in os.walk(path):
+        relative_root = os.path.relpath(root, path)
+        if relative_root == '.':
+            relative_root = ''
+
+        for name in list(dirs):
+            relative = os.path.join(relative_root, name)
+            if os.path.islink(os.path.join(root, name)):
+                # Not walked into by os.walk, copied like a file.
+                dirs.remove(name)
+                files.append(name)
+            elif rules.ignored(relative) and not rules.reincludes:
+                dirs.remove(name)
+
+        for name in files:
+            relative = os.path.join(relative_root, name)
+            if relative != IGNORE_FILE and not rules.ignored(relative):
+                selected.append(relative)
+
+    return sorted(selected)
+
+
+class DownloadCache(object):
+    """
+    Remote sources downloaded on the host.  Files are stored by the SHA-256
+    of their contents, an index keyed by URL records which file a URL
+    resolved to along with its checksum, so no URL is downloaded twice.
+    """
+
+    def __init__(self, path, max_bytes=DOWNLOAD_CACHE_SIZE,
+                 workers=DOWNLOAD_WORKERS, timeout=DOWNLOAD_TIMEOUT):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.index = os.path.join(path, 'urls')
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.timeout = timeout
+
+        for directory in (self.objects, self.index):
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    if not os.path.isdir(directory):
+                        raise
+
+    def _entry(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.index, key + '.json')
+
+    def get(self, url):
+        """Path of the cached download of url, None on a miss."""
+        try:
+            with open(self._entry(url)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        path = os.path.join(self.objects, entry['sha256'], source_name(url))
+        if (not os.path.exists(path) or
+                os.path.getsize(path) != entry['size'] or
+                file_digest(path, 'sha256') != entry['sha256']):
+            # Evicted, or the stored file does not match its checksum.
+            return None
+
+        os.utime(path, None)
+        return path
+
+    def fetch(self, url):
+        """Return the path of url's contents, downloading it on a miss."""
+        path = self.get(url)
+        if path is not None:
+            return path
+
+        digest = hashlib.sha256()
+        size = 0
+        fd, partial = tempfile.mkstemp(dir=self.path, suffix='.partial')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                response = urlopen(url.split('#')[0], timeout=self.timeout)
+                try:
+                    for block in iter(lambda: response.read(BLOCK_SIZE), b''):
+                        digest.update(block)
+                        size += len(block)
+                        f.write(block)
+                finally:
+                    response.close()
+
+            directory = os.path.join(self.objects, digest.hexdigest())
+            try:
+                os.mkdir(directory)
+            except OSError:
+                # Same contents downloaded for another URL or build.
+                if not os.path.isdir(directory):
+                    raise
+            path = os.path.join(directory, source_name(url))
+            os.rename(partial, path)
+        except:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        fd, partial = tempfile.mkstemp(dir=self.index, suffix='.partial')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'url': url, 'sha256': digest.hexdigest(),
+                       'size': size}, f)
+        os.rename(partial, self._entry(url))
+
+        return path
+
+    def fetch_all(self, urls):
+        """
+        Fetch urls in parallel.  Returns the paths of the fetched files and
+        the errors of the failed ones, both as dicts keyed by URL.  Old
+        downloads are evicted first so the files returned stay in place.
+        Eviction locks the cache for itself, fetches only keep eviction by
+        other builds out.
+        """
+        with lock(self.path):
+            evict(self.objects, self.max_bytes)
+            _remove_empty(self.objects)
+
+        def fetch(url):
+            try:
+                return url, self.fetch(url), None
+            except Exception as e:
+                return url, None, e
+
+        pool = ThreadPool(max(min(self.workers, len(urls)), 1))
+        try:
+            with lock(self.path, shared=True):
+                results = pool.map(fetch, urls)
+        finally:
+            pool.close()
+            pool.join()
+
+        fetched = dict((url, path) for url, path, error in results if path)
+        failed = dict((url, error) for url, path, error in results if error)
+
+        return fetched, failed
+
+
+def _remove_empty(path):
+    for name in os.listdir(path):
+        try:
+            os.rmdir(os.path.join(path, name))
+        except OSError:
+            pass
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,251 @@
+"""
+Minimal RPM spec file reader.
+
+Only understands enough of the spec syntax to answer questions about a
+package before it is built inside a container.  Anything it cannot resolve
+on the host (conditionals, shell expansions, unknown macros) is skipped and
+left for rpmbuild itself to deal with.
+"""
+
+import re
+
+TAG_RE = re.compile(r'^([A-Za-z]+\d*)\s*(?:\(([^)]*)\))?\s*:\s*(.*)$')
+SECTION_RE = re.compile(
+    r'^%(package|description|prep|build|install|check|clean|files|'
+    r'changelog|pre|post|preun|postun|pretrans|posttrans|trigger\w*|'
+    r'verifyscript)\b(.*)$')
+DEFINE_RE = re.compile(r'^%(define|global)\s+(\w+)(?:\(.*?\))?\s+(.*)$')
+SOURCE_TAG_RE = re.compile(r'^(source|patch)\d*$')
+OPERATORS = ('<', '>', '=', '<=', '>=')
+
+
+class Spec(object):
+
+    def __init__(self, content, defines=None):
+        self.macros = {}
+        self.tags = []
+
+        for define in defines or []:
+            name, _, value = define.strip().partition(' ')
+            self.macros[name] = value.strip()
+
+        self._parse(content)
+
+    @classmethod
+    def from_file(cls, path, defines=None):
+        with open(path) as f:
+            return cls(f.read(), defines)
+
+    def _parse(self, content):
+        """
+        Walk the preamble of the main package and every %package section.
+        Tags nested inside %if blocks are recorded as conditional.
+        """
+        depth = 0
+        preamble = True
+
+        for line in content.splitlines():
+            line = line.strip()
+
+            if line.startswith('%if'):
+                depth += 1
+                continue
+            if line.startswith('%endif'):
+                depth = max(depth - 1, 0)
+                continue
+
+            section = SECTION_RE.match(line)
+            if section:
+                preamble = section.group(1) == 'package'
+                if preamble:
+                    self.tags.append(
+                        ('package', self.expand(section.group(2).strip()),
+                         depth > 0))
+                continue
+
+            if not preamble:
+                continue
+
+            define = DEFINE_RE.match(line)
+            if define:
+                if not depth:
+                    self.macros.setdefault(define.group(2),
+                                           define.group(3).strip())
+                continue
+
+            tag = TAG_RE.match(line)
+            if tag:
+                name = tag.group(1).lower()
+                value = self.expand(tag.group(3).strip())
+                if name in ('name', 'version', 'release') and not depth:
+                    self.macros.setdefault(name, value)
+                self.tags.append((name, value, depth > 0))
+
+    def expand(self, text):
+        """
+        Expand the macros we know about.  Unknown macros are left untouched
+        so callers can tell the value was not fully resolved.
+        """
+        result = []
+        i = 0
+
+        while i < len(text):
+            if text[i] != '%' or i + 1 == len(text):
+                result.append(text[i])
+                i += 1
+            elif text[i + 1] == '%':
+                result.append('%%')
+                i += 2
+            elif text[i + 1] == '{':
+                end = _closing_brace(text, i + 1)
+                if end is None:
+                    result.append(text[i:])
+                    break
+                result.append(self._expand_macro(text[i + 2:end],
+                                                 text[i:end + 1]))
+                i = end + 1
+            else:
+                match = re.match(r'\w+', text[i + 1:])
+                if match and match.group(0) in self.macros:
+                    result.append(self.expand(self.macros[match.group(0)]))
+                    i += 1 + match.end()
+                else:
+                    result.append(text[i])
+                    i += 1
+
+        return ''.join(result)
+
+    def _expand_macro(self, body, original):
+        negate = body.startswith('!?')
+        conditional = negate or body.startswith('?')
+
+        if conditional:
+            body = body[2:] if negate else body[1:]
+            name, _, value = body.partition(':')
+            defined = name in self.macros
+            if negate:
+                return self.expand(value) if not defined else ''
+            if value:
+                return self.expand(value) if defined else ''
+            return self.expand(self.macros[name]) if defined else ''
+
+        if body in self.macros:
+            return self.expand(self.macros[body])
+
+        return original
+
+    def values(self, tag, conditional=False):
+        for name, value, nested in self.tags:
+            if name == tag and (conditional or not nested):
+                yield value
+
+    @property
+    def build_requires(self):
+        """
+        Sorted, de-duplicated BuildRequires that could be fully resolved on
+        the host.  Conditional or macro-laden entries are left out.
+        """
+        requires = set()
+
+        for value in self.values('buildrequires'):
+            for dependency in _split_dependencies(value):
+                if '%' not in dependency and not dependency.startswith('('):
+                    requires.add(dependency)
+
+        return sorted(requires)
+
+    @property
+    def remote_sources(self):
+        """
+        URLs of every Source and Patch tag, conditional ones included, the
+        files spectool would download.  URLs with macros left unresolved are
+        kept as they are.
+        """
+        return [value for name, value, nested in self.tags
+                if SOURCE_TAG_RE.match(name) and '://' in value]
+
+    @property
+    def source_files(self):
+        """
+        File names rpmbuild looks up in SOURCES for every Source and Patch
+        tag, conditional ones included.
+        """
+        return [value.rstrip('/').rsplit('/', 1)[-1]
+                for name, value, nested in self.tags
+                if SOURCE_TAG_RE.match(name)]
+
+    @property
+    def name(self):
+        return self.macros.get('name')
+
+    @property
+    def build_requires_names(self):
+        """
+        Package names of every BuildRequires, conditional ones included, for
+        ordering builds against each other.
+        """
+        names = set()
+        for value in self.values('buildrequires', conditional=True):
+            names.update(_dependency_names(value))
+        return names
+
+    @property
+    def provides(self):
+        """
+        Names this spec provides: the main package, its subpackages and any
+        explicit Provides.
+        """
+        names = set()
+
+        if self.name:
+            names.add(self.name)
+
+        for value in self.values('package', conditional=True):
+            args = value.split()
+            if args[:1] == ['-n'] and len(args) > 1:
+                names.add(args[1])
+            elif args and self.name:
+                names.add('%s-%s' % (self.name, args[0]))
+
+        for value in self.values('provides', conditional=True):
+            names.update(_dependency_names(value))
+
+        return set(name for name in names if '%' not in name)
+
+
+def _closing_brace(text, start):
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == '{':
+            depth += 1
+        elif text[i] == '}':
+            depth -= 1
+            if not depth:
+                return i
+    return None
+
+
+def _split_dependencies(value):
+    """
+    Split a dependency list such as 'foo >= 1.0, bar baz' into individual
+    dependencies, keeping version constraints attached to their name.
+    """
+    tokens = value.replace(',', ' ').split()
+    dependencies = []
+
+    while tokens:
+        token = tokens.pop(0)
+        if tokens and tokens[0] in OPERATORS and len(tokens) > 1:
+            token = ' '.join([token, tokens.pop(0), tokens.pop(0)])
+        dependencies.append(token)
+
+    return dependencies
+
+
+def _dependency_names(value):
+    return set(dependency.split()[0]
+               for dependency in _split_dependencies(value)
+               if '%' not in dependency and not dependency.startswith('('))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,24 @@
+"""
+Coroutines driving AsyncPackager, kept out of aio_test.py so interpreters
+older than 3.6 can still compile the test module and skip it.
+"""
+
+import asyncio
+
+from rpmbuild.aio import AsyncPackager
+
+
+def run_builds(loop, api, contexts, log, **kwargs):
+    """Build every (context, output) pair on loop, returning their RPMs."""
+    async def build(context, output):
+        async with AsyncPackager(context, api=api, **kwargs) as p:
+            return await p.run(output, log=log)
+
+    async def build_all():
+        return await asyncio.gather(
+            *[build(context, output) for context, output in contexts])
+
+    return loop.run_until_complete(build_all())
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,113 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from rpmbuild import PackagerContext, PackagerException
+from rpmbuild.cache import ResultCache
+
+from fakedocker import FakeDocker
+
+if sys.version_info >= (3, 6):
+    import asyncio
+    from rpmbuild.aio import APIError, DockerAPI
+
+    import aio_helpers
+
+
+@unittest.skipIf(sys.version_info < (3, 6), 'asyncio packager needs 3.6')
+class AsyncPackagerTestCase(unittest.TestCase):
+    """Tests for aio.py against a fake docker daemon"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmp, 'out')
+        os.mkdir(self.output)
+        self.docker = FakeDocker(images=['centos:6', 'centos:7']).__enter__()
+        self.api = DockerAPI(self.docker.base_url, version='1.24', timeout=10)
+        self.loop = asyncio.new_event_loop()
+        self.logged = []
+
+    def tearDown(self):
+        self.loop.close()
+        self.docker.__exit__(None, None, None)
+        shutil.rmtree(self.tmp)
+
+    def spec(self, name):
+        path = os.path.join(self.tmp, '%s.spec' % name)
+        with open(path, 'w') as f:
+            f.write('Name: %s\nBuildRequires: gcc\n' % name)
+        return path
+
+    def run_builds(self, contexts, **kwargs):
+        return aio_helpers.run_builds(self.loop, self.api, contexts,
+                                      self.logged.append, **kwargs)
+
+    def test_run_builds_and_exports(self):
+        context = PackagerContext('centos:7', spec=self.spec('foo'))
+        exported, = self.run_builds([(context, self.output)])
+        self.assertEqual(sorted(os.path.basename(p) for p in exported),
+                         ['foo-1.0-1.noarch.rpm', 'foo-1.0-1.src.rpm'])
+        self.assertTrue('Wrote: /rpmbuild/RPMS/noarch/foo-1.0-1.noarch.rpm'
+                        in self.logged)
+        tags = [build[0] for build in self.docker.builds]
+        self.assertTrue(tags[-1].startswith('rpmbuild_foo.spec:'))
+        self.assertTrue(tags[0].startswith('rpmbuild_base:'))
+        self.assertTrue(tags[1].startswith('rpmbuild_deps:'))
+        self.assertEqual(self.docker.containers, {})
+
+    def test_concurrent_builds_share_one_loop(self):
+        contexts = []
+        for name in ('foo', 'bar', 'baz'):
+            output = os.path.join(self.output, name)
+            os.mkdir(output)
+            contexts.append((PackagerContext('centos:6', spec=self.spec(name)),
+                             output))
+        results = self.run_builds(contexts)
+        self.assertEqual([os.path.basename(r[0]) for r in results],
+                         ['foo-1.0-1.noarch.rpm', 'bar-1.0-1.noarch.rpm',
+                          'baz-1.0-1.noarch.rpm'])
+
+    def test_missing_base_image_is_pulled(self):
+        context = PackagerContext('fedora:22', spec=self.spec('foo'))
+        self.run_builds([(context, self.output)])
+        self.assertTrue(('POST', '/images/create') in self.docker.requests)
+
+    def test_failed_rpmbuild_raises(self):
+        self.docker.status = 1
+        context = PackagerContext('centos:7', spec=self.spec('foo'))
+        self.assertRaises(PackagerException, self.run_builds,
+                          [(context, self.output)])
+        self.assertEqual(self.docker.containers, {})
+
+    def test_result_cache_skips_second_build(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache'), 1024 * 1024)
+        os.mkdir(cache.path)
+        spec = self.spec('foo')
+        self.run_builds([(PackagerContext('centos:7', spec=spec), self.output)],
+                        result_cache=cache)
+        builds = len(self.docker.builds)
+        exported, = self.run_builds(
+            [(PackagerContext('centos:7', spec=spec), self.output)],
+            result_cache=cache)
+        self.assertEqual(len(self.docker.builds), builds)
+        self.assertEqual(len(exported), 2)
+
+    def test_identical_context_reuses_image(self):
+        spec = self.spec('foo')
+        self.run_builds([(PackagerContext('centos:7', spec=spec), self.output)])
+        builds = len(self.docker.builds)
+        self.run_builds([(PackagerContext('centos:7', spec=spec), self.output)])
+        self.assertEqual(len(self.docker.builds), builds)
+        self.assertTrue(any(line.startswith('Using image rpmbuild_foo.spec:')
+                            for line in self.logged))
+
+    def test_api_errors_carry_status(self):
+        call = self.api.call('GET', '/images/nonexistent/json')
+        with self.assertRaises(APIError) as raised:
+            self.loop.run_until_complete(call)
+        self.assertEqual(raised.exception.status, 404)
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
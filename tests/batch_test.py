@@ -0,0 +1,234 @@
+from mock import patch
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from rpmbuild import PackagerException
+from rpmbuild.batch import Batch, Result, load_manifest, summary
+
+
+class BatchTestCase(unittest.TestCase):
+    """Tests for batch.py"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.tmp, 'manifest.json')
+        self.docker_client_patcher = patch('docker.Client')
+        self.docker_client = self.docker_client_patcher.start()
+
+    def tearDown(self):
+        self.docker_client_patcher.stop()
+        shutil.rmtree(self.tmp)
+
+    def write_manifest(self, jobs):
+        with open(self.manifest, 'w') as f:
+            json.dump(jobs, f)
+
+    def test_load_manifest_resolves_relative_paths(self):
+        self.write_manifest([{'image': 'centos:7', 'spec': 'foo/foo.spec',
+                              'sources': ['foo/foo.tar.gz']}])
+        job, = load_manifest(self.manifest)
+        self.assertEqual(job['spec'], os.path.join(self.tmp, 'foo/foo.spec'))
+        self.assertEqual(job['sources'],
+                         [os.path.join(self.tmp, 'foo/foo.tar.gz')])
+        self.assertEqual(job['macrofiles'], [])
+
+    def test_load_manifest_requires_image_and_spec_or_srpm(self):
+        self.write_manifest([{'image': 'centos:7'}])
+        self.assertRaises(PackagerException, load_manifest, self.manifest)
+        self.write_manifest({'image': 'centos:7', 'spec': 'foo.spec'})
+        self.assertRaises(PackagerException, load_manifest, self.manifest)
+
+    @patch('rpmbuild.batch.publish')
+    @patch('rpmbuild.batch.Packager')
+    def test_batch_shares_client_and_prefixes_logs(self, Packager, publish):
+        lines = []
+        packager = Packager.return_value.__enter__.return_value
+        packager.run.side_effect = lambda output, log, bind_output: (
+            log('building'), ['/out/foo.rpm'])[1]
+        jobs = [{'image': 'centos:7', 'spec': '/foo.spec', 'output': self.tmp},
+                {'image': 'centos:7', 'srpm': '/bar.src.rpm', 'name': 'bar',
+                 'output': self.tmp}]
+
+        results = Batch(jobs, {}, concurrency=2, log=lines.append).run()
+
+        self.assertEqual(results, [Result('foo.spec', ['/out/foo.rpm'], None),
+                                   Result('bar', ['/out/foo.rpm'], None)])
+        self.assertEqual(self.docker_client.call_count, 1)
+        for call in Packager.call_args_list:
+            self.assertEqual(call[1]['client'], self.docker_client.return_value)
+        self.assertEqual(sorted(lines), ['[bar] building', '[foo.spec] building'])
+
+    @patch('rpmbuild.batch.Packager')
+    def test_batch_records_failures(self, Packager):
+        packager = Packager.return_value.__enter__.return_value
+        packager.run.side_effect = PackagerException
+        jobs = [{'image': 'centos:7', 'spec': '/foo.spec', 'output': self.tmp}]
+
+        results = Batch(jobs, {}, log=lambda line: None).run()
+
+        self.assertEqual(results, [Result('foo.spec', [], 'PackagerException')])
+
+    @patch('rpmbuild.batch.Packager')
+    def test_batch_writes_job_logs(self, Packager):
+        lines = []
+        packager = Packager.return_value.__enter__.return_value
+        packager.run.side_effect = lambda output, log, bind_output: (
+            log('building'), log('warning'), [])[2]
+        log_dir = os.path.join(self.tmp, 'logs')
+        jobs = [{'image': 'centos:7', 'spec': '/foo.spec', 'output': self.tmp}]
+
+        Batch(jobs, {}, log=lines.append, log_dir=log_dir).run()
+
+        with open(os.path.join(log_dir, 'foo.spec.log')) as f:
+            self.assertEqual(f.read(), 'building\nwarning\n')
+        self.assertEqual(lines[0], '[foo.spec] building')
+        self.assertTrue(lines[-1].startswith('[foo.spec] Wrote 2 lines to'))
+
+    @patch('rpmbuild.batch.Packager')
+    def test_batch_job_logs_of_same_spec_name_are_kept_apart(self, Packager):
+        packager = Packager.return_value.__enter__.return_value
+        packager.run.return_value = []
+        log_dir = os.path.join(self.tmp, 'logs')
+        jobs = [{'image': 'centos:7', 'spec': '/a/foo.spec', 'output': self.tmp},
+                {'image': 'centos:7', 'spec': '/b/foo.spec', 'output': self.tmp},
+                {'image': 'centos:7', 'spec': '/bar.spec', 'output': self.tmp}]
+
+        Batch(jobs, {}, log=lambda line: None, log_dir=log_dir).run()
+
+        self.assertEqual(sorted(os.listdir(log_dir)),
+                         ['bar.spec.log', 'foo.spec-1.log', 'foo.spec-2.log'])
+
+    @patch('rpmbuild.batch.Packager')
+    def test_batch_tolerates_output_created_by_another_job(self, Packager):
+        packager = Packager.return_value.__enter__.return_value
+        packager.run.return_value = ['/out/foo.rpm']
+        output = os.path.join(self.tmp, 'out')
+
+        def makedirs(path):
+            os.mkdir(path)
+            raise OSError('File exists')
+        jobs = [{'image': 'centos:7', 'spec': '/foo.spec', 'output': output}]
+
+        with patch('os.makedirs', side_effect=makedirs):
+            results = Batch(jobs, {}, log=lambda line: None).run()
+
+        self.assertEqual(results, [Result('foo.spec', ['/out/foo.rpm'], None)])
+
+    def write_spec(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    @patch('rpmbuild.batch.Packager')
+    def test_batch_builds_dependencies_first_through_local_repo(self, Packager):
+        contexts = []
+        def run(output, log, bind_output):
+            context = Packager.call_args[0][0]
+            contexts.append((str(context), context.repo,
+                             context.repo and sorted(os.listdir(context.repo))))
+            rpm = os.path.join(output, os.path.basename(str(context)) + '.rpm')
+            with open(rpm, 'w') as f:
+                f.write('rpm')
+            return [rpm]
+        Packager.return_value.__enter__.return_value.run.side_effect = run
+        app = self.write_spec('app.spec', 'Name: app\nBuildRequires: libfoo-devel\n')
+        lib = self.write_spec('lib.spec', 'Name: libfoo\n%package devel\nSummary: x\n')
+        other = self.write_spec('other.spec', 'Name: other\n')
+        jobs = [{'image': 'centos:7', 'spec': spec, 'output': self.tmp}
+                for spec in (app, lib, other)]
+
+        results = Batch(jobs, {}, concurrency=1, log=lambda line: None).run()
+
+        self.assertEqual([r.error for r in results], [None, None, None])
+        self.assertEqual(contexts[:2], [(lib, None, None), (other, None, None)])
+        self.assertEqual(contexts[2][0], app)
+        self.assertEqual(contexts[2][2], ['lib.spec.rpm'])
+        self.assertFalse(os.path.exists(contexts[2][1]))
+
+    @patch('rpmbuild.batch.Packager')
+    def test_batch_repos_hold_only_transitive_providers(self, Packager):
+        repos = {}
+        def run(output, log, bind_output):
+            context = Packager.call_args[0][0]
+            name = os.path.basename(str(context))
+            repos[name] = context.repo and sorted(os.listdir(context.repo))
+            rpm = os.path.join(output, name + '.rpm')
+            with open(rpm, 'w') as f:
+                f.write('rpm')
+            return [rpm]
+        Packager.return_value.__enter__.return_value.run.side_effect = run
+        specs = [self.write_spec('app.spec', 'Name: app\nBuildRequires: mid\n'),
+                 self.write_spec('mid.spec', 'Name: mid\nBuildRequires: base\n'),
+                 self.write_spec('base.spec', 'Name: base\n'),
+                 self.write_spec('tool.spec', 'Name: tool\nBuildRequires: other\n'),
+                 self.write_spec('other.spec', 'Name: other\n')]
+        jobs = [{'image': 'centos:7', 'spec': spec, 'output': self.tmp}
+                for spec in specs]
+
+        Batch(jobs, {}, concurrency=1, log=lambda line: None).run()
+
+        self.assertEqual(repos, {
+            'app.spec': ['base.spec.rpm', 'mid.spec.rpm'],
+            'mid.spec': ['base.spec.rpm'],
+            'base.spec': None,
+            'tool.spec': ['other.spec.rpm'],
+            'other.spec': None})
+
+    @patch('rpmbuild.batch.Packager')
+    def test_batch_skips_jobs_with_failed_dependencies(self, Packager):
+        Packager.return_value.__enter__.return_value.run.side_effect = \
+            PackagerException('boom')
+        app = self.write_spec('app.spec', 'Name: app\nBuildRequires: libfoo\n')
+        lib = self.write_spec('lib.spec', 'Name: libfoo\n')
+        jobs = [{'image': 'centos:7', 'spec': spec, 'output': self.tmp}
+                for spec in (app, lib)]
+
+        results = Batch(jobs, {}, log=lambda line: None).run()
+
+        self.assertEqual(results, [
+            Result('app.spec', [], 'Dependency failed: lib.spec'),
+            Result('lib.spec', [], 'boom')])
+        self.assertEqual(Packager.call_count, 1)
+
+    @patch('rpmbuild.batch.Packager')
+    def test_batch_runs_as_many_jobs_as_fit_on_the_host(self, Packager):
+        self.docker_client.return_value.info.return_value = {
+            'NCPU': 4, 'MemTotal': 64 * 1024 * 1024 * 1024}
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def run(output, log, bind_output):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+            return []
+        Packager.return_value.__enter__.return_value.run.side_effect = run
+        jobs = [{'image': 'centos:7', 'srpm': '/foo%d.src.rpm' % i,
+                 'output': self.tmp} for i in range(4)]
+        jobs[0]['cpus'] = 4
+
+        Batch(jobs, {}, log=lambda line: None).run()
+
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(sorted(call[1]['resources'].cpus
+                                for call in Packager.call_args_list),
+                         [2.0, 2.0, 2.0, 4.0])
+
+    def test_summary(self):
+        lines = summary([Result('foo.spec', ['a.rpm', 'b.rpm'], None),
+                         Result('bar.spec', [], 'boom')])
+        self.assertEqual(lines, ['Summary:',
+                                 '  OK      foo.spec (2 RPMs)',
+                                 '  FAILED  bar.spec: boom'])
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
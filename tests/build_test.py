@@ -0,0 +1,131 @@
+from mock import MagicMock, patch
+import unittest
+
+from docopt import docopt
+
+from rpmbuild import build
+from rpmbuild import PackagerException
+from rpmbuild.build import apply_profile, build_job, matrix_jobs
+from rpmbuild.config import PROFILES
+
+
+class BuildTestCase(unittest.TestCase):
+    """Tests for build.py"""
+
+    def parse(self, argv):
+        return docopt(build.__doc__, argv=argv)
+
+    def test_build_accepts_several_images(self):
+        args = self.parse(['build', '--spec=foo.spec', '--source=foo.tar.gz',
+                           'centos:6', 'centos:7'])
+        self.assertEqual(args['<image>'], ['centos:6', 'centos:7'])
+
+    def test_build_job(self):
+        args = self.parse(['build', '--spec=foo.spec', '--source=foo.tar.gz',
+                           '--output=out', 'centos:7'])
+        job = build_job(args)
+        self.assertEqual(job['spec'], 'foo.spec')
+        self.assertEqual(job['sources'], ['foo.tar.gz'])
+        self.assertEqual(job['output'], 'out')
+
+    def test_build_job_filters_sources_dir(self):
+        args = self.parse(['build', '--spec=foo.spec', '--sources-dir=SOURCES',
+                           '--sources-ignore=*.rpm', '--sources-ignore=.git',
+                           '--referenced-sources', 'centos:7'])
+        job = build_job(args)
+        self.assertEqual(job['sources_ignore'], ['*.rpm', '.git'])
+        self.assertTrue(job['referenced_sources'])
+
+    def test_apply_profile(self):
+        args = self.parse(['build', '--spec=foo.spec', '--source=foo.tar.gz',
+                           '--profile=dev', 'centos:7'])
+        job = apply_profile(build_job(args), PROFILES, 'release')
+        self.assertEqual(job['profile'], PROFILES['dev'])
+        self.assertEqual(apply_profile({}, PROFILES, 'release')['profile'],
+                         PROFILES['release'])
+        self.assertRaises(PackagerException, apply_profile,
+                          {'profile': 'fast'}, PROFILES, 'release')
+
+    def test_dev_build_options(self):
+        args = self.parse(['build', '--spec=foo.spec', '--source=foo.tar.gz',
+                           '--dev', '--stage=install', 'centos:7'])
+        with patch('rpmbuild.build.cache_dir'):
+            options = build.packager_options(args)
+        self.assertTrue(options['dev'])
+        self.assertEqual(options['stage'], 'install')
+
+    def test_matrix_jobs_share_context_image(self):
+        jobs = matrix_jobs({'spec': 'foo.spec', 'output': 'out'},
+                           ['centos:6', 'centos:7'], 'rpmbuild_context:abc')
+        self.assertEqual([job['image'] for job in jobs],
+                         ['centos:6', 'centos:7'])
+        self.assertEqual([job['output'] for job in jobs],
+                         ['out/centos_6', 'out/centos_7'])
+        self.assertEqual(set(job['context_image'] for job in jobs),
+                         set(['rpmbuild_context:abc']))
+
+    @patch('rpmbuild.build.collect')
+    @patch('docker.Client')
+    def test_gc_collects_images(self, Client, collect):
+        collect.return_value = 0
+        argv = ['docker-rpmbuild', 'gc', '--image-cache-size=100',
+                '--dangling']
+        with patch('sys.argv', argv):
+            with patch('rpmbuild.build.cache_dir'):
+                build.main()
+        client, usage, max_bytes = collect.call_args[0]
+        self.assertEqual(max_bytes, 100 * 1024 * 1024)
+        self.assertTrue(collect.call_args[1]['dangling'])
+
+    @patch('rpmbuild.build.Batch')
+    @patch('rpmbuild.build.Packager')
+    @patch('docker.Client')
+    def test_main_uploads_context_once_for_matrix(self, Client, Packager,
+                                                  Batch):
+        packager = Packager.return_value.__enter__.return_value
+        packager.upload_context.return_value = 'rpmbuild_context:abc'
+        Batch.return_value.run.return_value = []
+        argv = ['docker-rpmbuild', 'build', '--spec=foo.spec', '--no-cache',
+                '--source=foo.tar.gz', 'centos:6', 'centos:7']
+        with patch('sys.argv', argv):
+            build.main()
+        self.assertEqual(packager.upload_context.call_count, 1)
+        jobs = Batch.call_args[0][0]
+        self.assertEqual([job['context_image'] for job in jobs],
+                         ['rpmbuild_context:abc'] * 2)
+
+    @patch('rpmbuild.build.write_metrics')
+    @patch('rpmbuild.build.job_context')
+    @patch('rpmbuild.build.dispatcher')
+    @patch('rpmbuild.build.Packager')
+    def test_main_builds_fresh_context_per_attempt(self, Packager, dispatcher,
+                                                   job_context, write_metrics):
+        def run(resources, build):
+            # The first attempt fails half way, the job starts over.
+            build(MagicMock(), None)
+            return build(MagicMock(), None)
+        dispatcher.return_value.run.side_effect = run
+        job_context.side_effect = lambda job: MagicMock()
+        Packager.return_value.__enter__.return_value.run.return_value = []
+        argv = ['docker-rpmbuild', 'build', '--spec=foo.spec', '--no-cache',
+                '--source=foo.tar.gz', 'centos:7']
+        with patch('sys.argv', argv):
+            build.main()
+
+        first, second = [call[0][0] for call in Packager.call_args_list]
+        self.assertFalse(first is second)
+        self.assertEqual(write_metrics.call_args[0][1], [second.metrics])
+
+    @patch('rpmbuild.build.BuildLog')
+    @patch('rpmbuild.build.dispatcher')
+    def test_main_closes_log_on_unexpected_errors(self, dispatcher, BuildLog):
+        dispatcher.return_value.run.side_effect = RuntimeError('boom')
+        argv = ['docker-rpmbuild', 'build', '--spec=foo.spec', '--no-cache',
+                '--source=foo.tar.gz', '--log-dir=logs', 'centos:7']
+        with patch('sys.argv', argv):
+            with patch('rpmbuild.build.log_path'):
+                self.assertRaises(RuntimeError, build.main)
+        BuildLog.return_value.close.assert_called_with(failed=True)
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
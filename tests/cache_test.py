@@ -0,0 +1,98 @@
+from mock import patch
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from rpmbuild.cache import (CACHE_ENV, ResultCache, cache_dir, cache_key,
+                            evict, lock)
+
+
+class CacheTestCase(unittest.TestCase):
+    """Tests for cache.py"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, size, used):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(b'0' * size)
+        os.utime(path, (used, used))
+        return path
+
+    def test_cache_dir_is_created_below_cache_root(self):
+        with patch.dict(os.environ, {CACHE_ENV: self.tmp}):
+            path = cache_dir('yum', 'centos_7')
+        self.assertEqual(path, os.path.join(self.tmp, 'yum', 'centos_7'))
+        self.assertTrue(os.path.isdir(path))
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key('registry:5000/centos:7'),
+                         'registry_5000_centos_7')
+
+    def test_evict_removes_least_recently_used_first(self):
+        self.write('old.rpm', 100, 1000)
+        self.write('new.rpm', 100, 3000)
+        self.write('mid.rpm', 100, 2000)
+        self.write('repomd.xml', 100, 0)
+
+        self.assertEqual(evict(self.tmp, 150, suffix='.rpm'), 200)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['new.rpm', 'repomd.xml'])
+
+    def test_evict_keeps_everything_under_limit(self):
+        self.write('foo.rpm', 100, 1000)
+        self.assertEqual(evict(self.tmp, 100), 0)
+        self.assertEqual(os.listdir(self.tmp), ['foo.rpm'])
+
+    def test_shared_locks_keep_exclusive_ones_out(self):
+        events = []
+
+        def exclusive():
+            with lock(self.tmp):
+                events.append('exclusive')
+
+        with lock(self.tmp, shared=True):
+            with lock(self.tmp, shared=True):
+                thread = threading.Thread(target=exclusive)
+                thread.start()
+                time.sleep(0.1)
+                events.append('shared')
+        thread.join()
+        self.assertEqual(events, ['shared', 'exclusive'])
+
+    def test_result_cache_round_trip_keeps_layout(self):
+        cache = ResultCache(os.path.join(self.tmp, 'results'), 1024)
+        os.makedirs(cache.path)
+        output = os.path.join(self.tmp, 'out')
+        os.makedirs(os.path.join(output, 'RPMS', 'noarch'))
+        rpm = os.path.join(output, 'RPMS', 'noarch', 'foo.rpm')
+        with open(rpm, 'w') as f:
+            f.write('rpm')
+
+        self.assertFalse('abc' in cache)
+        self.assertEqual(cache.get('abc', output), None)
+        cache.put('abc', [rpm], output)
+        shutil.rmtree(output)
+
+        self.assertTrue('abc' in cache)
+        self.assertEqual(cache.get('abc', output), [rpm])
+        with open(rpm) as f:
+            self.assertEqual(f.read(), 'rpm')
+
+    def test_result_cache_evicts_whole_entries(self):
+        cache = ResultCache(os.path.join(self.tmp, 'results'), 150)
+        os.makedirs(cache.path)
+        for key, used in (('old', 1000), ('new', 2000)):
+            rpm = self.write('%s.rpm' % key, 100, used)
+            cache.put(key, [rpm], self.tmp)
+            os.utime(os.path.join(cache.path, key), (used, used))
+        cache.evict()
+        self.assertEqual(os.listdir(cache.path), ['new'])
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
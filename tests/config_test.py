@@ -1,7 +1,9 @@
 from collections import defaultdict
 import unittest
 import mock
-from rpmbuild.config import read_config, get_docker_config, DEFAULT_TIMEOUT
+from rpmbuild.config import (read_config, read_hosts, read_profiles,
+                             get_docker_config, get_docker_configs,
+                             DEFAULT_TIMEOUT, PROFILES)
 
 
 class ConfigTestCase(unittest.TestCase):
@@ -142,3 +144,44 @@ version=1.11
 
             config = get_docker_config(docopt_with_timeout_and_with_config)
             self.assertEqual(config.get('timeout'), 48)
+
+    def test_read_profiles_adds_and_overrides_profiles(self):
+        profiles = read_profiles("""[profile:dev]
+options = --nocheck --without=docs
+
+[profile:nodebug]
+define = debug_package %{nil}
+    _binary_payload w2.xzdio
+""")
+        self.assertEqual(profiles['release'], PROFILES['release'])
+        self.assertEqual(profiles['dev'].defines, PROFILES['dev'].defines)
+        self.assertEqual(profiles['dev'].options,
+                         ['--nocheck', '--without=docs'])
+        self.assertEqual(profiles['nodebug'].defines,
+                         ['debug_package %{nil}', '_binary_payload w2.xzdio'])
+        self.assertEqual(profiles['nodebug'].stage, '-ba')
+
+    def test_read_profiles_rejects_unknown_stage(self):
+        self.assertRaises(ValueError, read_profiles,
+                          "[profile:dev]\nstage = --rebuild\n")
+
+    def test_read_hosts(self):
+        self.assertEqual(read_hosts(self.config_containg_all_attributes_valid),
+                         [])
+        self.assertEqual(read_hosts("""[docker]
+hosts = tcp://build1:2375, tcp://build2:2375
+    unix://var/run/docker.sock
+"""), ['tcp://build1:2375', 'tcp://build2:2375',
+       'unix://var/run/docker.sock'])
+
+    def test_get_docker_configs_one_per_host(self):
+        args = dict(self.docopt_with_only_config_file_without_timeout,
+                    **{'--config': None,
+                       '--docker-host': ['tcp://a:2375', 'tcp://b:2375']})
+        configs = get_docker_configs(args)
+        self.assertEqual([c['base_url'] for c in configs],
+                         ['tcp://a:2375', 'tcp://b:2375'])
+        self.assertEqual(configs[0]['timeout'], int(DEFAULT_TIMEOUT))
+
+        args['--docker-host'] = []
+        self.assertEqual(len(get_docker_configs(args)), 1)
@@ -0,0 +1,137 @@
+from mock import MagicMock
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from rpmbuild.batch import Batch
+from rpmbuild.dispatch import Dispatcher, DockerHost
+from rpmbuild.scheduler import Resources
+
+from fakedocker import FakeDocker
+
+
+def unused_url():
+    """URL of a local port nothing listens on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'tcp://127.0.0.1:%d' % port
+
+
+class DispatchTestCase(unittest.TestCase):
+    """Tests for dispatch.py against several fake docker daemons"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.daemons = [FakeDocker().__enter__() for i in range(2)]
+        self.lines = []
+
+    def tearDown(self):
+        for daemon in self.daemons:
+            daemon.__exit__(None, None, None)
+        shutil.rmtree(self.tmp)
+
+    def config(self, url):
+        return {'base_url': url, 'version': '1.24', 'timeout': 10}
+
+    def jobs(self, count, cpus=4):
+        jobs = []
+        for i in range(count):
+            spec = os.path.join(self.tmp, 'foo%d.spec' % i)
+            with open(spec, 'w') as f:
+                f.write('Name: foo%d\n' % i)
+            jobs.append({'image': 'centos:7', 'spec': spec, 'cpus': cpus,
+                         'output': os.path.join(self.tmp, 'out')})
+        return jobs
+
+    def run_batch(self, jobs, urls):
+        return Batch(jobs, [self.config(url) for url in urls],
+                     log=self.lines.append).run()
+
+    def built(self, daemon):
+        return [tag for tag, dockerfile, names in daemon.builds
+                if not tag.startswith('rpmbuild_base')]
+
+    def test_jobs_spread_over_hosts(self):
+        results = self.run_batch(self.jobs(2),
+                                 [d.base_url for d in self.daemons])
+        self.assertEqual([r.error for r in results], [None, None])
+        self.assertEqual([len(self.built(d)) for d in self.daemons], [1, 1])
+
+    def test_unreachable_host_is_skipped(self):
+        results = self.run_batch(self.jobs(2),
+                                 [unused_url(), self.daemons[1].base_url])
+        self.assertEqual([r.error for r in results], [None, None])
+        self.assertEqual(len(self.built(self.daemons[1])), 2)
+
+    def test_job_moves_to_another_host_when_its_host_fails(self):
+        self.daemons[0].broken = True
+        result, = self.run_batch(self.jobs(1),
+                                 [d.base_url for d in self.daemons])
+        self.assertEqual(result.error, None)
+        self.assertEqual(len(result.exported), 2)
+        self.assertEqual(len(self.built(self.daemons[1])), 1)
+        self.assertTrue(any('trying another one' in line
+                            for line in self.lines))
+
+    def test_job_fails_when_every_host_failed(self):
+        for daemon in self.daemons:
+            daemon.broken = True
+        result, = self.run_batch(self.jobs(1),
+                                 [d.base_url for d in self.daemons])
+        self.assertTrue(result.error.startswith('No healthy docker host'))
+
+
+class DispatcherTestCase(unittest.TestCase):
+    """Tests for the Dispatcher of dispatch.py with mocked clients"""
+
+    def host(self, name):
+        client = MagicMock()
+        client.info.return_value = {'NCPU': 4, 'MemTotal': 8 * 1024 ** 3}
+        return DockerHost({'base_url': name}, client=client)
+
+    def test_hosts_are_probed_outside_the_lock(self):
+        host = self.host('a')
+        dispatcher = Dispatcher([host], log=lambda line: None)
+        free = []
+
+        def try_lock():
+            if dispatcher.condition.acquire(False):
+                dispatcher.condition.release()
+                free.append(True)
+            else:
+                free.append(False)
+
+        def info():
+            # A probe under the condition would block other threads.
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            return {'NCPU': 4, 'MemTotal': 8 * 1024 ** 3}
+        host.client.info.side_effect = info
+
+        self.assertEqual(dispatcher.run(Resources(1.0, 0),
+                                        lambda host, share: str(host)), 'a')
+        self.assertEqual(free, [True])
+
+    def test_timeouts_move_the_job_to_another_host(self):
+        hosts = [self.host('a'), self.host('b')]
+        dispatcher = Dispatcher(hosts, log=lambda line: None)
+
+        def build(host, share):
+            if str(host) == 'a':
+                raise requests.exceptions.ReadTimeout('read timed out')
+            return str(host)
+
+        self.assertEqual(dispatcher.run(Resources(4.0, 0), build), 'b')
+        self.assertTrue(hosts[0].failed_at is not None)
+        self.assertEqual([h.running for h in hosts], [0, 0])
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,354 @@
+"""
+In-process fake of the docker remote API, just enough of it to build
+images, run containers and copy their results out.  Builds "succeed" by
+tagging a new image; containers log a few lines and leave RPMs named after
+the spec behind.
+
+Request and response bodies are streamed, so the fake also serves as the
+daemon of the benchmarks with their multi-GB contexts and RPMs.
+"""
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlsplit
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlsplit
+
+import hashlib
+import itertools
+import json
+import os
+import re
+import struct
+import tarfile
+import threading
+import time
+
+VERSION_PREFIX = re.compile(r'^/v[0-9.]+')
+BLOCK = 1024 * 1024
+ZEROS = b'\0' * BLOCK
+LOG_BATCH = 1000
+
+
+class FakeDocker(ThreadingMixIn, HTTPServer):
+    """
+    Serve the fake API on a local TCP port.
+
+    delay        seconds slept between the lines of build and log streams
+    status       exit status of every container
+    log_lines    number of lines every container logs
+    rpm_size     size of every RPM, None for a few bytes of content
+    broken       hang up on every build request, like a crashing daemon
+    """
+
+    daemon_threads = True
+
+    def __init__(self, images=('centos:7',), delay=0, status=0, log_lines=0,
+                 rpm_size=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.delay = delay
+        self.status = status
+        self.log_lines = log_lines
+        self.rpm_size = rpm_size
+        self.broken = False
+        self.lock = threading.Lock()
+        self.images = {}
+        self.containers = {}
+        self.ids = itertools.count()
+        self.builds = []
+        self.requests = []
+        for image in images:
+            self.add_image(image)
+
+    @property
+    def base_url(self):
+        return 'tcp://127.0.0.1:%d' % self.server_address[1]
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
+
+    def add_image(self, tag, spec=None):
+        if ':' not in tag:
+            tag += ':latest'
+        digest = hashlib.sha256(tag.encode('utf-8')).hexdigest()
+        with self.lock:
+            self.images[tag] = {'Id': 'sha256:' + digest, 'spec': spec}
+
+    def find_image(self, name):
+        with self.lock:
+            for tag, image in self.images.items():
+                if name in (tag, tag.split(':')[0] if tag.endswith(':latest')
+                            else None, image['Id'], image['Id'][7:]):
+                    return tag, image
+        return None, None
+
+    def rpms(self, name):
+        """Paths and sizes of the RPMs a container of name leaves behind."""
+        return [('/rpmbuild/RPMS/noarch/%s-1.0-1.noarch.rpm' % name,
+                 self.rpm_size or 3),
+                ('/rpmbuild/SRPMS/%s-1.0-1.src.rpm' % name,
+                 self.rpm_size or 4)]
+
+
+class Body(object):
+    """File-like view of a request body, decoding chunked encoding."""
+
+    def __init__(self, rfile, headers):
+        self.rfile = rfile
+        self.chunked = headers.get('Transfer-Encoding') == 'chunked'
+        self.remaining = 0 if self.chunked else int(
+            headers.get('Content-Length') or 0)
+        self.done = False
+
+    def read(self, size=-1):
+        data = []
+        while size != 0 and not self.done:
+            if not self.remaining:
+                if not self.chunked:
+                    self.done = True
+                    break
+                self.remaining = int(self.rfile.readline().split(b';')[0], 16)
+                if not self.remaining:
+                    self.rfile.readline()
+                    self.done = True
+                    break
+            wanted = self.remaining if size < 0 else min(size, self.remaining)
+            chunk = self.rfile.read(wanted)
+            self.remaining -= len(chunk)
+            if self.chunked and not self.remaining:
+                self.rfile.readline()
+            data.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(data)
+
+    def drain(self):
+        while self.read(BLOCK):
+            pass
+
+
+def tar_stream(files):
+    """Generate an uncompressed tar of (path, size) zero filled files."""
+    for path, size in files:
+        info = tarfile.TarInfo(path)
+        info.size = size
+        yield info.tobuf(tarfile.USTAR_FORMAT)
+        while size:
+            block = min(size, BLOCK)
+            yield ZEROS[:block]
+            size -= block
+        if info.size % tarfile.BLOCKSIZE:
+            yield ZEROS[:tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE]
+    yield ZEROS[:tarfile.BLOCKSIZE * 2]
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        path = VERSION_PREFIX.sub('', unquote(url.path))
+        self.query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        self.body = Body(self.rfile, self.headers)
+        self.server.requests.append((method, path))
+
+        if self.server.broken and (method, path) == ('POST', '/build'):
+            self.close_connection = True
+            return
+
+        routes = [
+            ('GET', r'/info$', self.info),
+            ('GET', r'/images/json$', self.images),
+            ('GET', r'/images/(.+)/json$', self.inspect_image),
+            ('POST', r'/images/create$', self.pull),
+            ('POST', r'/build$', self.build),
+            ('POST', r'/containers/create$', self.create),
+            ('GET', r'/containers/([^/]+)/json$', self.inspect_container),
+            ('POST', r'/containers/([^/]+)/start$', self.start),
+            ('GET', r'/containers/([^/]+)/logs$', self.logs),
+            ('POST', r'/containers/([^/]+)/wait$', self.wait),
+            ('GET', r'/containers/([^/]+)/archive$', self.archive),
+            ('DELETE', r'/containers/([^/]+)$', self.remove),
+        ]
+        for route_method, pattern, handler in routes:
+            match = re.match(pattern, path)
+            if method == route_method and match:
+                handler(*match.groups())
+                break
+        else:
+            self.send_json({'message': 'No route for %s' % path}, 404)
+
+        self.body.drain()
+
+    def request_json(self):
+        return json.loads(self.body.read().decode('utf-8'))
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status=204):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_stream(self, chunks, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(('%x\r\n' % len(chunk)).encode('ascii'))
+            self.wfile.write(chunk)
+            self.wfile.write(b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def paced(self, items):
+        for item in items:
+            if self.server.delay:
+                time.sleep(self.server.delay)
+            yield item
+
+    def container(self, container):
+        with self.server.lock:
+            return self.server.containers.get(container)
+
+    def info(self):
+        self.send_json({'NCPU': 4, 'MemTotal': 8 * 1024 * BLOCK})
+
+    def images(self):
+        name = self.query.get('filter')
+        with self.server.lock:
+            images = [{'Id': image['Id'], 'RepoTags': [tag]}
+                      for tag, image in self.server.images.items()
+                      if name is None or tag.split(':')[0] == name]
+        self.send_json(images)
+
+    def inspect_image(self, name):
+        tag, image = self.server.find_image(name)
+        if image is None:
+            return self.send_json({'message': 'No such image: %s' % name}, 404)
+        self.send_json({'Id': image['Id'], 'RepoTags': [tag]})
+
+    def pull(self):
+        image = self.query['fromImage'] + ':' + self.query.get('tag', 'latest')
+        self.server.add_image(image)
+        self.send_stream([json.dumps({'status': 'Pulled %s' % image})
+                          .encode('utf-8')])
+
+    def build(self):
+        names = []
+        dockerfile = ''
+        # Read the context as a stream, contents other than the Dockerfile
+        # are skipped without being kept.
+        with tarfile.open(fileobj=self.body, mode='r|') as tar:
+            for member in tar:
+                names.append(member.name)
+                if member.name == 'Dockerfile':
+                    dockerfile = tar.extractfile(member).read().decode('utf-8')
+        self.server.builds.append((self.query['t'], dockerfile, names))
+
+        spec = re.search(r'^\s*CMD rpmbuild .* /rpmbuild/SPECS/(\S+)\.spec',
+                         dockerfile, re.M)
+        self.server.add_image(self.query['t'], spec and spec.group(1))
+
+        steps = [line.strip() for line in dockerfile.splitlines()
+                 if line.strip()]
+        lines = ['Step %d : %s\n' % (i + 1, step)
+                 for i, step in enumerate(steps)]
+        lines.append('Successfully built %s\n' % self.query['t'])
+        self.send_stream(json.dumps({'stream': line}).encode('utf-8') + b'\r\n'
+                         for line in self.paced(lines))
+
+    def create(self):
+        request = self.request_json()
+        tag, image = self.server.find_image(request['Image'])
+        if image is None:
+            return self.send_json({'message': 'No such image'}, 404)
+        with self.server.lock:
+            container = hashlib.sha256(
+                str(next(self.server.ids)).encode('utf-8')).hexdigest()
+            self.server.containers[container] = image['spec'] or 'package'
+        self.send_json({'Id': container, 'Warnings': None}, 201)
+
+    def inspect_container(self, container):
+        if self.container(container) is None:
+            return self.send_json({'message': 'No such container'}, 404)
+        self.send_json({'Id': container, 'Config': {'Tty': False},
+                        'State': {'Running': False,
+                                  'ExitCode': self.server.status}})
+
+    def start(self, container):
+        if self.container(container) is None:
+            return self.send_json({'message': 'No such container'}, 404)
+        self.send_empty()
+
+    def log_lines(self, name):
+        yield 'Executing(%%build): %s\n' % name
+        for i in range(self.server.log_lines):
+            yield 'warning: line %d of a very chatty build\n' % i
+        for path, size in self.server.rpms(name):
+            yield 'Wrote: %s\n' % path
+
+    def logs(self, container):
+        def frames():
+            # Frames of the multiplexed stdout/stderr stream, many of them
+            # per chunk so the fake keeps up with log floods.
+            lines = self.paced(self.log_lines(self.container(container)))
+            while True:
+                batch = [struct.pack('>BxxxI', 1, len(line)) +
+                         line.encode('utf-8')
+                         for line in itertools.islice(lines, LOG_BATCH)]
+                if not batch:
+                    break
+                yield b''.join(batch)
+
+        self.send_stream(frames(), 'application/vnd.docker.raw-stream')
+
+    def wait(self, container):
+        self.send_json({'StatusCode': self.server.status})
+
+    def archive(self, container):
+        directory = '/' + self.query['path'].strip('/')
+        files = [(os.path.relpath(path, os.path.dirname(directory)), size)
+                 for path, size in self.server.rpms(self.container(container))
+                 if path.startswith(directory + '/')]
+        self.send_stream(tar_stream(files), 'application/x-tar')
+
+    def remove(self, container):
+        with self.server.lock:
+            self.server.containers.pop(container, None)
+        self.send_empty()
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
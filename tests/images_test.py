@@ -0,0 +1,78 @@
+from mock import MagicMock
+import shutil
+import tempfile
+import unittest
+
+import docker
+
+from rpmbuild.images import ImageUsage, collect, remove_containers
+
+MiB = 1024 * 1024
+
+
+class ImagesTestCase(unittest.TestCase):
+    """Tests for images.py"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.usage = ImageUsage(self.tmp)
+        self.client = MagicMock()
+        self.client.containers.return_value = []
+        self.client.images.side_effect = lambda filters=None: (
+            [] if filters else self.images)
+        self.images = [
+            {'Id': 'sha256:1', 'RepoTags': ['rpmbuild_base:abc'],
+             'Size': 300 * MiB, 'Created': 100},
+            {'Id': 'sha256:2', 'RepoTags': ['rpmbuild_foo.spec:latest'],
+             'Size': 400 * MiB, 'Created': 200},
+            {'Id': 'sha256:3', 'RepoTags': ['rpmbuild_bar.spec:latest'],
+             'Size': 400 * MiB, 'Created': 300},
+            {'Id': 'sha256:4', 'RepoTags': ['centos:7'],
+             'Size': 200 * MiB, 'Created': 0},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def removed(self):
+        return [c[0][0] for c in self.client.remove_image.call_args_list]
+
+    def test_usage_records_last_use(self):
+        self.usage.touch('rpmbuild_base:abc', None)
+        self.assertEqual(list(self.usage.last_used()), ['rpmbuild_base:abc'])
+        self.usage.forget(['rpmbuild_base:abc'])
+        self.assertEqual(self.usage.last_used(), {})
+
+    def test_collect_removes_least_recently_used(self):
+        self.usage.touch('rpmbuild_base:abc')
+        freed = collect(self.client, self.usage, 800 * MiB,
+                        log=lambda line: None)
+        # Not used since it was created, unlike the toolchain.
+        self.assertEqual(self.removed(), ['rpmbuild_foo.spec:latest'])
+        self.assertEqual(freed, 400 * MiB)
+
+    def test_collect_keeps_images_in_use(self):
+        self.client.remove_image.side_effect = [
+            docker.errors.APIError('conflict', MagicMock(status_code=409)),
+            None]
+        collect(self.client, self.usage, 800 * MiB, log=lambda line: None)
+        self.assertEqual(self.removed(), ['rpmbuild_base:abc',
+                                          'rpmbuild_foo.spec:latest'])
+
+    def test_collect_within_limit_removes_nothing(self):
+        collect(self.client, self.usage, 2048 * MiB)
+        self.assertFalse(self.client.remove_image.called)
+
+    def test_remove_containers_of_rpmbuild_images(self):
+        self.client.containers.return_value = [
+            {'Id': 'a', 'Image': 'sha256:2', 'Names': ['/happy_turing']},
+            {'Id': 'b', 'Image': 'rpmbuild_base:abc',
+             'Names': ['/sad_hopper']},
+            {'Id': 'c', 'Image': 'centos:7', 'Names': ['/web']},
+        ]
+        removed = remove_containers(self.client, set(['sha256:2']))
+        self.assertEqual(removed, ['a', 'b'])
+        self.client.remove_container.assert_called_with('b', v=True)
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,73 @@
+from mock import MagicMock, patch
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from rpmbuild.logs import BuildLog, log_path
+
+
+class BuildLogTestCase(unittest.TestCase):
+    """Tests for logs.py"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'foo.log')
+        self.console = MagicMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_log_path(self):
+        path = log_path(os.path.join(self.tmp, 'logs'), 'centos:7/foo.spec')
+        self.assertEqual(path, os.path.join(self.tmp, 'logs',
+                                            'centos_7_foo.spec.log'))
+        self.assertTrue(os.path.isdir(os.path.dirname(path)))
+
+    def test_writes_every_line(self):
+        with BuildLog(self.path, console=self.console, flush_size=10) as log:
+            for i in range(1000):
+                log('line %d' % i)
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, ['line %d' % i for i in range(1000)])
+
+    def test_compressed(self):
+        with BuildLog(self.path + '.gz', console=self.console,
+                      compress=True) as log:
+            log('line')
+            log({'status': 'Downloading'})
+        with gzip.open(self.path + '.gz') as f:
+            self.assertEqual(f.read(), b"line\n{'status': 'Downloading'}\n")
+
+    @patch('time.time', return_value=100.0)
+    def test_console_is_rate_limited(self, time):
+        log = BuildLog(self.path, console=self.console, interval=1.0)
+        log('first')
+        log('second')
+        time.return_value = 101.0
+        log('third')
+        log.close()
+        self.assertEqual([c[0][0] for c in self.console.call_args_list],
+                         ['first', 'third', 'Wrote 3 lines to %s' % self.path])
+
+    def test_tail_shown_on_failure(self):
+        log = BuildLog(self.path, console=self.console, interval=3600, tail=2)
+        for line in ('a', 'b', 'c'):
+            log(line)
+        log.close(failed=True)
+        self.assertEqual([c[0][0] for c in self.console.call_args_list],
+                         ['a', 'Last 2 lines of %s:' % self.path, 'b', 'c'])
+
+    def test_writer_applies_backpressure(self):
+        log = BuildLog(self.path, console=self.console, flush_size=1,
+                       max_pending=1)
+        for i in range(100):
+            log('x' * 10)
+            self.assertTrue(log.pending_size <= 11)
+        log.close()
+        self.assertEqual(os.path.getsize(self.path), 1100)
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
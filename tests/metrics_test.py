@@ -0,0 +1,66 @@
+from mock import patch
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from rpmbuild.metrics import Metrics, prometheus, write_json
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Tests for metrics.py"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @patch('time.time')
+    def test_phase_records_duration(self, time):
+        time.side_effect = [10.0, 12.5, 20.0, 21.0]
+        metrics = Metrics('foo.spec')
+        with metrics.phase('setup'):
+            pass
+        with metrics.phase('setup'):
+            pass
+        self.assertEqual(metrics.seconds('setup'), 3.5)
+        self.assertEqual(metrics.seconds('export'), 0.0)
+
+    def test_count_records_bytes(self):
+        metrics = Metrics('foo.spec')
+        chunks = list(metrics.count('upload', iter([b'abc', b'defg'])))
+        self.assertEqual(chunks, [b'abc', b'defg'])
+        self.assertEqual(metrics.phases['upload']['bytes'], 7)
+
+    def test_write_json(self):
+        metrics = Metrics('foo.spec')
+        metrics.add('setup', 1.0, 100)
+        metrics.add('rpmbuild', 2.0)
+        path = os.path.join(self.tmp, 'metrics.json')
+        write_json([metrics], path)
+        with open(path) as f:
+            data = json.load(f)
+        self.assertEqual(data, [{
+            'name': 'foo.spec',
+            'seconds': 3.0,
+            'phases': {'setup': {'seconds': 1.0, 'bytes': 100},
+                       'rpmbuild': {'seconds': 2.0, 'bytes': 0}}}])
+        self.assertEqual(os.listdir(self.tmp), ['metrics.json'])
+
+    def test_prometheus(self):
+        metrics = Metrics('foo "1".spec')
+        metrics.add('upload', 0.5, 2048)
+        metrics.add('rpmbuild', 2.0)
+        lines = prometheus([metrics]).splitlines()
+        self.assertTrue('rpmbuild_phase_seconds{build="foo \\"1\\".spec",'
+                        'phase="upload"} 0.500000' in lines)
+        self.assertTrue('rpmbuild_phase_bytes{build="foo \\"1\\".spec",'
+                        'phase="upload"} 2048' in lines)
+        self.assertFalse(any('bytes' in line and 'rpmbuild"' in line
+                             for line in lines))
+        self.assertTrue('# TYPE rpmbuild_phase_seconds gauge' in lines)
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
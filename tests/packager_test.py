@@ -1,20 +1,38 @@
 #!/usr/bin/env python
 from mock import mock_open, patch, MagicMock
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
 import unittest
 
-from rpmbuild import Packager, PackagerException
+import docker
+
+from rpmbuild import YUM_CACHE_SCRIPT, Packager, PackagerException
+from rpmbuild.metrics import Metrics
+from rpmbuild.scheduler import Resources
 
 
 @patch('rpmbuild.PackagerContext')
 class PackagetTestCase(unittest.TestCase):
 
-    docker_file_header = ''.join(['0' for x in range(512)])
-    docker_file_content = 'foobar'
+    docker_file_content = b'foobar'
+
+    def docker_file(self, name, content=None):
+        content = content or self.docker_file_content
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        archive.seek(0)
+        return archive
 
     def setUp(self):
         self.open = mock_open()
-        self.docker_file = MagicMock()
-        self.docker_file.read.return_value = self.docker_file_header + self.docker_file_content
         self.docker_client_patcher = patch('docker.Client')
         self.docker_client = self.docker_client_patcher.start()
 
@@ -26,46 +44,189 @@ class PackagetTestCase(unittest.TestCase):
     def test_packager_image_name(self, PackagerContext):
         context = PackagerContext.return_value
         context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        context.context_image = None
+        packager = Packager(context, {})
+        self.assertEqual(packager.image_name, 'rpmbuild_foo:0123456789ab')
+
+    def test_packager_image_name_ignores_spec_directory(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = '/home/joe/specs/Foo.spec'
+        context.image_digest.return_value = 'fedcba9876543210'
+        packager = Packager(context, {})
+        self.assertEqual(packager.image_name, 'rpmbuild_foo.spec:fedcba987654')
+
+    def test_packager_build_image_from_context_image(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        context.image = 'centos:7'
+        context.deps_image = None
+        context.context_image = 'rpmbuild_context:abc'
+        context.toolchain = None
+        context.render.return_value = 'FROM centos:7'
         packager = Packager(context, {})
-        self.assertEqual(packager.image_name, 'rpmbuild_foo')
+        packager.client.build = MagicMock()
+        list(packager.build_image())
+        kwargs = packager.client.build.call_args[1]
+        self.assertEqual(kwargs['fileobj'].getvalue(), b'FROM centos:7')
+        self.assertEqual(kwargs['tag'], 'rpmbuild_foo:0123456789ab')
+        self.assertFalse(context.chunks.called)
+
+    def test_packager_upload_context(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.digest.return_value = 'abcdef0123456789'
+        packager = Packager(context, {})
+        packager.client = MagicMock()
+        packager.client.images.return_value = []
+        packager.client.build.return_value = [b'{"stream": "done"}']
+        log = MagicMock()
+        tag = packager.upload_context(log)
+        self.assertEqual(tag, 'rpmbuild_context:abcdef012345')
+        context.chunks.assert_called_with(
+            dockerfile=context._context_dockerfile.return_value)
+        kwargs = packager.client.build.call_args[1]
+        self.assertEqual(kwargs['tag'], tag)
+        self.assertTrue(kwargs['custom_context'])
+        log.assert_called_with('done')
+
+    def test_packager_upload_context_reuses_image(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.digest.return_value = 'abcdef0123456789'
+        packager = Packager(context, {})
+        packager.client = MagicMock()
+        packager.client.images.return_value = [
+            {'RepoTags': ['rpmbuild_context:abcdef012345']}]
+        packager.upload_context()
+        self.assertFalse(packager.client.build.called)
 
     def test_packager_image_with_matches(self, PackagerContext):
         context = PackagerContext.return_value
         packager = Packager(context, {})
         packager.client = MagicMock()
-        packager.client.images.return_value = ['foo', 'bar']
-        self.assertEqual(packager.image, 'foo')
+        packager.client.inspect_image.return_value = {'Id': 'foo'}
+        self.assertEqual(packager.image, {'Id': 'foo'})
 
     def test_packager_image_without_matches(self, PackagerContext):
         context = PackagerContext.return_value
         packager = Packager(context, {})
         packager.client = MagicMock()
-        packager.client.images.return_value = []
+        packager.client.inspect_image.side_effect = docker.errors.APIError(
+            'missing', MagicMock(status_code=404))
         self.assertRaises(PackagerException, lambda: packager.image)
 
+    def test_packager_build_image_reuses_identical_image(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        packager = Packager(context, {})
+        packager.client = MagicMock()
+        packager.client.images.return_value = [
+            {'RepoTags': ['rpmbuild_foo:0123456789ab']}]
+        lines = list(packager.build_image())
+        self.assertFalse(packager.client.build.called)
+        self.assertEqual(json.loads(lines[0].decode('UTF-8')),
+                         {'stream': 'Using image rpmbuild_foo:0123456789ab\n'})
+
+    def test_packager_build_image_pulls_from_registry(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        packager = Packager(context, {}, registry='registry:5000')
+        packager.client = MagicMock()
+        packager.client.images.return_value = []
+        packager.client.tag.return_value = True
+        list(packager.build_image())
+        packager.client.pull.assert_called_with(
+            'registry:5000/rpmbuild_foo', tag='0123456789ab')
+        packager.client.tag.assert_called_with(
+            'registry:5000/rpmbuild_foo:0123456789ab', 'rpmbuild_foo',
+            '0123456789ab')
+        self.assertFalse(packager.client.build.called)
+
+    def test_packager_build_image_pushes_to_registry(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        context.path = '/tmp'
+        context.deps_image = None
+        context.context_image = None
+        context.toolchain = None
+        packager = Packager(context, {}, registry='registry:5000')
+        packager.client = MagicMock()
+        # Missing in the registry, there once built.
+        packager.client.tag.side_effect = [
+            docker.errors.APIError('missing', MagicMock(status_code=404)),
+            True]
+        packager.client.images.side_effect = [
+            [], [{'RepoTags': ['rpmbuild_foo:0123456789ab']}]]
+        packager.client.push.return_value = [b'{"status": "Pushed"}']
+        lines = list(packager.build_image())
+        packager.client.build.assert_called_with(
+            '/tmp', tag='rpmbuild_foo:0123456789ab', stream=True)
+        packager.client.push.assert_called_with(
+            'registry:5000/rpmbuild_foo', tag='0123456789ab', stream=True)
+        self.assertEqual(lines[-1], b'{"status": "Pushed"}')
+
     def test_packager_export_package(self, PackagerContext):
         context = PackagerContext.return_value
+        context.srpm = None
         packager = Packager(context, {})
         packager.container = {'Id': 0}
         packager.client = MagicMock()
-        packager.client.copy.return_value = self.docker_file
-        packager.client.diff.return_value = [
-            {'Path': '/foo'},
-            {'Path': '/rpmbuild/SOURCES/foo.tar.gz'},
-            {'Path': '/rpmbuild/SPECS/foo.spec'},
-            {'Path': '/rpmbuild/foo.rpm'},
-            {'Path': '/rpmbuild/foo.src.rpm'},
-        ]
+        packager.client.get_archive.side_effect = lambda container, path: (
+            self.docker_file('RPMS/noarch/foo.rpm' if path.endswith('/RPMS')
+                             else 'SRPMS/foo.src.rpm'), {})
+        output = tempfile.mkdtemp()
+        try:
+            exported = packager.export_package(output)
+            with open(os.path.join(output, 'foo.rpm'), 'rb') as f:
+                self.assertEqual(f.read(), self.docker_file_content)
+        finally:
+            shutil.rmtree(output)
+
+        packager.client.get_archive.assert_any_call({'Id': 0}, '/rpmbuild/RPMS')
+        packager.client.get_archive.assert_any_call({'Id': 0}, '/rpmbuild/SRPMS')
+        self.assertEqual(exported, [os.path.join(output, 'foo.rpm'),
+                                    os.path.join(output, 'foo.src.rpm')])
+
+    def test_packager_export_package_skips_srpm_of_rebuilds(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.srpm = '/tmp/foo.src.rpm'
+        packager = Packager(context, {})
+        packager.container = {'Id': 0}
+        packager.client = MagicMock()
+        packager.client.get_archive.return_value = (
+            self.docker_file('RPMS/noarch/foo.rpm'), {})
+        output = tempfile.mkdtemp()
+        try:
+            exported = packager.export_package(output)
+        finally:
+            shutil.rmtree(output)
+
+        packager.client.get_archive.assert_called_once_with({'Id': 0},
+                                                            '/rpmbuild/RPMS')
+        self.assertEqual(exported, [os.path.join(output, 'foo.rpm')])
+
+    def test_packager_export_package_streams_long_names_in_chunks(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.srpm = '/tmp/foo.src.rpm'
+        packager = Packager(context, {})
+        packager.container = {'Id': 0}
+        packager.client = MagicMock()
+        name = 'x' * 200 + '.rpm'
+        content = b'rpm' * 1024 * 1024
+        packager.client.get_archive.return_value = (
+            self.docker_file('RPMS/' + name, content), {})
 
         with patch('rpmbuild.open', self.open, create=True):
-            packager.export_package('/tmp')
+            with patch('rpmbuild.CHUNK_SIZE', 1024 * 1024):
+                packager.export_package('/tmp')
 
-        packager.client.copy.assert_any_call(0, '/rpmbuild/foo.rpm')
-        packager.client.copy.assert_any_call(0, '/rpmbuild/foo.src.rpm')
-        self.open.assert_any_call('/tmp/foo.rpm', 'wb')
-        self.open.assert_any_call('/tmp/foo.src.rpm', 'wb')
-        exported = self.open()
-        exported.write.assert_called_with(self.docker_file_content)
+        self.open.assert_called_with('/tmp/' + name, 'wb')
+        writes = self.open().write.call_args_list
+        self.assertEqual(len(writes), 3)
+        self.assertEqual(b''.join(w[0][0] for w in writes), content)
 
     def test_packager_string(self, PackagerContext):
         context = PackagerContext.return_value
@@ -75,31 +236,449 @@ class PackagetTestCase(unittest.TestCase):
 
     def test_packager_with_statement(self, PackagerContext):
         context = PackagerContext.return_value
+        self.docker_client.return_value.inspect_image.return_value = {
+            'Id': 'sha256:0123456789abcdef'}
         with Packager(context, {}):
             context.setup.assert_called_with()
+            self.assertEqual(context.toolchain, 'rpmbuild_base:0123456789ab')
         context.teardown.assert_called_with()
 
+    def test_packager_toolchain_name_pulls_missing_base_image(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.image = 'centos:7'
+        packager = Packager(context, {})
+        packager.client = MagicMock()
+        packager.client.inspect_image.side_effect = [
+            docker.errors.APIError('missing', MagicMock()),
+            {'Id': 'fedcba9876543210'}]
+        self.assertEqual(packager.toolchain_name, 'rpmbuild_base:fedcba987654')
+        packager.client.pull.assert_called_with('centos:7')
+
+    def test_packager_build_image_commits_stages_with_yum_cache(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        context.image = 'centos:7'
+        context.path = '/tmp'
+        context.deps_image = None
+        context.context_image = None
+        context.toolchain = 'rpmbuild_base:def'
+        context.toolchain_dockerfile.return_value = io.BytesIO(
+            b'FROM centos:7\nRUN yum -y install tar\nRUN rpmdev-setuptree\n')
+        cache = tempfile.mkdtemp()
+        try:
+            packager = Packager(context, client=MagicMock(), yum_cache=cache)
+            packager.client.images.return_value = []
+            packager.client.logs.return_value = [b'Installed: tar\n']
+            packager.client.wait.return_value = 0
+            packager.client.inspect_image.return_value = {
+                'Config': {'Cmd': ['/bin/bash']}}
+            lines = list(packager.build_image())
+        finally:
+            shutil.rmtree(cache)
+
+        container = packager.client.create_container.return_value
+        args, kwargs = packager.client.create_container.call_args
+        self.assertEqual(args, ('centos:7',))
+        self.assertTrue('yum -y install tar && rpmdev-setuptree' in kwargs['command'][2])
+        self.assertFalse('volumes' in kwargs)
+        self.assertEqual(kwargs['host_config'],
+                         packager.client.create_host_config.return_value)
+        packager.client.create_host_config.assert_called_with(binds={
+            os.path.join(cache, 'centos_7', 'yum'): {'bind': '/var/cache/yum',
+                                                     'ro': False},
+            os.path.join(cache, 'centos_7', 'dnf'): {'bind': '/var/cache/dnf',
+                                                     'ro': False}})
+        packager.client.start.assert_called_with(container)
+        packager.client.inspect_image.assert_called_with('centos:7')
+        packager.client.commit.assert_called_with(
+            container, repository='rpmbuild_base', tag='def',
+            conf={'Cmd': ['/bin/bash']})
+        packager.client.remove_container.assert_called_with(container)
+        self.assertEqual(json.loads(lines[0].decode('UTF-8')),
+                         {'stream': 'Installed: tar\n'})
+        packager.client.build.assert_called_with('/tmp', tag='rpmbuild_foo:0123456789ab', stream=True)
+
+    def test_yum_cache_script_keeps_packages_without_editing_config(self, PackagerContext):
+        bin_dir = tempfile.mkdtemp()
+        try:
+            for manager in ('yum', 'dnf'):
+                with open(os.path.join(bin_dir, manager), 'w') as f:
+                    f.write('#!/bin/sh\necho %s "$@"\n' % manager)
+                os.chmod(os.path.join(bin_dir, manager), 0o755)
+            script = YUM_CACHE_SCRIPT % 'yum -y install tar && dnf -y install gcc'
+            output = subprocess.check_output(
+                ['/bin/sh', '-c', script],
+                env={'PATH': bin_dir + os.pathsep + os.environ['PATH']})
+        finally:
+            shutil.rmtree(bin_dir)
+        self.assertEqual(output.decode('UTF-8').split('\n'), [
+            'yum --setopt=keepcache=1 -y install tar',
+            'dnf --setopt=keepcache=1 -y install gcc', ''])
+        self.assertFalse('yum.conf' in YUM_CACHE_SCRIPT)
+
+    def test_packager_commit_stage_fails_on_error_status(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.image = 'centos:7'
+        cache = tempfile.mkdtemp()
+        try:
+            packager = Packager(context, client=MagicMock(), yum_cache=cache)
+            packager.client.logs.return_value = []
+            packager.client.wait.return_value = {'StatusCode': 1}
+            stage = packager._commit_stage(
+                'rpmbuild_base:def', io.BytesIO(b'FROM centos:7\nRUN false\n'))
+            self.assertRaises(PackagerException, list, stage)
+        finally:
+            shutil.rmtree(cache)
+        self.assertFalse(packager.client.commit.called)
+        self.assertTrue(packager.client.remove_container.called)
+
+    def test_packager_build_image_builds_missing_toolchain(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        context.path = '/tmp'
+        context.deps_image = None
+        context.context_image = None
+        context.toolchain = 'rpmbuild_base:def'
+        packager = Packager(context, {})
+        packager.client = MagicMock()
+        packager.client.images.return_value = []
+        list(packager.build_image())
+        packager.client.build.assert_any_call(
+            fileobj=context.toolchain_dockerfile.return_value,
+            tag='rpmbuild_base:def', stream=True)
+        packager.client.build.assert_called_with('/tmp', tag='rpmbuild_foo:0123456789ab', stream=True)
+
     def test_packager_build_image(self, PackagerContext):
         context = PackagerContext.return_value
         context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
         context.path = '/tmp'
+        context.deps_image = None
+        context.context_image = None
+        context.toolchain = None
+        packager = Packager(context, {})
+        packager.client.build = MagicMock()
+        list(packager.build_image())
+        packager.client.build.assert_called_with('/tmp', tag='rpmbuild_foo:0123456789ab', stream=True)
+
+    def test_packager_build_image_streams_context(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        context.path = None
+        context.deps_image = None
+        context.context_image = None
+        context.toolchain = None
+        context.chunks.return_value = iter([b'abc', b'de'])
+        context.metrics = Metrics()
         packager = Packager(context, {})
         packager.client.build = MagicMock()
-        packager.build_image()
-        packager.client.build.assert_called_with('/tmp', tag='rpmbuild_foo', stream=True)
+        list(packager.build_image())
+        kwargs = packager.client.build.call_args[1]
+        self.assertEqual(list(kwargs.pop('fileobj')), [b'abc', b'de'])
+        self.assertEqual(kwargs, {'custom_context': True,
+                                  'tag': 'rpmbuild_foo:0123456789ab', 'stream': True})
+        self.assertEqual(context.metrics.phases['upload']['bytes'], 5)
+        self.assertTrue('builddep' in context.metrics.phases)
+
+    def test_packager_build_image_builds_missing_deps_image(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        context.path = '/tmp'
+        context.deps_image = 'rpmbuild_deps:abc'
+        context.context_image = None
+        context.toolchain = None
+        packager = Packager(context, {})
+        packager.client = MagicMock()
+        packager.client.images.return_value = []
+        list(packager.build_image())
+        packager.client.build.assert_any_call(
+            fileobj=context.deps_dockerfile.return_value,
+            tag='rpmbuild_deps:abc', stream=True)
+        packager.client.build.assert_called_with('/tmp', tag='rpmbuild_foo:0123456789ab', stream=True)
+
+    def test_packager_build_image_reuses_cached_deps_image(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        context.path = '/tmp'
+        context.deps_image = 'rpmbuild_deps:abc'
+        context.context_image = None
+        context.toolchain = 'rpmbuild_base:def'
+        packager = Packager(context, {})
+        packager.client = MagicMock()
+        packager.client.images.return_value = [
+            {'RepoTags': ['rpmbuild_base:def', 'rpmbuild_deps:abc']}]
+        list(packager.build_image())
+        self.assertEqual(packager.client.build.call_count, 1)
 
     def test_packager_build_package(self, PackagerContext):
         context = PackagerContext.return_value
         packager = Packager(context, {})
         packager.client = MagicMock()
-        packager.client.images.return_value = [{'Id': 0}]
+        packager.client.inspect_image.return_value = {'Id': 0}
         result_container, result_logs = packager.build_package()
         container = packager.client.create_container.return_value
-        packager.client.create_container.assert_called_with(0)
+        packager.client.create_host_config.assert_called_with(binds=None)
+        packager.client.create_container.assert_called_with(
+            0, host_config=packager.client.create_host_config.return_value)
         packager.client.logs.assert_called_with(container, stream=True)
         packager.client.start.assert_called_with(container)
         self.assertEqual(result_container, container)
 
+    def test_packager_run(self, PackagerContext):
+        context = PackagerContext.return_value
+        packager = Packager(context, client=MagicMock())
+        packager.build_image = MagicMock(return_value=[
+            b'{"stream": "Step 1 : FROM foo\\n"}', b'{"status": "bar"}'])
+        packager.build_package = MagicMock(return_value=(
+            {'Id': 0}, [b'Wrote: /rpmbuild/RPMS/foo.rpm\n']))
+        packager.export_package = MagicMock(return_value=['/tmp/foo.rpm'])
+        packager.client.wait.return_value = 0
+        lines = []
+
+        exported = packager.run('/tmp', log=lines.append)
+
+        self.assertEqual(exported, ['/tmp/foo.rpm'])
+        self.assertEqual(lines, ['Step 1 : FROM foo', {'status': 'bar'},
+                                 'Wrote: /rpmbuild/RPMS/foo.rpm'])
+        packager.build_package.assert_called_with()
+        packager.export_package.assert_called_with('/tmp')
+        self.assertFalse(self.docker_client.called)
+        packager.client.wait.assert_called_with({'Id': 0})
+        packager.client.remove_container.assert_called_with({'Id': 0},
+                                                             v=True)
+
+    def test_packager_run_raises_on_build_errors(self, PackagerContext):
+        context = PackagerContext.return_value
+        packager = Packager(context, client=MagicMock())
+        packager.build_image = MagicMock(return_value=[
+            b'{"stream": "Step 1 : FROM foo\\n"}', b'{"error": "bar"}'])
+        packager.build_package = MagicMock()
+
+        with self.assertRaises(PackagerException) as raised:
+            packager.run('/tmp', log=lambda line: None)
+
+        self.assertEqual(str(raised.exception), 'bar')
+        self.assertFalse(packager.build_package.called)
+
+    def test_packager_run_raises_on_failed_rpmbuild(self, PackagerContext):
+        context = PackagerContext.return_value
+        result_cache = MagicMock()
+        result_cache.__contains__.return_value = False
+        packager = Packager(context, client=MagicMock(),
+                            result_cache=result_cache)
+        packager.build_image = MagicMock(return_value=[])
+        packager.build_package = MagicMock(return_value=({'Id': 0}, []))
+        packager.export_package = MagicMock()
+        packager.client.wait.return_value = {'StatusCode': 1}
+
+        with self.assertRaises(PackagerException):
+            packager.run('/tmp', log=lambda line: None)
+
+        self.assertFalse(packager.export_package.called)
+        self.assertFalse(result_cache.put.called)
+        packager.client.remove_container.assert_called_with({'Id': 0},
+                                                             v=True)
+
+    def test_packager_run_removes_container_of_failed_export(self, PackagerContext):
+        context = PackagerContext.return_value
+        packager = Packager(context, client=MagicMock())
+        packager.build_image = MagicMock(return_value=[])
+        packager.build_package = MagicMock(return_value=({'Id': 0}, []))
+        packager.export_package = MagicMock(side_effect=PackagerException)
+        packager.client.wait.return_value = 0
+
+        with self.assertRaises(PackagerException):
+            packager.run('/tmp', log=lambda line: None)
+
+        packager.client.remove_container.assert_called_with({'Id': 0},
+                                                             v=True)
+
+    def test_packager_build_image_records_image_usage(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.__str__.return_value = 'foo'
+        context.image_digest.return_value = '0123456789abcdef'
+        context.toolchain = 'rpmbuild_base:abc'
+        context.deps_image = None
+        context.context_image = None
+        context.path = '/tmp'
+        image_usage = MagicMock()
+        packager = Packager(context, client=MagicMock(),
+                            image_usage=image_usage)
+        packager.client.images.return_value = [
+            {'RepoTags': ['rpmbuild_base:abc']}]
+
+        list(packager.build_image())
+
+        image_usage.touch.assert_called_with('rpmbuild_base:abc', None,
+                                             'rpmbuild_foo:0123456789ab', None)
+
+    def test_packager_run_returns_cached_results(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.digest.return_value = 'abc'
+        result_cache = MagicMock()
+        result_cache.__contains__.return_value = True
+        result_cache.get.return_value = ['/tmp/foo.rpm']
+        packager = Packager(context, client=MagicMock(),
+                            result_cache=result_cache)
+        packager.client.inspect_image.return_value = {'Id': 'sha256:0123'}
+        packager.build_image = MagicMock()
+
+        with packager:
+            self.assertEqual(packager.run('/tmp', log=lambda line: None),
+                             ['/tmp/foo.rpm'])
+
+        context.digest.assert_called_with('0123')
+        self.assertFalse(context.setup.called)
+        self.assertFalse(packager.build_image.called)
+        result_cache.get.assert_called_with('abc', '/tmp')
+
+    def test_packager_run_stores_results_in_cache(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.digest.return_value = 'abc'
+        result_cache = MagicMock()
+        result_cache.__contains__.return_value = False
+        packager = Packager(context, client=MagicMock(),
+                            result_cache=result_cache)
+        packager.client.inspect_image.return_value = {'Id': 'sha256:0123'}
+        packager.build_image = MagicMock(return_value=[])
+        packager.build_package = MagicMock(return_value=({'Id': 0}, []))
+        packager.export_package = MagicMock(return_value=['/tmp/foo.rpm'])
+        packager.client.wait.return_value = 0
+
+        with packager:
+            packager.run('/tmp', log=lambda line: None)
+
+        self.assertTrue(context.setup.called)
+        result_cache.put.assert_called_with('abc', ['/tmp/foo.rpm'], '/tmp')
+
+    def test_packager_build_package_binds_output(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.srpm = None
+        packager = Packager(context, {})
+        packager.client = MagicMock()
+        packager.client.inspect_image.return_value = {'Id': 0}
+        output = tempfile.mkdtemp()
+        try:
+            rpms = os.path.join(output, 'RPMS', 'noarch')
+            os.makedirs(rpms)
+            with open(os.path.join(rpms, 'old.rpm'), 'w') as f:
+                f.write('old')
+
+            container, logs = packager.build_package(output)
+            binds = packager.client.create_host_config.call_args[1]['binds']
+            staging = packager.staging
+            self.assertEqual(os.path.dirname(staging), output)
+            self.assertEqual(binds[os.path.join(staging, 'RPMS')],
+                             {'bind': '/rpmbuild/RPMS', 'ro': False})
+            self.assertEqual(binds[os.path.join(staging, 'SRPMS')],
+                             {'bind': '/rpmbuild/SRPMS', 'ro': False})
+            args, kwargs = packager.client.create_container.call_args
+            self.assertEqual(sorted(kwargs['volumes']),
+                             ['/rpmbuild/RPMS', '/rpmbuild/SRPMS'])
+            self.assertEqual(kwargs['host_config'],
+                             packager.client.create_host_config.return_value)
+            packager.client.start.assert_called_with(container)
+
+            os.mkdir(os.path.join(staging, 'RPMS', 'noarch'))
+            with open(os.path.join(staging, 'RPMS', 'noarch', 'foo.rpm'),
+                      'w') as f:
+                f.write('new')
+            self.assertEqual(packager.export_package(output),
+                             [os.path.join(rpms, 'foo.rpm')])
+            self.assertEqual(sorted(os.listdir(rpms)), ['foo.rpm', 'old.rpm'])
+            self.assertFalse(os.path.exists(staging))
+            self.assertFalse(packager.client.get_archive.called)
+        finally:
+            shutil.rmtree(output)
+
+    def test_packager_bound_builds_sharing_output_keep_their_rpms(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.srpm = None
+        output = tempfile.mkdtemp()
+        try:
+            first = Packager(context, client=MagicMock())
+            second = Packager(context, client=MagicMock())
+            stagings = []
+            for packager, name in ((first, 'foo.rpm'), (second, 'bar.rpm')):
+                packager.output_binds(output)
+                stagings.append(packager.staging)
+                with open(os.path.join(packager.staging, 'RPMS', name),
+                          'w') as f:
+                    f.write(name)
+            self.assertNotEqual(stagings[0], stagings[1])
+
+            self.assertEqual(second.export_package(output),
+                             [os.path.join(output, 'RPMS', 'bar.rpm')])
+            self.assertEqual(first.export_package(output),
+                             [os.path.join(output, 'RPMS', 'foo.rpm')])
+        finally:
+            shutil.rmtree(output)
+
+    def test_packager_dev_build_keeps_tree_in_volumes(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.spec = '/src/foo/foo.spec'
+        context.image = 'centos:7'
+        packager = Packager(context, {}, result_cache=MagicMock(), dev=True,
+                            stage='install')
+        self.assertEqual(packager.result_cache, None)
+        packager.client = MagicMock()
+        packager.client.inspect_image.return_value = {'Id': 0}
+        packager.build_package()
+
+        volume = packager.tree_volume
+        self.assertTrue(volume.startswith('rpmbuild_tree_foo.spec_'))
+        args, kwargs = packager.client.create_container.call_args
+        self.assertEqual(kwargs['environment'],
+                         {'RPMBUILD_STAGE': '-bi --short-circuit'})
+        self.assertEqual(sorted(kwargs['volumes']),
+                         ['/rpmbuild/BUILD', '/rpmbuild/BUILDROOT'])
+        binds = packager.client.create_host_config.call_args[1]['binds']
+        self.assertEqual(binds[volume + '_build'],
+                         {'bind': '/rpmbuild/BUILD', 'ro': False})
+        packager.client.start.assert_called_with(
+            packager.client.create_container.return_value)
+
+        context.image = 'centos:6'
+        self.assertNotEqual(packager.tree_volume, volume)
+
+    def test_packager_build_package_limits_resources(self, PackagerContext):
+        context = PackagerContext.return_value
+        packager = Packager(context, {},
+                            resources=Resources(1.5, 512 * 1024 * 1024))
+        packager.client = MagicMock()
+        packager.client.inspect_image.return_value = {'Id': 0}
+        packager.build_package()
+        packager.client.create_host_config.assert_called_with(
+            binds=None, cpu_period=100000, cpu_quota=150000,
+            mem_limit=512 * 1024 * 1024)
+        kwargs = packager.client.create_container.call_args[1]
+        self.assertEqual(kwargs['environment'], {'RPM_BUILD_NCPUS': 2})
+        self.assertEqual(kwargs['host_config'],
+                         packager.client.create_host_config.return_value)
+        packager.client.start.assert_called_with(
+            packager.client.create_container.return_value)
+
+    def test_packager_rejects_unknown_stage(self, PackagerContext):
+        context = PackagerContext.return_value
+        self.assertRaises(PackagerException, Packager, context, {},
+                          dev=True, stage='prep')
+
+    def test_packager_output_binds_keep_srpms_for_rebuild(self, PackagerContext):
+        context = PackagerContext.return_value
+        context.srpm = 'foo.src.rpm'
+        packager = Packager(context, {})
+        output = tempfile.mkdtemp()
+        try:
+            binds = packager.output_binds(output)
+        finally:
+            shutil.rmtree(output)
+        self.assertEqual([b['bind'] for b in binds.values()], ['/rpmbuild/RPMS'])
+
     def tearDown(self):
         self.docker_client_patcher.stop()
 
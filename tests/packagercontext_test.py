@@ -1,7 +1,13 @@
 from mock import mock_open, patch, DEFAULT, MagicMock
+import io
+import os
+import shutil
+import tarfile
+import tempfile
 import unittest
 
 from rpmbuild import PackagerContext, PackagerException
+from rpmbuild.config import PROFILES
 
 
 class PackagerContextTestCase(unittest.TestCase):
@@ -10,13 +16,19 @@ class PackagerContextTestCase(unittest.TestCase):
     def setUp(self):
         self.context_defaults = dict(
                 image=None,
+                deps_image=None,
+                toolchain=None,
                 defines=[],
+                options=[],
+                stage='-ba',
                 macrofiles=[],
                 sources=[],
-                sources_dir=None,
+                sources_dir=False,
                 spec=None,
                 retrieve=None,
-                srpm=None)
+                srpm=None,
+                repo=None,
+                context_image=None)
         self.open = mock_open()
 
     def test_packager_context_str(self):
@@ -31,7 +43,7 @@ class PackagerContextTestCase(unittest.TestCase):
         with patch('rpmbuild.open', self.open, create=True):
             context = PackagerContext('foo', macrofiles=['foo.macro'])
             context.setup()
-            copy.assert_called_with('foo.macro', '/context')
+            copy.assert_called_with('foo.macro', '/context/foo.macro')
 
     @patch('shutil.copy')
     @patch('tempfile.mkdtemp', return_value='/context')
@@ -40,7 +52,7 @@ class PackagerContextTestCase(unittest.TestCase):
             context = PackagerContext('foo', spec='foo.spec')
             context.template.render = MagicMock()
             context.setup()
-            copy.assert_called_with('foo.spec', '/context')
+            copy.assert_called_with('foo.spec', '/context/foo.spec')
             self.context_defaults.update(image='foo', spec='foo.spec')
             context.template.render.assert_called_with(**self.context_defaults)
 
@@ -50,7 +62,7 @@ class PackagerContextTestCase(unittest.TestCase):
         with patch('rpmbuild.open', self.open, create=True):
             context = PackagerContext('foo', sources=['foo.tar.gz'])
             context.setup()
-            copy.assert_called_with('foo.tar.gz', '/context')
+            copy.assert_called_with('foo.tar.gz', '/context/foo.tar.gz')
 
     @patch.multiple('shutil', copy=DEFAULT, copytree=DEFAULT)
     @patch('tempfile.mkdtemp', return_value='/context')
@@ -58,7 +70,7 @@ class PackagerContextTestCase(unittest.TestCase):
         with patch('rpmbuild.open', self.open, create=True):
             context = PackagerContext('foo', spec='foo.spec', sources_dir='/tmp')
             context.setup()
-            copy.assert_called_with('foo.spec', '/context')
+            copy.assert_called_with('foo.spec', '/context/foo.spec')
             copytree.assert_called_with('/tmp', '/context/SOURCES')
 
     @patch('shutil.copy')
@@ -67,7 +79,7 @@ class PackagerContextTestCase(unittest.TestCase):
         with patch('rpmbuild.open', self.open, create=True):
             context = PackagerContext('foo', srpm='foo.srpm')
             context.setup()
-            copy.assert_called_with('foo.srpm', '/context')
+            copy.assert_called_with('foo.srpm', '/context/foo.srpm')
 
     @patch.multiple('shutil', copy=DEFAULT, rmtree=DEFAULT)
     @patch('tempfile.mkdtemp', return_value='/context')
@@ -78,6 +90,271 @@ class PackagerContextTestCase(unittest.TestCase):
             context.teardown()
             rmtree.assert_called_with('/context')
 
+    @patch('shutil.copy')
+    @patch('tempfile.mkdtemp', return_value='/context')
+    def test_packager_context_setup_build_requires(self, mkdtemp, copy):
+        self.open = mock_open(read_data='BuildRequires: gcc, make >= 3.8\n')
+        with patch('rpmbuild.open', self.open, create=True):
+            context = PackagerContext('foo', spec='foo.spec')
+            context.setup()
+            self.assertEqual(context.build_requires, ['gcc', 'make >= 3.8'])
+            self.assertTrue(context.deps_image.startswith('rpmbuild_deps:'))
+            self.assertTrue(b"'make >= 3.8'" in
+                            context.deps_dockerfile().getvalue())
+
+    def test_deps_image_is_keyed_by_dependency_set(self):
+        context = PackagerContext('foo', spec='foo.spec')
+        self.assertEqual(context.deps_image, None)
+        context.build_requires = ['gcc']
+        deps_image = context.deps_image
+        context.spec = 'bar.spec'
+        self.assertEqual(context.deps_image, deps_image)
+        context.build_requires = ['gcc', 'make']
+        self.assertNotEqual(context.deps_image, deps_image)
+        context.build_requires = ['gcc']
+        context.defines = ['dist .el7']
+        self.assertNotEqual(context.deps_image, deps_image)
+
+    def test_toolchain_replaces_base_image(self):
+        context = PackagerContext('foo', spec='foo.spec')
+        context.build_requires = ['gcc']
+        deps_image = context.deps_image
+        context.toolchain = 'rpmbuild_base:abc'
+        self.assertEqual(context.base_image, 'rpmbuild_base:abc')
+        self.assertNotEqual(context.deps_image, deps_image)
+        self.assertTrue(b'FROM rpmbuild_base:abc' in
+                        context.deps_dockerfile().getvalue())
+        self.assertTrue(b'FROM foo' in
+                        context.toolchain_dockerfile().getvalue())
+
+    @patch('tempfile.mkdtemp')
+    def test_packager_context_setup_stream_skips_temp_dir(self, mkdtemp):
+        with patch('rpmbuild.open', self.open, create=True):
+            context = PackagerContext('foo', spec='foo.spec', stream=True)
+            context.setup()
+            context.teardown()
+        self.assertFalse(mkdtemp.called)
+        self.assertEqual(context.path, None)
+
+    def test_packager_context_chunks_streams_original_files(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            spec = os.path.join(tmp, 'foo.spec')
+            sources_dir = os.path.join(tmp, 'SOURCES')
+            os.mkdir(sources_dir)
+            with open(spec, 'w') as f:
+                f.write('Name: foo\n')
+            with open(os.path.join(sources_dir, 'foo.patch'), 'w') as f:
+                f.write('patch')
+
+            context = PackagerContext('foo', spec=spec, sources_dir=sources_dir,
+                                      stream=True)
+            context.setup()
+            data = b''.join(context.chunks(size=16))
+        finally:
+            shutil.rmtree(tmp)
+
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            names = tar.getnames()
+            dockerfile = tar.extractfile('Dockerfile').read()
+        self.assertEqual(names, ['Dockerfile', 'foo.spec', 'SOURCES',
+                                 'SOURCES/foo.patch'])
+        self.assertTrue(b'COPY foo.spec /rpmbuild/SPECS/foo.spec' in dockerfile)
+
+    def test_packager_context_filters_sources_dir(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            spec = os.path.join(tmp, 'foo.spec')
+            sources_dir = os.path.join(tmp, 'SOURCES')
+            os.makedirs(os.path.join(sources_dir, '.git'))
+            with open(spec, 'w') as f:
+                f.write('Name: foo\nSource0: foo.tar.gz\nPatch0: foo.patch\n')
+            with open(os.path.join(sources_dir, '.rpmbuildignore'), 'w') as f:
+                f.write('.git\n')
+            for name in ('.git/HEAD', 'foo.tar.gz', 'foo.patch', 'old.tar.gz'):
+                open(os.path.join(sources_dir, name), 'w').close()
+
+            context = PackagerContext('foo', spec=spec, sources_dir=sources_dir,
+                                      stream=True)
+            self.assertEqual([name for path, name in context.files()],
+                             ['foo.spec', 'SOURCES/foo.patch',
+                              'SOURCES/foo.tar.gz', 'SOURCES/old.tar.gz'])
+
+            context = PackagerContext('foo', spec=spec, sources_dir=sources_dir,
+                                      referenced_sources=True)
+            context.setup()
+            copied = sorted(os.listdir(os.path.join(context.path, 'SOURCES')))
+            dockerfile = context.render()
+            context.teardown()
+        finally:
+            shutil.rmtree(tmp)
+
+        self.assertEqual(copied, ['foo.patch', 'foo.tar.gz'])
+        self.assertTrue('COPY SOURCES /rpmbuild/SOURCES' in dockerfile)
+
+    @patch('rpmbuild.pack_directories')
+    def test_packager_context_packs_directory_sources(self, pack_directories):
+        tmp = tempfile.mkdtemp()
+        packed = pack_directories.return_value.__enter__
+        packed.return_value = {tmp: '/cache/abc.gz'}
+        try:
+            context = PackagerContext('foo', sources=[tmp], stream=True)
+            context.setup()
+        finally:
+            shutil.rmtree(tmp)
+        pack_directories.assert_called_with([tmp], 'gz')
+        self.assertTrue(pack_directories.return_value.__exit__.called)
+        self.assertEqual(context.files(),
+                         [('/cache/abc.gz', os.path.basename(tmp))])
+
+    def test_packager_context_chunks_raises_archive_errors(self):
+        context = PackagerContext('foo', sources=['/nonexistent.tar.gz'],
+                                  stream=True)
+        context.setup()
+        self.assertRaises(OSError, lambda: list(context.chunks()))
+
+    def test_repo_is_set_up_before_build_dependencies(self):
+        context = PackagerContext('foo', spec='foo.spec', repo='/repo')
+        context.build_requires = ['libfoo']
+        self.assertEqual(context.deps_image, None)
+        self.assertEqual(context.files()[-1], ('/repo', 'REPO'))
+        dockerfile = context.render()
+        self.assertTrue(dockerfile.index('createrepo /rpmbuild/REPO') <
+                        dockerfile.index('yum-builddep'))
+
+    def test_rpmbuild_stage_is_read_from_environment(self):
+        context = PackagerContext('foo', spec='foo.spec')
+        dockerfile = context.render()
+        self.assertTrue('ENV RPMBUILD_STAGE -ba' in dockerfile)
+        self.assertTrue('$RPMBUILD_STAGE /rpmbuild/SPECS/foo.spec' in
+                        dockerfile)
+
+    def test_profile_sets_defines_options_and_stage(self):
+        context = PackagerContext('foo', spec='foo.spec',
+                                  defines=['debug_package 1'],
+                                  profile=PROFILES['dev'])
+        self.assertEqual(context.defines[-1], 'debug_package 1')
+        dockerfile = context.render()
+        self.assertTrue('ENV RPMBUILD_STAGE -bb' in dockerfile)
+        self.assertTrue("--define '_binary_payload w1.gzdio'" in dockerfile)
+        self.assertTrue('--nocheck $RPMBUILD_STAGE' in dockerfile)
+        self.assertNotEqual(PackagerContext('foo').digest(),
+                            PackagerContext('foo', profile=PROFILES['dev'])
+                            .digest())
+
+    def test_context_image_copies_from_shared_image(self):
+        context = PackagerContext('centos:7', spec='foo.spec',
+                                  sources=['foo.tar.gz'],
+                                  context_image='rpmbuild_context:abc')
+        dockerfile = context.render()
+        self.assertTrue('COPY --from=rpmbuild_context:abc /context/foo.spec '
+                        '/rpmbuild/SPECS/foo.spec' in dockerfile)
+        self.assertTrue('COPY --from=rpmbuild_context:abc /context/foo.tar.gz '
+                        '/rpmbuild/SOURCES/foo.tar.gz' in dockerfile)
+
+    @patch('tempfile.mkdtemp')
+    def test_packager_context_setup_context_image_skips_temp_dir(self, mkdtemp):
+        with patch('rpmbuild.open', self.open, create=True):
+            context = PackagerContext('foo', spec='foo.spec',
+                                      context_image='rpmbuild_context:abc')
+            context.setup()
+        self.assertFalse(mkdtemp.called)
+
+    def test_setup_records_context_size(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            spec = os.path.join(tmp, 'foo.spec')
+            with open(spec, 'w') as f:
+                f.write('Name: foo\n')
+            context = PackagerContext('foo', spec=spec, stream=True)
+            context.setup()
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(context.metrics.name, 'foo.spec')
+        self.assertEqual(context.metrics.phases['setup']['bytes'], 10)
+
+    def test_setup_retrieves_sources_on_the_host(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            spec = os.path.join(tmp, 'foo.spec')
+            with open(spec, 'w') as f:
+                f.write('Name: foo\n'
+                        'Source0: http://example.com/foo-1.0.tar.gz\n'
+                        'Source1: http://example.com/foo.conf\n')
+            local = os.path.join(tmp, 'foo.conf')
+            open(local, 'w').close()
+            cache = MagicMock()
+            cache.fetch_all.return_value = (
+                {'http://example.com/foo-1.0.tar.gz': '/cache/foo-1.0.tar.gz'},
+                {})
+            context = PackagerContext('foo', spec=spec, sources=[local],
+                                      retrieve=True, download_cache=cache,
+                                      stream=True)
+            context.setup()
+        finally:
+            shutil.rmtree(tmp)
+        cache.fetch_all.assert_called_with(
+            ['http://example.com/foo-1.0.tar.gz'])
+        self.assertEqual(context.sources, [local, '/cache/foo-1.0.tar.gz'])
+        self.assertFalse('spectool' in context.render())
+
+    def test_setup_falls_back_to_spectool(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            spec = os.path.join(tmp, 'foo.spec')
+            with open(spec, 'w') as f:
+                f.write('Name: foo\nSource0: http://example.com/foo.tar.gz\n')
+            cache = MagicMock()
+            cache.fetch_all.return_value = (
+                {}, {'http://example.com/foo.tar.gz': IOError()})
+            context = PackagerContext('foo', spec=spec, retrieve=True,
+                                      download_cache=cache, stream=True)
+            context.setup()
+        finally:
+            shutil.rmtree(tmp)
+        self.assertTrue('spectool -g -R -A' in context.render())
+
+    def test_digest_covers_inputs(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            spec = os.path.join(tmp, 'foo.spec')
+            with open(spec, 'w') as f:
+                f.write('Name: foo\n')
+            context = PackagerContext('foo', spec=spec, sources=[tmp])
+            digest = context.digest('0123')
+            self.assertEqual(context.digest('0123'), digest)
+            self.assertNotEqual(context.digest('4567'), digest)
+            context.defines = ['dist .el7']
+            self.assertNotEqual(context.digest('0123'), digest)
+            context.defines = []
+            with open(spec, 'a') as f:
+                f.write('Version: 1\n')
+            self.assertNotEqual(context.digest('0123'), digest)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_image_digest_ignores_location(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            specs = []
+            for checkout in ('a', 'b'):
+                os.mkdir(os.path.join(tmp, checkout))
+                specs.append(os.path.join(tmp, checkout, 'foo.spec'))
+                with open(specs[-1], 'w') as f:
+                    f.write('Name: foo\n')
+            first, second = [PackagerContext('centos:7', spec=spec)
+                             for spec in specs]
+            self.assertEqual(first.image_digest(), second.image_digest())
+            with open(specs[1], 'a') as f:
+                f.write('Version: 1\n')
+            self.assertNotEqual(first.image_digest(), second.image_digest())
+            second.image = 'centos:6'
+            self.assertNotEqual(second.image_digest(),
+                                PackagerContext('centos:7',
+                                                spec=specs[1]).image_digest())
+        finally:
+            shutil.rmtree(tmp)
+
     def test_image_throws_packagerexception_if_empty(self):
         self.assertRaises(PackagerException, PackagerContext, image=None)
 
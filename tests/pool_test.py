@@ -0,0 +1,162 @@
+from mock import MagicMock
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from rpmbuild import Packager, PackagerContext, PackagerException
+from rpmbuild.pool import BuilderPool
+
+
+def archive(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    data.seek(0)
+    return data
+
+
+class BuilderPoolTestCase(unittest.TestCase):
+    """Tests for pool.py"""
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.exec_start.return_value = [b'Wrote: foo', b'.rpm\nDone\n']
+        self.client.exec_inspect.return_value = {'ExitCode': 0}
+        self.client.get_archive.side_effect = lambda container, path: (
+            archive({'RPMS/noarch/foo.rpm': b'rpm'} if path.endswith('/RPMS')
+                    else {'SRPMS/foo.src.rpm': b'srpm'}), {})
+        self.output = tempfile.mkdtemp()
+        self.context = PackagerContext('centos:7', spec='/specs/foo.spec',
+                                       defines=['dist .el7'])
+        self.context.toolchain = 'rpmbuild_base:abc'
+        self.context.chunks = MagicMock(return_value=iter([b'context']))
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def scripts(self):
+        return [call[0][1][2] for call in self.client.exec_create.call_args_list]
+
+    def test_every_job_gets_a_fresh_container(self):
+        self.client.create_container.side_effect = [{'Id': 'a'}, {'Id': 'b'}]
+        pool = BuilderPool(self.client)
+        for i in range(2):
+            pool.run(Packager(self.context, client=self.client), self.output,
+                     lambda line: None)
+
+        self.client.create_container.assert_called_with(
+            'rpmbuild_base:abc', command=['tail', '-f', '/dev/null'],
+            volumes=None,
+            host_config=self.client.create_host_config.return_value)
+        self.client.create_host_config.assert_called_with(binds=None)
+        self.assertEqual(
+            [call[0][0] for call in self.client.start.call_args_list],
+            [{'Id': 'a'}, {'Id': 'b'}])
+        self.assertEqual(
+            [call[0][0] for call in self.client.remove_container.call_args_list],
+            [{'Id': 'a'}, {'Id': 'b'}])
+        self.client.remove_container.assert_called_with({'Id': 'b'}, v=True,
+                                                        force=True)
+
+    def test_jobs_start_from_the_deps_image(self):
+        self.context.build_requires = ['gcc']
+        pool = BuilderPool(self.client)
+        pool.run(Packager(self.context, client=self.client), self.output,
+                 lambda line: None)
+
+        image = self.client.create_container.call_args[0][0]
+        self.assertEqual(image, self.context.deps_image)
+        self.assertTrue(image.startswith('rpmbuild_deps:'))
+
+    def test_run_builds_in_job_topdir_and_exports(self):
+        self.client.create_container.return_value = {'Id': 'a'}
+        packager = Packager(self.context, client=self.client)
+        lines = []
+
+        exported = BuilderPool(self.client).run(packager, self.output,
+                                                lines.append)
+
+        mkdir, script = self.scripts()
+        top = mkdir.split()[-1][:-len('/context')]
+        self.assertTrue(top.startswith('/rpmbuild-jobs/'))
+        container, path, chunks = self.client.put_archive.call_args[0]
+        self.assertEqual((container, path), ({'Id': 'a'}, top + '/context'))
+        self.assertEqual(list(chunks), [b'context'])
+        self.assertEqual(packager.metrics.phases['upload']['bytes'], 7)
+        self.assertEqual(packager.metrics.phases['export']['bytes'], 7)
+        self.assertTrue(("rpmbuild --define \"_topdir $top\"  --define "
+                         "'dist .el7'  -ba $top/SPECS/'foo.spec'") in script)
+        self.assertTrue('Wrote: foo.rpm' in lines)
+        self.assertEqual(exported, [os.path.join(self.output, 'foo.rpm'),
+                                    os.path.join(self.output, 'foo.src.rpm')])
+
+    def test_run_binds_output(self):
+        packager = Packager(self.context, client=self.client)
+        rpms = os.path.join(self.output, 'RPMS')
+
+        def build(container, cmd):
+            if 'rpmbuild' in cmd[2]:
+                with open(os.path.join(packager.staging, 'RPMS', 'foo.rpm'),
+                          'w') as f:
+                    f.write('rpm')
+            return 'exec'
+        self.client.exec_create.side_effect = build
+
+        exported = BuilderPool(self.client).run(packager, self.output,
+                                                lambda line: None, True)
+
+        top = self.scripts()[0].split()[-1][:-len('/context')]
+        binds = self.client.create_host_config.call_args[1]['binds']
+        self.assertEqual(sorted(b['bind'] for b in binds.values()),
+                         [top + '/RPMS', top + '/SRPMS'])
+        self.assertTrue(all(os.path.dirname(os.path.dirname(path)) ==
+                            self.output for path in binds))
+        self.assertEqual(
+            sorted(self.client.create_container.call_args[1]['volumes']),
+            [top + '/RPMS', top + '/SRPMS'])
+        self.assertFalse(self.client.get_archive.called)
+        self.assertEqual(exported, [os.path.join(rpms, 'foo.rpm')])
+        self.assertEqual(os.listdir(self.output), ['RPMS'])
+
+    def test_run_fails_on_exit_status_and_cleans_up(self):
+        self.client.exec_inspect.return_value = {'ExitCode': 1}
+        packager = Packager(self.context, client=self.client)
+
+        self.assertRaises(PackagerException, BuilderPool(self.client).run,
+                          packager, self.output, lambda line: None)
+        self.assertTrue(self.client.remove_container.called)
+        self.assertFalse(self.client.get_archive.called)
+
+    def test_packager_run_uses_pool(self):
+        pool = MagicMock()
+        pool.run.return_value = ['/out/foo.rpm']
+        packager = Packager(self.context, client=self.client, pool=pool)
+        packager.build_toolchain = MagicMock(return_value=[])
+        packager.build_image = MagicMock()
+
+        log = MagicMock()
+
+        self.assertEqual(packager.run('/out', log=log), ['/out/foo.rpm'])
+        pool.run.assert_called_with(packager, '/out', log, False)
+        self.assertFalse(packager.build_image.called)
+
+    def test_packager_run_builds_missing_deps_stage_for_pool(self):
+        self.context.build_requires = ['gcc']
+        self.client.images.return_value = []
+        self.client.build.return_value = []
+        pool = MagicMock()
+        pool.run.return_value = []
+        packager = Packager(self.context, client=self.client, pool=pool)
+
+        packager.run('/out', log=lambda line: None)
+
+        tags = [call[1]['tag'] for call in self.client.build.call_args_list]
+        self.assertEqual(tags, ['rpmbuild_base:abc', self.context.deps_image])
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,70 @@
+from mock import MagicMock
+import threading
+import time
+import unittest
+
+from rpmbuild import PackagerException
+from rpmbuild.scheduler import (MiB, ResourcePool, Resources, host_resources,
+                                job_resources, providers, waves)
+
+
+class SchedulerTestCase(unittest.TestCase):
+    """Tests for scheduler.py"""
+
+    def test_waves_run_independent_jobs_together(self):
+        graph = {0: set([1]), 1: set(), 2: set(), 3: set([0, 2])}
+        self.assertEqual(waves(graph), [[1, 2], [0], [3]])
+
+    def test_waves_detect_cycles(self):
+        graph = {0: set([1]), 1: set([0]), 2: set()}
+        self.assertRaises(PackagerException, waves, graph)
+
+    def test_providers_follow_the_graph(self):
+        graph = {0: set([1]), 1: set([2]), 2: set(), 3: set([2]), 4: set()}
+        self.assertEqual(providers(graph, 0), set([1, 2]))
+        self.assertEqual(providers(graph, 3), set([2]))
+        self.assertEqual(providers(graph, 4), set())
+
+    def test_job_resources_from_manifest(self):
+        default = Resources(2.0, 2048 * MiB)
+        self.assertEqual(job_resources({'cpus': 4, 'memory': 512}, default),
+                         Resources(4.0, 512 * MiB))
+        self.assertEqual(job_resources({}, default), default)
+
+    def test_host_resources_from_docker_info(self):
+        client = MagicMock()
+        client.info.return_value = {'NCPU': 8, 'MemTotal': 16 * 1024 * MiB}
+        self.assertEqual(host_resources(client),
+                         Resources(8.0, 16 * 1024 * MiB))
+        client.info.return_value = {}
+        self.assertTrue(host_resources(client).cpus >= 1)
+
+    def test_resource_pool_packs_jobs(self):
+        pool = ResourcePool(Resources(4.0, 4096 * MiB))
+        running = []
+        peak = []
+
+        def job(cpus):
+            with pool.reserve(Resources(cpus, 1024 * MiB)):
+                running.append(cpus)
+                peak.append(sum(running))
+                time.sleep(0.05)
+                running.remove(cpus)
+
+        threads = [threading.Thread(target=job, args=(cpus,))
+                   for cpus in (3.0, 2.0, 1.0, 2.0)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(max(peak), 4.0)
+        self.assertEqual(pool.free, pool.capacity)
+
+    def test_resource_pool_clamps_oversized_jobs(self):
+        pool = ResourcePool(Resources(2.0, 1024 * MiB))
+        with pool.reserve(Resources(16.0, 4096 * MiB)) as share:
+            self.assertEqual(share, Resources(2.0, 1024 * MiB))
+            self.assertEqual(pool.free, Resources(0.0, 0))
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
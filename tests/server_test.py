@@ -0,0 +1,126 @@
+# Python 2/3 Compatibility
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+
+from rpmbuild.server import BuildServer, make_server
+
+from fakedocker import FakeDocker
+
+
+class UnixHTTPConnection(HTTPConnection):
+
+    def __init__(self, path):
+        HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class BuildServerTestCase(unittest.TestCase):
+    """Tests for server.py against a fake docker daemon"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.docker = FakeDocker().__enter__()
+        self.builds = BuildServer({'base_url': self.docker.base_url,
+                                   'version': '1.24'},
+                                  workers=2, log=lambda line: None)
+        self.socket = os.path.join(self.tmp, 'rpmbuild.sock')
+        self.server = make_server(self.builds, 'unix://' + self.socket)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.builds.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.builds.stop()
+        self.docker.__exit__(None, None, None)
+        shutil.rmtree(self.tmp)
+
+    def request(self, method, path, body=None):
+        connection = UnixHTTPConnection(self.socket)
+        connection.request(method, path, body and json.dumps(body),
+                           {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        data = response.read().decode('utf-8')
+        connection.close()
+        return response.status, data
+
+    def spec(self, name):
+        path = os.path.join(self.tmp, '%s.spec' % name)
+        with open(path, 'w') as f:
+            f.write('Name: %s\n' % name)
+        return path
+
+    def test_submitted_job_is_built_and_its_log_streamed(self):
+        output = os.path.join(self.tmp, 'out')
+        status, data = self.request('POST', '/jobs', {
+            'image': 'centos:7', 'spec': self.spec('foo'), 'output': output,
+            'profile': 'dev'})
+        self.assertEqual(status, 201)
+        job = json.loads(data)
+        self.assertEqual(job['name'], 'foo.spec')
+
+        status, log = self.request('GET', '/jobs/%d/log' % job['id'])
+        self.assertEqual(status, 200)
+        self.assertTrue('Wrote: /rpmbuild/SRPMS/foo-1.0-1.src.rpm\n' in log)
+
+        status, data = self.request('GET', '/jobs/%d' % job['id'])
+        job = json.loads(data)
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(sorted(os.path.basename(p) for p in job['rpms']),
+                         ['foo-1.0-1.noarch.rpm', 'foo-1.0-1.src.rpm'])
+        self.assertTrue('rpmbuild' in job['metrics']['phases'])
+        self.assertTrue('--nocheck' in self.docker.builds[-1][1])
+
+        status, data = self.request('GET', '/jobs')
+        self.assertEqual([j['id'] for j in json.loads(data)], [job['id']])
+
+    def test_failed_job_reports_error(self):
+        status, data = self.request('POST', '/jobs', {
+            'image': 'centos:7', 'spec': os.path.join(self.tmp, 'bar.spec'),
+            'output': os.path.join(self.tmp, 'out')})
+        job_id = json.loads(data)['id']
+        status, log = self.request('GET', '/jobs/%d/log' % job_id)
+        self.assertTrue('Container build failed!' in log)
+        job = json.loads(self.request('GET', '/jobs/%d' % job_id)[1])
+        self.assertEqual(job['state'], 'failed')
+
+    def test_invalid_jobs_are_rejected(self):
+        status, data = self.request('POST', '/jobs', {'image': 'centos:7'})
+        self.assertEqual(status, 400)
+        status, data = self.request('POST', '/jobs', {
+            'image': 'centos:7', 'spec': 'foo.spec'})
+        self.assertEqual(status, 400)
+        self.assertTrue('absolute' in json.loads(data)['message'])
+        status, data = self.request('POST', '/jobs', {
+            'image': 'centos:7', 'spec': self.spec('foo'), 'profile': 'x'})
+        self.assertEqual(status, 400)
+        status, data = self.request('POST', '/jobs', {
+            'image': 'centos:7', 'spec': self.spec('foo'), 'profile': ['x']})
+        self.assertEqual(status, 400)
+        status, data = self.request('POST', '/jobs', {
+            'image': 'centos:7', 'spec': self.spec('foo'), 'output': 42})
+        self.assertEqual(status, 400)
+        self.assertEqual(self.request('GET', '/jobs/42')[0], 404)
+
+    def test_socket_is_private(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket).st_mode), 0o600)
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
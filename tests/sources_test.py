@@ -0,0 +1,235 @@
+# Python 2/3 Compatibility
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from mock import patch
+import fcntl
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from rpmbuild.cache import CACHE_ENV
+from rpmbuild.sources import (DownloadCache, IgnoreRules, ParallelGzipFile,
+                              directory_digest, pack_directories,
+                              pack_directory, select_files, source_name)
+
+
+class Upstream(ThreadingMixIn, HTTPServer):
+    """Local stand-in for upstream download sites, counting requests."""
+
+    daemon_threads = True
+
+    def __init__(self, files):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), UpstreamHandler)
+        self.files = files
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        body = self.server.files[self.path]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SourcesTestCase(unittest.TestCase):
+    """Tests for sources.py"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'foo-1.0')
+        os.makedirs(os.path.join(self.source, 'src'))
+        with open(os.path.join(self.source, 'src', 'foo.c'), 'w') as f:
+            f.write('int main() { return 0; }\n')
+        self.env = patch.dict(os.environ,
+                              {CACHE_ENV: os.path.join(self.tmp, 'cache')})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_parallel_gzip_file_is_valid_gzip(self):
+        data = os.urandom(1000) * 300
+        out = io.BytesIO()
+        with ParallelGzipFile(out, workers=3, block_size=4096) as gz:
+            for i in range(0, len(data), 1000):
+                gz.write(data[i:i + 1000])
+        with gzip.GzipFile(fileobj=io.BytesIO(out.getvalue())) as f:
+            self.assertEqual(f.read(), data)
+
+    def test_directory_digest_follows_content(self):
+        digest = directory_digest(self.source)
+        os.utime(os.path.join(self.source, 'src', 'foo.c'), (0, 0))
+        self.assertEqual(directory_digest(self.source), digest)
+        with open(os.path.join(self.source, 'src', 'foo.c'), 'a') as f:
+            f.write('\n')
+        self.assertNotEqual(directory_digest(self.source), digest)
+
+    def test_pack_directory_contents(self):
+        archive = pack_directory(self.source)
+        self.assertTrue(archive.endswith('.gz'))
+        with tarfile.open(archive) as tar:
+            members = dict((m.name, m) for m in tar.getmembers())
+        self.assertTrue('./src/foo.c' in members)
+        self.assertEqual(members['./src/foo.c'].uid, 0)
+        self.assertEqual(members['./src/foo.c'].uname, 'root')
+
+    def test_pack_directory_is_cached(self):
+        archive = pack_directory(self.source, 'tar')
+        with patch('rpmbuild.sources._pack') as pack:
+            self.assertEqual(pack_directory(self.source, 'tar'), archive)
+            self.assertFalse(pack.called)
+
+    def test_pack_directories_evicts_old_archives(self):
+        first = pack_directory(self.source, 'tar')
+        os.utime(first, (0, 0))
+        with open(os.path.join(self.source, 'foo.patch'), 'w') as f:
+            f.write('patch')
+        with pack_directories([self.source], 'tar', max_bytes=0) as packed:
+            self.assertFalse(os.path.exists(first))
+            self.assertTrue(os.path.exists(packed[self.source]))
+
+    def test_pack_directories_keeps_archives_handed_out(self):
+        other = os.path.join(self.tmp, 'other')
+        os.mkdir(other)
+        with open(os.path.join(other, 'bar.c'), 'w') as f:
+            f.write('int bar;')
+        with pack_directories([self.source, other], 'tar',
+                              max_bytes=0) as packed:
+            self.assertEqual(sorted(packed), sorted([self.source, other]))
+            self.assertTrue(all(os.path.exists(archive)
+                                for archive in packed.values()))
+            cache = os.path.dirname(packed[other])
+            with open(os.path.join(cache, '.lock')) as f:
+                # Eviction of other builds waits until the block is left.
+                self.assertRaises(IOError, fcntl.flock, f,
+                                  fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_pack_directory_rejects_unknown_format(self):
+        self.assertRaises(ValueError, pack_directory, self.source, 'zip')
+
+    def test_source_name(self):
+        self.assertEqual(source_name('http://example.com/foo-1.0.tar.gz'),
+                         'foo-1.0.tar.gz')
+        self.assertEqual(source_name('https://example.com/v1.0#/foo.tar.gz'),
+                         'foo.tar.gz')
+
+    def test_ignore_rules(self):
+        rules = IgnoreRules(['# build leftovers', '*.rpm', '**/*.o', '.git',
+                             '!keep.rpm'])
+        self.assertTrue(rules.ignored('foo-1.0-1.x86_64.rpm'))
+        self.assertTrue(rules.ignored('src/lib/foo.o'))
+        self.assertTrue(rules.ignored('.git/objects/ab'))
+        self.assertFalse(rules.ignored('keep.rpm'))
+        self.assertFalse(rules.ignored('sub/foo.rpm'))
+        self.assertFalse(rules.ignored('foo.conf'))
+
+    def test_select_files_honours_ignore_file(self):
+        with open(os.path.join(self.source, '.rpmbuildignore'), 'w') as f:
+            f.write('src\n!src/foo.c\n')
+        os.makedirs(os.path.join(self.source, 'build'))
+        for name in ('src/foo.o', 'build/out', 'foo.patch'):
+            open(os.path.join(self.source, name), 'w').close()
+
+        self.assertEqual(select_files(self.source, ['build']),
+                         ['foo.patch', os.path.join('src', 'foo.c')])
+
+    def test_select_files_by_name(self):
+        for name in ('foo.patch', 'foo-1.0.tar.gz', 'foo-0.9.tar.gz'):
+            open(os.path.join(self.source, name), 'w').close()
+
+        self.assertEqual(select_files(self.source, ['foo-0.*'],
+                                      ['foo.patch', 'foo-%{version}.tar.gz']),
+                         ['foo-1.0.tar.gz', 'foo.patch'])
+
+    def test_download_cache_fetches_each_url_once(self):
+        upstream = Upstream({'/foo-1.0.tar.gz': b'foo', '/bar.patch': b'bar'})
+        try:
+            urls = [upstream.url('/foo-1.0.tar.gz'), upstream.url('/bar.patch')]
+            cache = DownloadCache(os.path.join(self.tmp, 'downloads'))
+            fetched, failed = cache.fetch_all(urls)
+            self.assertEqual(failed, {})
+            self.assertEqual(sorted(os.path.basename(p)
+                                    for p in fetched.values()),
+                             ['bar.patch', 'foo-1.0.tar.gz'])
+            with open(fetched[urls[0]], 'rb') as f:
+                self.assertEqual(f.read(), b'foo')
+
+            again, failed = DownloadCache(cache.path).fetch_all(urls)
+            self.assertEqual(again, fetched)
+            self.assertEqual(len(upstream.requests), 2)
+        finally:
+            upstream.close()
+
+    def test_download_cache_reports_failures(self):
+        upstream = Upstream({})
+        try:
+            cache = DownloadCache(os.path.join(self.tmp, 'downloads'))
+            url = upstream.url('/missing.tar.gz')
+            fetched, failed = cache.fetch_all([url])
+            self.assertEqual(fetched, {})
+            self.assertEqual(list(failed), [url])
+            self.assertEqual(cache.get(url), None)
+            self.assertEqual(sorted(os.listdir(cache.path)),
+                             ['.lock', 'objects', 'urls'])
+        finally:
+            upstream.close()
+
+    def test_download_cache_refetches_damaged_files(self):
+        upstream = Upstream({'/foo.tar.gz': b'foo'})
+        try:
+            cache = DownloadCache(os.path.join(self.tmp, 'downloads'))
+            path = cache.fetch(upstream.url('/foo.tar.gz'))
+            with open(path, 'wb') as f:
+                f.write(b'truncated')
+            self.assertEqual(cache.fetch(upstream.url('/foo.tar.gz')), path)
+            self.assertEqual(len(upstream.requests), 2)
+        finally:
+            upstream.close()
+
+    def test_download_cache_checks_contents_not_only_size(self):
+        upstream = Upstream({'/foo.tar.gz': b'foo'})
+        try:
+            cache = DownloadCache(os.path.join(self.tmp, 'downloads'))
+            url = upstream.url('/foo.tar.gz')
+            path = cache.fetch(url)
+            with open(path, 'wb') as f:
+                f.write(b'bar')
+            self.assertEqual(cache.get(url), None)
+            cache.fetch(url)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'foo')
+        finally:
+            upstream.close()
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
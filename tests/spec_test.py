@@ -0,0 +1,88 @@
+import unittest
+
+from rpmbuild.spec import Spec
+
+
+SPEC = """
+%global upstream foo
+Name:           %{upstream}-tools
+Version:        1.2
+Release:        1%{?dist}
+Source0:        http://example.com/%{upstream}-%{version}.tar.gz
+Source1:        foo.conf
+Patch12:        https://example.com/fix.patch#/foo-fix.patch
+BuildRequires:  gcc, make >= 3.8
+BuildRequires:  %{name}-devel pkgconfig(glib-2.0)
+BuildRequires:  %{unknown}
+%if 0%{?rhel} >= 7
+BuildRequires:  systemd
+%endif
+
+%description
+BuildRequires: not-a-tag
+
+%package devel
+Summary: Development files
+BuildRequires: zlib-devel
+Provides: foo-headers = %{version}
+
+%package -n libfoo
+Summary: Library
+"""
+
+
+class SpecTestCase(unittest.TestCase):
+    """Tests for spec.py"""
+
+    def test_expand_known_macros(self):
+        spec = Spec(SPEC)
+        self.assertEqual(spec.expand('%{name}-%version'), 'foo-tools-1.2')
+        self.assertEqual(list(spec.values('source0')),
+                         ['http://example.com/foo-1.2.tar.gz'])
+
+    def test_expand_conditional_macros(self):
+        spec = Spec(SPEC, defines=['dist .el7'])
+        self.assertEqual(spec.expand('%{?dist}'), '.el7')
+        self.assertEqual(spec.expand('%{?missing}'), '')
+        self.assertEqual(spec.expand('%{?dist:yes}'), 'yes')
+        self.assertEqual(spec.expand('%{!?dist:no}'), '')
+        self.assertEqual(spec.expand('%{unknown}'), '%{unknown}')
+
+    def test_build_requires(self):
+        spec = Spec(SPEC)
+        self.assertEqual(spec.build_requires, [
+            'foo-tools-devel',
+            'gcc',
+            'make >= 3.8',
+            'pkgconfig(glib-2.0)',
+            'zlib-devel',
+        ])
+
+    def test_build_requires_names_include_conditionals(self):
+        spec = Spec(SPEC)
+        self.assertEqual(spec.build_requires_names, set([
+            'foo-tools-devel', 'gcc', 'make', 'pkgconfig(glib-2.0)',
+            'systemd', 'zlib-devel']))
+
+    def test_provides(self):
+        spec = Spec(SPEC)
+        self.assertEqual(spec.name, 'foo-tools')
+        self.assertEqual(spec.provides, set([
+            'foo-tools', 'foo-tools-devel', 'foo-headers', 'libfoo']))
+
+    def test_remote_sources(self):
+        spec = Spec(SPEC)
+        self.assertEqual(spec.remote_sources, [
+            'http://example.com/foo-1.2.tar.gz',
+            'https://example.com/fix.patch#/foo-fix.patch'])
+
+    def test_source_files(self):
+        spec = Spec(SPEC)
+        self.assertEqual(spec.source_files, [
+            'foo-1.2.tar.gz', 'foo.conf', 'foo-fix.patch'])
+
+    def test_defines_take_precedence(self):
+        spec = Spec(SPEC, defines=['upstream bar'])
+        self.assertEqual(spec.expand('%{name}'), 'bar-tools')
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4